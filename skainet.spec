@@ -9,7 +9,17 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[('./src/skainet/config.ini', 'skainet')],
-    hiddenimports=[],
+    hiddenimports=[
+        'skainet.audio',
+        'skainet.config',
+        'skainet.file',
+        'skainet.image',
+        'skainet.model',
+        'skainet.moderate',
+        'skainet.session',
+        'skainet.stats',
+        'skainet.text',
+    ],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
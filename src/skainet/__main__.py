@@ -1,21 +1,95 @@
+import importlib
 import os
+import sys
+from typing import Dict, List, Optional, Tuple
 
 import click
-import openai
 from importlib_metadata import version
 
-from skainet.audio import audio
-from skainet.config import config
+from skainet import daemon, perf
 from skainet.data import load_key, save_key
-from skainet.file import file
-from skainet.image import image
-from skainet.model import model
-from skainet.moderate import moderate
-from skainet.text import chat, complete, edit
 
+# name -> (module, attribute, short help)
+# Short help is duplicated here so that `skai --help` can list every command
+# without importing the modules (and openai along with them)
+COMMANDS: Dict[str, Tuple[str, str, str]] = {
+    "audio": ("skainet.audio", "audio", "Audio translation and transcription"),
+    "chat": ("skainet.text", "chat", "Chat with ChatGPT"),
+    "complete": ("skainet.text", "complete", "Text Completion"),
+    "config": ("skainet.config", "config", "Skainet configuration"),
+    "edit": ("skainet.text", "edit", "Text editing"),
+    "file": ("skainet.file", "file", "File management"),
+    "image": ("skainet.image", "image", "Image generation and manipulation"),
+    "model": ("skainet.model", "model", "Get information about available models"),
+    "moderate": (
+        "skainet.moderate",
+        "moderate",
+        "Check if text violates OpenAI's Content Policy",
+    ),
+    "serve": ("skainet.daemon", "serve", "Run a warm skai daemon"),
+    "session": ("skainet.session", "session", "Manage chat sessions"),
+    "stats": ("skainet.stats", "stats", "Latency and token usage of API calls"),
+}
 
-@click.group(invoke_without_command=True)
+
+class LazyGroup(click.Group):
+    """
+    click.Group that only imports a command's module once the command is dispatched
+    """
+
+    def __init__(self, *args, lazy_commands: Dict[str, Tuple[str, str, str]], **kwargs):
+        self.lazy_commands = lazy_commands
+        super().__init__(*args, **kwargs)
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> Optional[click.Command]:
+        if cmd_name in self.commands:
+            return self.commands[cmd_name]
+        if cmd_name not in self.lazy_commands:
+            return None
+
+        module_name, attribute, _ = self.lazy_commands[cmd_name]
+        with perf.timer("command_import"):
+            command = getattr(importlib.import_module(module_name), attribute)
+        self.add_command(command, cmd_name)
+        return command
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter):
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.commands:
+                command = self.commands[name]
+                if command.hidden:
+                    continue
+                short_help = command.get_short_help_str(formatter.width)
+            else:
+                short_help = self.lazy_commands[name][2]
+            rows.append((name, short_help))
+
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+
+def enable_profiling(ctx: click.Context, param: click.Parameter, value: str):
+    # Eager, so that recording starts before the subcommand's module is imported
+    if value:
+        perf.enable(value)
+
+
+@click.group(cls=LazyGroup, lazy_commands=COMMANDS, invoke_without_command=True)
 @click.version_option(version("skainet"))
+@click.option(
+    "--profile",
+    metavar="PATH",
+    envvar="SKAI_PROFILE",
+    is_eager=True,
+    expose_value=False,
+    callback=enable_profiling,
+    help="Write a timing report to PATH when skai exits. Use a .prof or .pstats extension for a cProfile dump, or - for stderr",
+)
 @click.option("--key", "new_key", is_flag=True, help="Show prompt to save an API key")
 def main(new_key: bool):
     """Skainet - Shell tool for interacting with the OpenAI API"""
@@ -31,19 +105,20 @@ def main(new_key: bool):
         )
         save_key(key)
 
-    openai.api_key = key
+    # Subcommands are resolved before this callback runs, so any command that
+    # talks to the API has already imported openai by now
+    openai = sys.modules.get("openai")
+    if openai is not None:
+        openai.api_key = key
 
 
-main.add_command(chat)
-main.add_command(edit)
-main.add_command(complete)
-main.add_command(config)
-main.add_command(image)
-main.add_command(model)
-main.add_command(moderate)
-main.add_command(file)
-main.add_command(audio)
+def run():
+    """Entry point, hands the invocation to a running daemon if there is one"""
+    code = daemon.forward(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+    main()
 
 
 if __name__ == "__main__":
-    main()
+    run()
@@ -0,0 +1,27 @@
+import asyncio
+from typing import Awaitable, TypeVar
+
+import openai
+
+from skainet import connection
+
+T = TypeVar("T")
+
+
+async def _with_session(awaitable: Awaitable[T]) -> T:
+    async with connection.async_session() as session:
+        token = openai.aiosession.set(session)
+        try:
+            return await awaitable
+        finally:
+            openai.aiosession.reset(token)
+
+
+def run(awaitable: Awaitable[T]) -> T:
+    """
+    Run a coroutine from a sync command and return its result
+
+    Each call runs one event loop in which every openai async request shares a
+    pooled session, so requests started with api.acall overlap without threads.
+    """
+    return asyncio.run(_with_session(awaitable))
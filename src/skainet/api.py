@@ -0,0 +1,357 @@
+import asyncio
+import email.utils
+import random
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+
+import aiohttp
+import openai
+import requests
+
+from skainet import connection, data, perf, ratelimit, stats, tokenizer
+
+DEFAULT_RETRIES = 4
+DEFAULT_MAX_DELAY = 30.0
+
+# First backoff, doubled on every attempt up to the max delay
+BASE_DELAY = 0.5
+
+# A Retry-After longer than this fails the request instead of waiting
+MAX_RETRY_AFTER = 120.0
+
+# Error classes
+RATE_LIMIT = "rate_limit"
+TIMEOUT = "timeout"
+SERVER = "server"
+INVALID = "invalid"
+
+_ERRORS = (
+    openai.OpenAIError,
+    requests.exceptions.RequestException,
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+)
+
+
+def classify(error: Exception) -> str:
+    if isinstance(error, openai.error.RateLimitError):
+        # Running out of quota is a rate limit that waiting doesn't fix
+        code = error.code or (error.error or {}).get("code")
+        if code == "insufficient_quota":
+            return INVALID
+        return RATE_LIMIT
+    if isinstance(
+        error,
+        (
+            openai.error.Timeout,
+            openai.error.APIConnectionError,
+            requests.exceptions.RequestException,
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+        ),
+    ):
+        return TIMEOUT
+    if isinstance(error, (openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+        return SERVER
+    if isinstance(error, openai.error.APIError):
+        status = error.http_status
+        return SERVER if status is None or status >= 500 else INVALID
+    return INVALID
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the API asked to wait before retrying, if it did"""
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def _settings():
+    config = data.load_config()
+    retries = config.getint("api", "retries", fallback=DEFAULT_RETRIES)
+    max_delay = config.getfloat("api", "max_delay", fallback=DEFAULT_MAX_DELAY)
+    return retries, max_delay
+
+
+def _delay(error: Exception, attempt: int, idempotent: bool) -> Optional[float]:
+    """Seconds to wait before the next attempt, or None if the error is final"""
+    retries, max_delay = _settings()
+    kind = classify(error)
+    if attempt >= retries or kind == INVALID:
+        return None
+    # A request that timed out or failed on the server may have been carried out,
+    # rate limited requests never were
+    if kind != RATE_LIMIT and not idempotent:
+        return None
+
+    # Full jitter, so processes that were limited together don't retry together
+    delay = random.uniform(0, min(max_delay, BASE_DELAY * 2**attempt))
+    after = retry_after(error)
+    if after is not None:
+        if after > MAX_RETRY_AFTER:
+            return None
+        delay = max(delay, after)
+
+    perf.incr("api_retries")
+    perf.incr(f"api_retries_{kind}")
+    perf.add("api_backoff", delay)
+    return delay
+
+
+def _as_openai_error(error: Exception) -> openai.OpenAIError:
+    if isinstance(error, openai.OpenAIError):
+        return error
+    return openai.error.APIConnectionError(f"Error communicating with OpenAI: {error}")
+
+
+# Completion length assumed for the rate limit when max_tokens isn't set
+DEFAULT_COMPLETION_TOKENS = 256
+
+
+def prompt_tokens(kwargs: Dict[str, Any]) -> int:
+    """Tokens in a request's prompt, messages, input and instruction"""
+    texts = [kwargs.get("input"), kwargs.get("instruction"), kwargs.get("suffix")]
+    prompt = kwargs.get("prompt")
+    texts += prompt if isinstance(prompt, list) else [prompt]
+    texts += [message["content"] for message in kwargs.get("messages") or []]
+    return sum(tokenizer.count(text) for text in texts if isinstance(text, str))
+
+
+def estimate_tokens(kwargs: Dict[str, Any]) -> int:
+    """Tokens a request may use, its prompt plus the longest completion it allows"""
+    completion_tokens = kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    return prompt_tokens(kwargs) + completion_tokens * (kwargs.get("n") or 1)
+
+
+def _send(function: Callable, args, kwargs, idempotent: bool, metrics: stats.Call):
+    attempt = 0
+    while True:
+        ratelimit.acquire(kwargs.get("model"), lambda: estimate_tokens(kwargs))
+        connection.use()
+        try:
+            response = function(*args, **kwargs)
+            metrics.responded(response)
+            return response
+        except _ERRORS as error:
+            delay = _delay(error, attempt, idempotent)
+            if delay is None:
+                raise _as_openai_error(error) from error
+            time.sleep(delay)
+            attempt += 1
+            metrics.retries += 1
+            _rewind(args, kwargs)
+
+
+async def _asend(
+    function: Callable, args, kwargs, idempotent: bool, metrics: stats.Call
+):
+    attempt = 0
+    while True:
+        await ratelimit.aacquire(kwargs.get("model"), lambda: estimate_tokens(kwargs))
+        try:
+            response = await function(*args, **kwargs)
+            metrics.responded(response)
+            return response
+        except _ERRORS as error:
+            delay = _delay(error, attempt, idempotent)
+            if delay is None:
+                raise _as_openai_error(error) from error
+            await asyncio.sleep(delay)
+            attempt += 1
+            metrics.retries += 1
+            _rewind(args, kwargs)
+
+
+def _rewind(args, kwargs):
+    # Files uploaded by the failed attempt are sent again from the start
+    for value in [*args, *kwargs.values()]:
+        if hasattr(value, "seek"):
+            value.seek(0)
+
+
+def call(function: Callable, *args, idempotent: bool = True, **kwargs):
+    """
+    Make an API request, retrying rate limits, timeouts and server errors
+
+    Retries back off exponentially with jitter, or as long as the API's Retry-After
+    asks for. Requests that aren't idempotent are only retried when they were rate
+    limited. A stream that breaks off is requested again and continued where it
+    stopped, if it's deterministic (temperature 0). Each call's latency, retries and
+    tokens are recorded for skai stats.
+    """
+    metrics = stats.Call(function, kwargs)
+    try:
+        response = _send(function, args, kwargs, idempotent, metrics)
+    except Exception:
+        metrics.finish(failed=True)
+        raise
+    if kwargs.get("stream"):
+        # Streams don't report usage, count the prompt as it was sent
+        metrics.prompt_tokens = prompt_tokens(kwargs)
+        return _resume(response, function, args, kwargs, idempotent, metrics)
+    metrics.finish()
+    return response
+
+
+async def acall(function: Callable, *args, idempotent: bool = True, **kwargs):
+    """
+    call for the openai async API, e.g. acall(openai.ChatCompletion.acreate, ...)
+
+    Must run in an event loop started by aio.run, streams are async iterators.
+    """
+    metrics = stats.Call(function, kwargs)
+    try:
+        response = await _asend(function, args, kwargs, idempotent, metrics)
+    except Exception:
+        metrics.finish(failed=True)
+        raise
+    if kwargs.get("stream"):
+        # Streams don't report usage, count the prompt as it was sent
+        metrics.prompt_tokens = prompt_tokens(kwargs)
+        return _aresume(response, function, args, kwargs, idempotent, metrics)
+    metrics.finish()
+    return response
+
+
+def _choice_text(choice: Dict[str, Any]) -> str:
+    if "delta" in choice:
+        return choice["delta"].get("content") or ""
+    return choice.get("text") or ""
+
+
+def _with_text(choice: Dict[str, Any], text: str) -> Dict[str, Any]:
+    choice = dict(choice)
+    if "delta" in choice:
+        choice["delta"] = dict(choice["delta"], content=text)
+    else:
+        choice["text"] = text
+    return choice
+
+
+class StreamDiverged(openai.error.APIError):
+    """A stream was resumed but the new response didn't repeat what was sent"""
+
+
+class _Replay:
+    """Skips the text a resumed stream repeats, so each chunk is passed on once"""
+
+    def __init__(self):
+        # Text passed on so far for each choice, and how much of it a replacement
+        # stream has repeated
+        self.emitted: Dict[int, List[str]] = {}
+        self.expected: Dict[int, str] = {}
+        self.replayed: Dict[int, int] = {}
+        self.attempt = 0
+
+    def chunk(self, chunk: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """The part of chunk not sent before, None if there is none"""
+        choices = []
+        for choice in chunk["choices"]:
+            index = choice.get("index", 0)
+            text = _choice_text(choice)
+            done = self.replayed.get(index, 0)
+            if done < len(self.expected.get(index, "")):
+                repeated = self.expected[index][done : done + len(text)]
+                if not text.startswith(repeated):
+                    raise StreamDiverged("Resumed stream did not match")
+                self.replayed[index] = done + len(repeated)
+                text = text[len(repeated) :]
+                if not text:
+                    continue
+                choice = _with_text(choice, text)
+            self.emitted.setdefault(index, []).append(text)
+            choices.append(choice)
+
+        if not choices and chunk["choices"]:
+            return None
+        return dict(chunk, choices=choices) if self.expected else chunk
+
+    def end(self):
+        if any(
+            self.replayed.get(i, 0) < len(text) for i, text in self.expected.items()
+        ):
+            raise StreamDiverged("Resumed stream ended early")
+
+    def restart(self, error: Exception, kwargs, idempotent: bool) -> float:
+        """Seconds to wait before requesting the stream again, or raise error"""
+        delay = None
+        if kwargs.get("temperature") == 0:
+            delay = _delay(error, self.attempt, idempotent)
+        if delay is None:
+            raise _as_openai_error(error) from error
+
+        perf.incr("stream_resumes")
+        self.attempt += 1
+        self.expected = {i: "".join(parts) for i, parts in self.emitted.items()}
+        self.replayed = {}
+        return delay
+
+
+def _resume(
+    response, function: Callable, args, kwargs, idempotent: bool, metrics: stats.Call
+) -> Iterator:
+    replay = _Replay()
+    failed = True
+    try:
+        while True:
+            try:
+                for chunk in response:
+                    chunk = replay.chunk(chunk)
+                    if chunk is not None:
+                        metrics.chunk(chunk)
+                        yield chunk
+                replay.end()
+                failed = False
+                return
+            except StreamDiverged:
+                raise
+            except _ERRORS as error:
+                time.sleep(replay.restart(error, kwargs, idempotent))
+                metrics.retries += 1
+                response = _send(function, args, kwargs, idempotent, metrics)
+    except GeneratorExit:
+        failed = False  # the caller stopped reading
+        raise
+    finally:
+        metrics.finish(failed)
+
+
+async def _aresume(
+    response, function: Callable, args, kwargs, idempotent: bool, metrics: stats.Call
+) -> AsyncIterator:
+    replay = _Replay()
+    failed = True
+    try:
+        while True:
+            try:
+                async for chunk in response:
+                    chunk = replay.chunk(chunk)
+                    if chunk is not None:
+                        metrics.chunk(chunk)
+                        yield chunk
+                replay.end()
+                failed = False
+                return
+            except StreamDiverged:
+                raise
+            except _ERRORS as error:
+                await asyncio.sleep(replay.restart(error, kwargs, idempotent))
+                metrics.retries += 1
+                response = await _asend(function, args, kwargs, idempotent, metrics)
+    except GeneratorExit:
+        failed = False  # the caller stopped reading
+        raise
+    finally:
+        metrics.finish(failed)
@@ -4,7 +4,7 @@ from typing import BinaryIO
 import click
 import openai
 
-from skainet import utils
+from skainet import api, utils
 from skainet.data import CONFIG
 
 DEFAULT_AUDIO_MODEL = CONFIG["audio"]["model"]
@@ -105,7 +105,8 @@ def transcribe(
     """Transcribes audio into the input language"""
 
     try:
-        response = openai.Audio.transcribe(
+        response = api.call(
+            openai.Audio.transcribe,
             model=model,
             file=audio,
             temperature=temp,
@@ -131,7 +132,8 @@ def translate(
     """Translate audio into English"""
 
     try:
-        response = openai.Audio.translate(
+        response = api.call(
+            openai.Audio.translate,
             model=model,
             file=audio,
             temperature=temp,
@@ -0,0 +1,162 @@
+import asyncio
+import functools
+import json
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    TextIO,
+    Tuple,
+)
+
+import click
+
+DEFAULT_CONCURRENCY = 4
+
+
+def batch_options(function):
+    """Options for commands that can run a file of prompts"""
+
+    @click.option(
+        "-b",
+        "--batch",
+        "batch_file",
+        type=click.File("r"),
+        is_eager=True,
+        callback=_batch_callback,
+        help="Run every prompt in FILE (JSON lines or one prompt per line, - for stdin) and write the results as JSON lines",
+    )
+    @click.option(
+        "-j",
+        "--concurrency",
+        type=click.IntRange(min=1),
+        default=DEFAULT_CONCURRENCY,
+        help="Number of batch or chunk requests to run at once",
+    )
+    @click.option(
+        "--completion-order",
+        is_flag=True,
+        help="Write batch results as they finish instead of in input order",
+    )
+    @functools.wraps(function)
+    def wrapper_batch_options(*args, **kwargs):
+        return function(*args, **kwargs)
+
+    return wrapper_batch_options
+
+
+def _batch_callback(ctx: click.Context, param: click.Parameter, value):
+    # Lets utils.Prompt know stdin belongs to the batch, not the prompt
+    if value is not None:
+        ctx.meta["skainet.batch"] = True
+    return value
+
+
+def read_items(file: TextIO) -> Iterator[Dict[str, Any]]:
+    """
+    Batch items from a file, one per line
+
+    A line can be a JSON object, a JSON string or plain text, strings become
+    {"prompt": line}
+    """
+    for line in file:
+        if not line.strip():
+            continue
+
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = line.rstrip("\n")
+
+        if not isinstance(item, dict):
+            item = {"prompt": item if isinstance(item, str) else line.rstrip("\n")}
+        yield item
+
+
+def pack(
+    items: Iterable[Dict[str, Any]],
+    size: int,
+    budget: int,
+    cost: Callable[[Dict[str, Any]], int],
+) -> Iterator[List[Tuple[int, Dict[str, Any]]]]:
+    """
+    Group consecutive items, with their indexes, for sending in one request
+
+    A group holds at most size items costing at most budget in total, an item
+    costing more than the budget gets a group of its own.
+    """
+    group: List[Tuple[int, Dict[str, Any]]] = []
+    total = 0
+    for index, item in enumerate(items):
+        item_cost = cost(item)
+        if group and (len(group) >= size or total + item_cost > budget):
+            yield group
+            group = []
+            total = 0
+        group.append((index, item))
+        total += item_cost
+    if group:
+        yield group
+
+
+async def run(
+    function: Callable[[Any], Awaitable[Any]],
+    items: Iterable[Any],
+    concurrency: int,
+    ordered: bool = True,
+) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Await function on every item, running at most concurrency at once
+
+    Yields (index, result) in input order, or in completion order if ordered is
+    False. Items are read lazily and at most twice the concurrency are held at any
+    time, so memory stays bounded no matter how many items there are.
+    """
+    window = concurrency * 2
+    items = enumerate(items)
+    semaphore = asyncio.Semaphore(concurrency)
+    pending: Dict[asyncio.Task, int] = {}
+    finished: Dict[int, Any] = {}
+    next_index = 0
+
+    async def limited(item: Any) -> Any:
+        async with semaphore:
+            return await function(item)
+
+    def fill():
+        while len(pending) + len(finished) < window:
+            try:
+                index, item = next(items)
+            except StopIteration:
+                return
+            pending[asyncio.ensure_future(limited(item))] = index
+
+    try:
+        fill()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # Yield completions in input order among those finished together
+            for task in sorted(done, key=pending.__getitem__):
+                index = pending.pop(task)
+                if ordered:
+                    finished[index] = task.result()
+                else:
+                    yield index, task.result()
+
+            while next_index in finished:
+                yield next_index, finished.pop(next_index)
+                next_index += 1
+
+            fill()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def error_result(error: Exception) -> Dict[str, str]:
+    return {"type": error.__class__.__name__, "message": str(error)}
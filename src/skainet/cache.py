@@ -0,0 +1,196 @@
+import functools
+import hashlib
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import click
+
+from skainet import api, data, perf
+
+CACHE_DIR = data.DATA_DIR / "cache"
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_SIZE = 50  # MB
+
+
+def cache_option(function):
+    """--cache/--no-cache, defaulting to the enabled setting in the [cache] config"""
+
+    @click.option(
+        "--cache/--no-cache",
+        "use_cache",
+        default=None,
+        help="Reuse responses to identical temperature 0 requests  [default: from config]",
+    )
+    @functools.wraps(function)
+    def wrapper_cache_option(*args, **kwargs):
+        return function(*args, **kwargs)
+
+    return wrapper_cache_option
+
+
+def enabled(use_cache: Optional[bool]) -> bool:
+    if use_cache is not None:
+        return use_cache
+    return data.load_config().getboolean("cache", "enabled", fallback=False)
+
+
+def _ttl() -> float:
+    return data.load_config().getfloat("cache", "ttl", fallback=DEFAULT_TTL)
+
+
+def _max_bytes() -> int:
+    size = data.load_config().getfloat("cache", "max_size", fallback=DEFAULT_MAX_SIZE)
+    return int(size * 1024 * 1024)
+
+
+def request_key(endpoint: str, parameters: Dict[str, Any]) -> str:
+    """Hash of the canonical form of a request, parameters left as None are dropped"""
+    request = {name: value for name, value in parameters.items() if value is not None}
+    request["endpoint"] = endpoint
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _path(key: str):
+    return CACHE_DIR / key[:2] / f"{key}.json"
+
+
+def load(key: str) -> Optional[Any]:
+    """Cached response for key, unless it's missing or older than the ttl"""
+    path = _path(key)
+    try:
+        entry = json.loads(path.read_bytes())
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - entry["created"] > _ttl():
+        try:
+            path.unlink()
+        except OSError:
+            pass
+        return None
+
+    # Modification time is the last use, the least recently used go first
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return entry["response"]
+
+
+# Eviction frees this share of max_size, so it runs once per that many bytes stored
+# rather than on every store once the cache is full
+EVICT_TO = 0.9
+
+# Bytes in the cache as of this process' last scan plus those it stored since,
+# None until the first store
+_size: Optional[int] = None
+
+
+def store(key: str, response: Any):
+    global _size
+    entry = json.dumps({"created": time.time(), "response": response})
+    data.atomic_write(_path(key), entry)
+
+    # Scanning the cache is only worth it once it may have outgrown the limit
+    max_bytes = _max_bytes()
+    if _size is not None:
+        _size += len(entry)
+    if _size is None or _size > max_bytes:
+        _size = evict(int(max_bytes * EVICT_TO))
+
+
+def evict(max_bytes: int) -> int:
+    """
+    Remove the least recently used responses until the cache fits in max_bytes
+
+    Returns the size of the cache that's left.
+    """
+    entries = []
+    for directory in CACHE_DIR.glob("??"):
+        for entry in os.scandir(directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+def _record(key: str, chunks: Iterator[Any]) -> Iterator[Any]:
+    """Pass a stream through, caching it once it has been read to the end"""
+    recorded = []
+    for chunk in chunks:
+        recorded.append(chunk)
+        yield chunk
+    store(key, recorded)
+
+
+async def _arecord(key: str, chunks: AsyncIterator[Any]) -> AsyncIterator[Any]:
+    recorded = []
+    async for chunk in chunks:
+        recorded.append(chunk)
+        yield chunk
+    store(key, recorded)
+
+
+async def _areplay(chunks: List[Any]) -> AsyncIterator[Any]:
+    for chunk in chunks:
+        yield chunk
+
+
+def create(resource, use_cache: Optional[bool], **parameters):
+    """
+    resource.create(**parameters), answered from the cache when possible
+
+    Only temperature 0 requests are cached, anything else is expected to vary
+    between calls. Cached streams are replayed chunk by chunk.
+    """
+    if not enabled(use_cache) or parameters.get("temperature"):
+        return api.call(resource.create, **parameters)
+
+    key = request_key(resource.OBJECT_NAME, parameters)
+    response = load(key)
+    if response is not None:
+        perf.incr("cache_hit")
+        return iter(response) if parameters.get("stream") else response
+
+    perf.incr("cache_miss")
+    response = api.call(resource.create, **parameters)
+    if parameters.get("stream"):
+        return _record(key, response)
+
+    store(key, response)
+    return response
+
+
+async def acreate(resource, use_cache: Optional[bool], **parameters):
+    """create using resource.acreate, for requests made in an event loop"""
+    if not enabled(use_cache) or parameters.get("temperature"):
+        return await api.acall(resource.acreate, **parameters)
+
+    key = request_key(resource.OBJECT_NAME, parameters)
+    response = load(key)
+    if response is not None:
+        perf.incr("cache_hit")
+        return _areplay(response) if parameters.get("stream") else response
+
+    perf.incr("cache_miss")
+    response = await api.acall(resource.acreate, **parameters)
+    if parameters.get("stream"):
+        return _arecord(key, response)
+
+    store(key, response)
+    return response
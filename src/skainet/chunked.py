@@ -0,0 +1,136 @@
+import functools
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Iterator, List, TextIO, Tuple
+
+import click
+
+from skainet import batch, perf, tokenizer
+
+DEFAULT_CHUNK_SIZE = 2000
+DEFAULT_CHUNK_OVERLAP = 100
+
+# Characters read from the input at a time
+READ_SIZE = 64 * 1024
+
+REDUCE_PROMPT = (
+    "The input was too long to read at once, so it was split into consecutive parts "
+    "and the request below was answered for each part. Combine the answers into one "
+    "answer to the request for the whole input.\n\n"
+    "Request: {prompt}\n\n{answers}"
+)
+
+
+def chunked_options(function):
+    """Options for commands that can map-reduce an input too long for one request"""
+
+    @click.option(
+        "--chunked",
+        is_flag=True,
+        is_eager=True,
+        callback=_chunked_callback,
+        help="Split piped input into chunks, answer PROMPT for each and combine the answers",
+    )
+    @click.option(
+        "--chunk-size",
+        type=click.IntRange(min=1),
+        default=DEFAULT_CHUNK_SIZE,
+        help="Tokens of input in each chunk",
+    )
+    @click.option(
+        "--chunk-overlap",
+        type=click.IntRange(min=0),
+        default=DEFAULT_CHUNK_OVERLAP,
+        help="Tokens at the end of each chunk repeated at the start of the next",
+    )
+    @functools.wraps(function)
+    def wrapper_chunked_options(*args, **kwargs):
+        return function(*args, **kwargs)
+
+    return wrapper_chunked_options
+
+
+def _chunked_callback(ctx: click.Context, param: click.Parameter, value: bool):
+    # Lets utils.Prompt know stdin is the input to split, not part of the prompt
+    if value:
+        ctx.meta["skainet.chunked"] = True
+    return value
+
+
+def chunks(file: TextIO, size: int, overlap: int) -> Iterator[str]:
+    """
+    The text read from file in chunks of at most size tokens, split between tokens
+
+    Each chunk starts with the last overlap tokens of the one before. The file is
+    read a block at a time, so only about one chunk is held at once.
+    """
+    window: Deque[Tuple[str, int]] = deque()
+    total = 0
+    new = False
+    blocks = iter(lambda: file.read(READ_SIZE), "")
+    for piece, tokens in tokenizer.stream_pieces(blocks):
+        if new and total + tokens > size:
+            yield "".join(text for text, _ in window)
+            kept: Deque[Tuple[str, int]] = deque()
+            total = 0
+            while window and total + window[-1][1] <= overlap:
+                kept.appendleft(window.pop())
+                total += kept[0][1]
+            window = kept
+            new = False
+        window.append((piece, tokens))
+        total += tokens
+        new = True
+
+    if new:
+        yield "".join(text for text, _ in window)
+
+
+def reduce_prompt(prompt: str, answers: List[str]) -> str:
+    numbered = "\n\n".join(
+        f"Answer for part {n}:\n{answer}" for n, answer in enumerate(answers, 1)
+    )
+    return REDUCE_PROMPT.format(prompt=prompt, answers=numbered)
+
+
+async def run(
+    request: Callable[[str], Awaitable[str]],
+    prompt: str,
+    file: TextIO,
+    size: int,
+    overlap: int,
+    concurrency: int,
+) -> str:
+    """
+    Answer prompt for the whole of file, however long it is
+
+    request sends a user message and returns the answer. prompt is answered for
+    every chunk of the file, concurrency at a time, then the answers are combined
+    by a reduce request. Answers are combined as they arrive whenever they outgrow
+    the chunk size, so memory use doesn't grow with the input.
+    """
+    start = time.perf_counter()
+
+    async def answer(chunk: str) -> str:
+        perf.incr("chunks")
+        return await request(f"{prompt}\n\n{chunk}")
+
+    async def reduce(answers: List[str]) -> str:
+        perf.incr("chunk_reduces")
+        return await request(reduce_prompt(prompt, answers))
+
+    answers: List[str] = []
+    total = 0
+    async for _, partial in batch.run(answer, chunks(file, size, overlap), concurrency):
+        tokens = tokenizer.count(partial)
+        if len(answers) > 1 and total + tokens > size:
+            answers = [await reduce(answers)]
+            total = tokenizer.count(answers[0])
+        answers.append(partial)
+        total += tokens
+
+    if not answers:
+        raise click.UsageError("--chunked needs input piped to skai")
+    result = answers[0] if len(answers) == 1 else await reduce(answers)
+    perf.record("map_reduce", time.perf_counter() - start)
+    return result
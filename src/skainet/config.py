@@ -3,7 +3,7 @@ from typing import List
 
 import click
 
-from skainet.data import _CONFIG_FILE, CONFIG
+from skainet.data import _CONFIG_FILE, load_config, save_config
 
 
 @click.group("config", help="Skainet configuration")
@@ -15,6 +15,7 @@ def config():
 @config.command()
 def show():
     """Display contents of config file"""
+    load_config()  # creates the config file if it doesn't exist yet
     click.echo(_CONFIG_FILE.read_text())
 
 
@@ -30,8 +31,9 @@ def path():
 def set(setting: List[str], value: str):
     """Set a variable in the config file"""
     config_path = setting
+    config = load_config()
     try:
-        dic = CONFIG
+        dic = config
         for key in config_path[:-1]:
             dic = dic[key]
         dic[config_path[-1]] = value
@@ -39,5 +41,4 @@ def set(setting: List[str], value: str):
         click.echo(f"{' '.join(setting)} does not exist", err=True)
         sys.exit(1)
 
-    with open(_CONFIG_FILE, "w") as configfile:
-        CONFIG.write(configfile)
+    save_config(config)
@@ -0,0 +1,170 @@
+import contextlib
+import functools
+import threading
+from typing import Any, AsyncIterator, Dict, Optional, Tuple, Union
+
+import aiohttp
+import openai
+import requests
+
+from skainet import data, perf
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 600.0
+
+# Connection attempts retried by urllib3, as the openai client does
+CONNECT_RETRIES = 2
+
+
+class _Adapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter applying the configured timeouts and counting connection reuse"""
+
+    def __init__(self, timeout: Tuple[float, float], **kwargs):
+        self.timeout = timeout
+        # Connections each pool had opened as of the last response counted
+        self._opened: Dict[Any, int] = {}
+        self._lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        kwargs["timeout"] = self.timeout
+        response = super().send(request, **kwargs)
+        pool = getattr(response.raw, "_pool", None)
+        if pool is not None:
+            with self._lock:
+                opened = pool.num_connections - self._opened.get(pool, 0)
+                self._opened[pool] = pool.num_connections
+            perf.incr("http_requests")
+            if opened:
+                perf.incr("http_connections_opened", opened)
+            else:
+                perf.incr("http_connections_reused")
+        return response
+
+
+def _settings() -> Tuple[int, float, float, Optional[str]]:
+    config = data.load_config()
+    return (
+        config.getint("api", "pool_size", fallback=DEFAULT_POOL_SIZE),
+        config.getfloat("api", "connect_timeout", fallback=DEFAULT_CONNECT_TIMEOUT),
+        config.getfloat("api", "read_timeout", fallback=DEFAULT_READ_TIMEOUT),
+        config.get("api", "proxy", fallback="") or None,
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _session(
+    pool_size: int, connect_timeout: float, read_timeout: float, proxy: Optional[str]
+) -> requests.Session:
+    session = requests.Session()
+    adapter = _Adapter(
+        (connect_timeout, read_timeout),
+        pool_connections=4,
+        pool_maxsize=pool_size,
+        max_retries=CONNECT_RETRIES,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if proxy:
+        session.proxies = {"http": proxy, "https": proxy}
+    return session
+
+
+def session() -> requests.Session:
+    """
+    The pooled session every API request in this process goes through
+
+    Connections are kept alive between requests, commands and threads. A new
+    session is made if the [api] settings change, e.g. in a long running daemon.
+    """
+    return _session(*_settings())
+
+
+def use():
+    """Send this thread's API requests through the shared session"""
+    if _prewarm is not None:
+        # The connection being opened is further along than a new one would be
+        _prewarm.join(PREWARM_WAIT)
+    openai.api_requestor._thread_context.session = session()
+
+
+# Longest a request waits for the prewarmed connection before opening its own
+PREWARM_WAIT = 5.0
+
+_prewarm: Optional[threading.Thread] = None
+
+
+def _warm_up(session: requests.Session, url: str):
+    with perf.timer("prewarm"):
+        try:
+            session.head(url)
+        except requests.RequestException:
+            pass  # the request itself will fail and report it
+
+
+def prewarm():
+    """
+    Connect to the API in the background, e.g. while the prompt is being written
+
+    DNS, TCP and TLS are done by the time the request is made, rather than after,
+    and the connection is left in the shared session's pool for it.
+    """
+    global _prewarm
+    if _prewarm is None:
+        _prewarm = threading.Thread(
+            target=_warm_up, args=(session(), openai.api_base), daemon=True
+        )
+        _prewarm.start()
+
+
+async def _connection_opened(session, context, params):
+    perf.incr("http_requests")
+    perf.incr("http_connections_opened")
+
+
+async def _connection_reused(session, context, params):
+    perf.incr("http_requests")
+    perf.incr("http_connections_reused")
+
+
+class _ProxiedSession:
+    """
+    A ClientSession sending every request through proxy
+
+    ClientSession only takes a default proxy from aiohttp 3.10, which needs Python
+    3.8, so it's passed with each request instead.
+    """
+
+    def __init__(self, client: aiohttp.ClientSession, proxy: str):
+        self._client = client
+        self._proxy = proxy
+
+    def request(self, method: str, url: str, **kwargs):
+        # openai passes proxy=None unless openai.proxy is set
+        if kwargs.get("proxy") is None:
+            kwargs["proxy"] = self._proxy
+        return self._client.request(method, url, **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+
+@contextlib.asynccontextmanager
+async def async_session() -> AsyncIterator[
+    Union[aiohttp.ClientSession, _ProxiedSession]
+]:
+    """
+    A pooled aiohttp session for the openai async API, closed on exit
+
+    Sized and proxied like session(). Timeouts are set per request by openai.
+    """
+    pool_size, _, _, proxy = _settings()
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(_connection_opened)
+    trace.on_connection_reuseconn.append(_connection_reused)
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size),
+        trace_configs=[trace],
+    ) as client:
+        yield _ProxiedSession(client, proxy) if proxy else client
@@ -0,0 +1,385 @@
+import importlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import traceback
+from pathlib import Path
+from typing import List, Optional
+
+import click
+
+from skainet import data
+
+SOCKET_FILE = Path(os.getenv("SKAI_SOCKET", data.DATA_DIR / "daemon.sock"))
+
+# openai reads these once, when it's imported, so the daemon can only serve clients
+# that agree with its own environment on them
+OPENAI_ENV = [
+    "OPENAI_API_KEY_PATH",
+    "OPENAI_ORGANIZATION",
+    "OPENAI_API_BASE",
+    "OPENAI_API_TYPE",
+]
+# Read by requests for each request
+_PROXY_ENV = ["HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "NO_PROXY"]
+
+# Environment variables forwarded from the client for each invocation
+FORWARDED_ENV = [
+    "OPENAI_API_KEY",
+    "SKAI_SESSION",
+    "REQUESTS_CA_BUNDLE",
+    "CURL_CA_BUNDLE",
+    *OPENAI_ENV,
+    *_PROXY_ENV,
+    *(name.lower() for name in _PROXY_ENV),
+]
+
+# Frames are a 1 byte kind followed by a 4 byte payload length
+_FRAME_HEADER = struct.Struct("!BI")
+
+# Most stdin the daemon asks the client for at once
+STDIN_BLOCK_SIZE = 64 * 1024
+
+# client -> daemon
+_ARGS = 1
+_STDIN = 2
+
+# daemon -> client
+_STDOUT = 3
+_STDERR = 4
+_STDIN_REQUEST = 5
+_EXIT = 6
+_FALLBACK = 7
+
+
+class TerminalRequired(Exception):
+    """Raised inside the daemon when a command needs the client's terminal"""
+
+
+def _send_frame(connection: socket.socket, kind: int, payload: bytes = b""):
+    connection.sendall(_FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+
+def _recv_exact(connection: socket.socket, size: int) -> bytes:
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = connection.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("connection closed mid-frame")
+        buffer += chunk
+    return bytes(buffer)
+
+
+def _recv_frame(connection: socket.socket):
+    kind, size = _FRAME_HEADER.unpack(_recv_exact(connection, _FRAME_HEADER.size))
+    return kind, _recv_exact(connection, size)
+
+
+## Client
+def available() -> bool:
+    return hasattr(socket, "AF_UNIX") and SOCKET_FILE.exists()
+
+
+def forward(argv: List[str]) -> Optional[int]:
+    """
+    Run argv in the daemon, streaming its output to this process
+
+    Returns the exit code, or None if there is no daemon to hand the invocation to
+    (or the daemon hands it back) and it should run in-process instead
+    """
+    if not available() or "SKAI_NO_DAEMON" in os.environ:
+        return None
+    if "SKAI_PROFILE" in os.environ or "--profile" in argv or argv[:1] == ["serve"]:
+        return None
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(str(SOCKET_FILE))
+    except OSError:
+        connection.close()
+        return None
+
+    header = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "env": {name: os.environ[name] for name in FORWARDED_ENV if name in os.environ},
+        "isatty": [
+            sys.stdin.isatty(),
+            sys.stdout.isatty(),
+            sys.stderr.isatty(),
+        ],
+    }
+
+    with connection:
+        _send_frame(connection, _ARGS, json.dumps(header).encode())
+        while True:
+            try:
+                kind, payload = _recv_frame(connection)
+            except ConnectionError:
+                click.echo("Lost connection to skai daemon", err=True)
+                return 1
+
+            if kind == _STDOUT:
+                sys.stdout.buffer.write(payload)
+                sys.stdout.buffer.flush()
+            elif kind == _STDERR:
+                sys.stderr.buffer.write(payload)
+                sys.stderr.buffer.flush()
+            elif kind == _STDIN_REQUEST:
+                # stdin is read a block at a time as the command asks for it, so skai
+                # never swallows input it wouldn't have read in-process, and the
+                # daemon never holds more of it than the command does
+                (size,) = struct.unpack("!I", payload)
+                _send_frame(connection, _STDIN, sys.stdin.buffer.read1(size))
+            elif kind == _EXIT:
+                return struct.unpack("!i", payload)[0]
+            elif kind == _FALLBACK:
+                return None
+
+
+## Daemon
+class _FrameWriter(io.RawIOBase):
+    def __init__(self, connection: socket.socket, kind: int, isatty: bool):
+        self.connection = connection
+        self.kind = kind
+        self._isatty = isatty
+
+    def writable(self) -> bool:
+        return True
+
+    def isatty(self) -> bool:
+        return self._isatty
+
+    def write(self, b) -> int:
+        _send_frame(self.connection, self.kind, bytes(b))
+        return len(b)
+
+
+class _StdinReader(io.RawIOBase):
+    """The client's stdin as a raw stream, each read asks the client for a block"""
+
+    def __init__(self, connection: socket.socket):
+        self.connection = connection
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self._eof:
+            return 0
+        size = min(len(b), STDIN_BLOCK_SIZE)
+        _send_frame(self.connection, _STDIN_REQUEST, struct.pack("!I", size))
+        kind, payload = _recv_frame(self.connection)
+        if kind != _STDIN or not payload:
+            self._eof = True
+            return 0
+        b[: len(payload)] = payload
+        return len(payload)
+
+
+class _RemoteStdin(io.TextIOBase):
+    """stdin of the client, read from it as the command reads"""
+
+    def __init__(self, connection: socket.socket, isatty: bool):
+        self.connection = connection
+        self._isatty = isatty
+        self._stream: Optional[io.TextIOWrapper] = None
+
+    def _load(self) -> io.TextIOWrapper:
+        if self._stream is None:
+            if self._isatty:
+                raise TerminalRequired()
+
+            reader = io.BufferedReader(_StdinReader(self.connection), STDIN_BLOCK_SIZE)
+            self._stream = io.TextIOWrapper(reader, encoding="utf-8")
+        return self._stream
+
+    @property
+    def buffer(self):
+        return self._load().buffer
+
+    def isatty(self) -> bool:
+        return self._isatty
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> str:
+        return self._load().read(size)
+
+    def readline(self, size: Optional[int] = -1) -> str:
+        return self._load().readline(size)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    server: "_Server"
+
+    def handle(self):
+        kind, payload = _recv_frame(self.request)
+        if kind != _ARGS:
+            return
+
+        # Invocations run one at a time since they share the process' stdio, cwd
+        # and environment. Rather than queue behind a long running chat, a busy
+        # daemon hands the invocation back to the client.
+        if not self.server.lock.acquire(blocking=False):
+            _send_frame(self.request, _FALLBACK)
+            return
+
+        try:
+            code = self.server.execute(self.request, json.loads(payload))
+        finally:
+            self.server.lock.release()
+
+        if code is None:
+            _send_frame(self.request, _FALLBACK)
+        else:
+            _send_frame(self.request, _EXIT, struct.pack("!i", code))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: Path):
+        self.lock = threading.Lock()
+        self.config = None
+        super().__init__(str(path), _Handler)
+
+    def warm_up(self):
+        """Import every command, open the HTTP session and load the config"""
+        from skainet import __main__, connection, utils
+
+        for name in __main__.COMMANDS:
+            if name != "serve":
+                __main__.main.get_command(click.Context(__main__.main), name)
+
+        connection.session()
+        self.config = data.load_config()
+        utils.INTERACTIVE = False
+
+    def reload_commands(self):
+        """Re-import command modules so their defaults pick up a changed config"""
+        from skainet import __main__
+
+        modules = set()
+        for name, (module_name, _, _) in __main__.COMMANDS.items():
+            if name != "serve" and name in __main__.main.commands:
+                del __main__.main.commands[name]
+                modules.add(module_name)
+
+        for module_name in modules:
+            importlib.reload(sys.modules[module_name])
+
+        self.warm_up()
+
+    def execute(self, connection: socket.socket, header: dict) -> Optional[int]:
+        from skainet.__main__ import main
+
+        if any(header["env"].get(name) != os.getenv(name) for name in OPENAI_ENV):
+            return None  # handed back, to run with the client's openai settings
+
+        if data.load_config() is not self.config:
+            self.reload_commands()
+
+        stdin_tty, stdout_tty, stderr_tty = header["isatty"]
+        streams = sys.stdin, sys.stdout, sys.stderr
+        environ = dict(os.environ)
+        cwd = os.getcwd()
+
+        sys.stdin = _RemoteStdin(connection, stdin_tty)
+        sys.stdout = io.TextIOWrapper(
+            _FrameWriter(connection, _STDOUT, stdout_tty),
+            encoding="utf-8",
+            write_through=True,
+        )
+        sys.stderr = io.TextIOWrapper(
+            _FrameWriter(connection, _STDERR, stderr_tty),
+            encoding="utf-8",
+            write_through=True,
+        )
+        for name in FORWARDED_ENV:
+            os.environ.pop(name, None)
+        os.environ.update(header["env"])
+
+        try:
+            os.chdir(header["cwd"])
+            main.main(args=header["argv"], prog_name="skai")
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except TerminalRequired:
+            code = None
+        except (BrokenPipeError, ConnectionError):
+            code = 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        else:
+            code = 0
+        finally:
+            for stream in (sys.stdout, sys.stderr):
+                try:
+                    stream.flush()
+                except OSError:
+                    pass
+            sys.stdin, sys.stdout, sys.stderr = streams
+            os.environ.clear()
+            os.environ.update(environ)
+            os.chdir(cwd)
+
+        return code
+
+
+@click.command()
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=SOCKET_FILE,
+    show_default=True,
+    help="Path of the Unix socket to listen on",
+)
+def serve(socket_path: Path):
+    """Run a warm skai daemon
+
+    Keeps the OpenAI client, configuration and HTTPS connections loaded and serves
+    skai invocations over a Unix socket. While the daemon is running, skai hands its
+    invocations to it, otherwise commands run in-process as usual.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        click.echo("skai serve requires Unix domain sockets", err=True)
+        sys.exit(1)
+
+    if socket_path.exists():
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(socket_path))
+        except OSError:
+            socket_path.unlink()  # left behind by a daemon that didn't exit cleanly
+        else:
+            click.echo(f"A skai daemon is already listening on {socket_path}", err=True)
+            sys.exit(1)
+        finally:
+            probe.close()
+
+    data.make_data_dir()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+
+    server = _Server(socket_path)
+    os.chmod(socket_path, 0o600)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        server.warm_up()
+        click.echo(f"Listening on {socket_path}", err=True)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        socket_path.unlink()
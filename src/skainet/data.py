@@ -1,13 +1,18 @@
+import contextlib
+import io
 import json
 import os
 import platform
 import sys
+import tempfile
 from configparser import ConfigParser
 from pathlib import Path
-from typing import Dict, List
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 import click
 
+from skainet import perf
+
 ## Data Directory
 if platform.system() == "Windows":
     appdata = os.getenv("LOCALAPPDATA")
@@ -15,80 +20,254 @@ if platform.system() == "Windows":
 else:
     DATA_DIR = Path.home() / ".local" / "share" / __package__
 
-try:
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
-except OSError as e:
-    click.echo(f"Error while attempting to create data directory: {e}", err=True)
-    sys.exit(1)
+
+def make_data_dir():
+    """Create the data directory, nothing is written until something needs saving"""
+    try:
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        click.echo(f"Error while attempting to create data directory: {e}", err=True)
+        sys.exit(1)
+
+
+def atomic_write(path: Path, content: Union[str, bytes]):
+    """Write content to a temporary file next to path, then move it into place"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb" if isinstance(content, bytes) else "w") as file:
+            file.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+@contextlib.contextmanager
+def file_lock(path: Path, blocking: bool = True) -> Iterator[bool]:
+    """
+    Hold an exclusive lock on path (created if needed) for the duration of the block
+
+    Yields False instead of waiting if blocking is False and the lock is taken
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as file:
+        file.seek(0)
+        try:
+            if platform.system() == "Windows":
+                import msvcrt
+
+                mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+                msvcrt.locking(file.fileno(), mode, 1)
+            else:
+                import fcntl
+
+                mode = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+                fcntl.flock(file.fileno(), mode)
+        except OSError:
+            if blocking:
+                raise
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            if platform.system() == "Windows":
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
 
 
 ## Key File
 _KEY_FILE = DATA_DIR / "api_key"
-if not _KEY_FILE.exists():
-    _KEY_FILE.touch()
 
 
 def load_key() -> str:
+    if not _KEY_FILE.exists():
+        return ""
     return _KEY_FILE.read_text()
 
 
 def save_key(key: str):
+    make_data_dir()
     _KEY_FILE.write_text(key)
 
 
 ## Chat History
-_CHAT_FILE = DATA_DIR / "chat_history.json"
-if not _CHAT_FILE.exists():
-    _CHAT_FILE.write_text("[]")
+_CHAT_FILE = DATA_DIR / "chat_history.jsonl"
+_LEGACY_CHAT_FILE = DATA_DIR / "chat_history.json"
+
 
+def chat_history():
+    """The chat history store, importing the old single file history on first use"""
+    from skainet.history import History
 
-def load_chat() -> List[Dict[str, str]]:
-    with open(_CHAT_FILE) as file:
-        chat = json.load(file)
-    return chat
+    history = History(_CHAT_FILE)
+    if _LEGACY_CHAT_FILE.exists() and not _CHAT_FILE.exists():
+        with open(_LEGACY_CHAT_FILE) as file:
+            history.append(json.load(file))
+        _LEGACY_CHAT_FILE.rename(_LEGACY_CHAT_FILE.with_suffix(".json.bak"))
+    return history
 
 
-def save_chat(chat: List[Dict[str, str]]):
-    with open(_CHAT_FILE, "w") as file:
-        json.dump(chat, file, indent=2)
+def load_chat(context_limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    return chat_history().load(context_limit)
+
+
+def append_chat(messages: List[Dict[str, Any]]):
+    chat_history().append(messages)
+
+
+def clear_chat():
+    chat_history().clear()
 
 
 # Configuration
 default_config_path = Path(__file__).parent / "config.ini"
-if not default_config_path.exists():
-    click.echo(f"Default config ({default_config_path}) does not exist!", err=True)
-    sys.exit(1)
+_CONFIG_FILE = DATA_DIR / "config.ini"
 
-DEFAULT_CONFIG = ConfigParser()
-DEFAULT_CONFIG.read(default_config_path)
+# Snapshot of the merged configuration, keyed on the stat of both config files
+_CONFIG_CACHE = DATA_DIR / "config.cache.json"
 
+_config: Optional[ConfigParser] = None
+_config_stamp: Optional[List[Any]] = None
+
+
+def _stat_stamp(path: Path) -> Optional[Tuple[int, int]]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _config_files_stamp() -> List[Any]:
+    return [_stat_stamp(default_config_path), _stat_stamp(_CONFIG_FILE)]
+
+
+def _config_to_dict(config: ConfigParser) -> Dict[str, Dict[str, str]]:
+    return {
+        section: dict(config.items(section, raw=True)) for section in config.sections()
+    }
+
+
+def load_default_config() -> ConfigParser:
+    if not default_config_path.exists():
+        click.echo(f"Default config ({default_config_path}) does not exist!", err=True)
+        sys.exit(1)
+
+    default_config = ConfigParser()
+    default_config.read(default_config_path)
+    return default_config
+
+
+def save_config(config: ConfigParser):
+    buffer = io.StringIO()
+    config.write(buffer)
+    atomic_write(_CONFIG_FILE, buffer.getvalue())
+
+
+def _build_config() -> ConfigParser:
+    """
+    Parse the user's config file, creating it from the default config if it doesn't
+    exist, and merging in new default settings if the package default is newer
+    """
+    if not _CONFIG_FILE.exists():
+        default_config = load_default_config()
+        if platform.system() == "Darwin":
+            default_config["general"]["editor"] = "open"
+        elif platform.system() == "Windows":
+            default_config["general"]["editor"] = "notepad"
+        else:
+            default_config["general"]["editor"] = "nano"
+
+        save_config(default_config)
+        return default_config
+
+    config = ConfigParser()
+    config.read(_CONFIG_FILE)
+
+    default_stamp, config_stamp = _config_files_stamp()
+    if default_stamp is None or config_stamp[0] >= default_stamp[0]:
+        return config
+
+    # Add any settings in default_config that don't exist in config file
+    changed = False
+    default_config = load_default_config()
+    for section in default_config.sections():
+        if section not in config:
+            config.add_section(section)
+            changed = True
+
+        for key, value in default_config.items(section, raw=True):
+            if key not in config[section]:
+                config[section][key] = value
+                changed = True
+
+    if changed:
+        save_config(config)
+
+    return config
+
+
+def _read_config_cache(stamp: List[Any]) -> Optional[Dict[str, Dict[str, str]]]:
+    try:
+        with open(_CONFIG_CACHE) as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if cache.get("stamp") != stamp:
+        return None
+    return cache.get("config")
+
+
+def load_config() -> ConfigParser:
+    """
+    Return the merged configuration
+
+    The result is memoized for as long as neither config file changes on disk. A warm
+    start is served from a JSON snapshot, so no INI parsing or writing takes place.
+
+    Modules the daemon doesn't reload when the config changes (api, cache, stats) call
+    this whenever they need a setting rather than reading it once at import.
+    """
+    with perf.timer("config_load"):
+        return _load_config()
 
-# Create config file, copying default config if it doesn't exist
-_CONFIG_FILE = DATA_DIR / "config.ini"
-if not _CONFIG_FILE.exists():
-    if platform.system() == "Darwin":
-        DEFAULT_CONFIG["general"]["editor"] = "open"
-    elif platform.system() == "Windows":
-        DEFAULT_CONFIG["general"]["editor"] = "notepad"
-        editor = "notepad.exe"
-    else:
-        DEFAULT_CONFIG["general"]["editor"] = "nano"
 
-    with open(_CONFIG_FILE, "w") as configfile:
-        DEFAULT_CONFIG.write(configfile)
+def _load_config() -> ConfigParser:
+    global _config, _config_stamp
 
-CONFIG = ConfigParser()
-CONFIG.read(_CONFIG_FILE)
+    # json round trips tuples as lists
+    stamp = [list(s) if s else None for s in _config_files_stamp()]
+    if _config is not None and stamp == _config_stamp:
+        return _config
 
+    snapshot = _read_config_cache(stamp)
+    if snapshot is None:
+        snapshot = _config_to_dict(_build_config())
+        # Building the config may have created or rewritten the config file
+        stamp = [list(s) if s else None for s in _config_files_stamp()]
+        try:
+            atomic_write(
+                _CONFIG_CACHE, json.dumps({"stamp": stamp, "config": snapshot})
+            )
+        except OSError:
+            pass
 
-# Add any settings in default_config that don't exist in config file
-for section in DEFAULT_CONFIG.sections():
-    if section not in CONFIG:
-        CONFIG.add_section(section)
+    config = ConfigParser()
+    config.read_dict(snapshot)
+    _config, _config_stamp = config, stamp
+    return config
 
-    for key, value in DEFAULT_CONFIG.items(section):
-        if key not in CONFIG[section]:
-            CONFIG[section][key] = value
 
-with open(_CONFIG_FILE, "w") as configfile:
-    CONFIG.write(configfile)
+def __getattr__(name: str):
+    # CONFIG and DEFAULT_CONFIG are loaded on first access instead of at import
+    if name == "CONFIG":
+        return load_config()
+    if name == "DEFAULT_CONFIG":
+        return load_default_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -4,7 +4,7 @@ from pathlib import Path
 import click
 import openai
 
-from skainet import utils
+from skainet import api, utils
 
 FILE_PURPOSES = [
     "fine-tune",
@@ -20,7 +20,7 @@ def file():
 def list():
     """List files"""
     try:
-        response = openai.File.list()
+        response = api.call(openai.File.list)
     except openai.OpenAIError as e:
         utils.handle_openai_error(e)
     else:
@@ -47,8 +47,12 @@ def upload(
 ):
     """Upload file"""
     try:
-        response = openai.File.create(
-            file=file.read_text(), purpose=purpose, user_provided_filename=file.name
+        response = api.call(
+            openai.File.create,
+            idempotent=False,
+            file=file.read_text(),
+            purpose=purpose,
+            user_provided_filename=file.name,
         )
     except openai.OpenAIError as e:
         utils.handle_openai_error(e)
@@ -63,7 +67,8 @@ def delete(
 ):
     """Delete file"""
     try:
-        openai.File.delete(
+        api.call(
+            openai.File.delete,
             sid=file_id,
         )
     except openai.OpenAIError as e:
@@ -83,12 +88,13 @@ def delete(
 def download(file_id: str, output: Path):
     """Download file"""
     try:
-        response_bytes = openai.File.download(
+        response_bytes = api.call(
+            openai.File.download,
             id=file_id,
         )
 
         if not output or output.is_dir():
-            file_list = openai.File.list()
+            file_list = api.call(openai.File.list)
             for file_info in file_list["data"]:
                 if file_info["id"] == file_id:
                     file_name = file_info["filename"]
@@ -121,7 +127,8 @@ def find(
 ):
     """File information"""
     try:
-        response = openai.File.find_matching_files(
+        response = api.call(
+            openai.File.find_matching_files,
             name=name,
             bytes=size,
             purpose=purpose,
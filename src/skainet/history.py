@@ -0,0 +1,279 @@
+import json
+import os
+import struct
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from skainet.data import atomic_write, file_lock
+
+# The index starts with the id of its journal, followed by fixed width records
+# holding the journal offset, line length and token count of each message
+_ID_SIZE = 16
+_RECORD = struct.Struct("<QII")
+
+# Records read per step when scanning the index backwards
+_SCAN_RECORDS = 1024
+
+
+class History:
+    """
+    Append-only chat history
+
+    Messages are stored one per line in a JSON lines journal. A fixed width index
+    next to it holds the offset and token count of every message, so the context
+    for a chat can be loaded by reading only the tail of the journal. The first line
+    of the journal is an identifier that is also stored at the start of the index,
+    an index that doesn't belong to its journal (e.g. after a crash mid-compaction)
+    is rebuilt from the journal. The header also counts the messages dropped by
+    compaction, so every message keeps its position in the whole conversation.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.index_path = path.with_name(path.name + ".idx")
+        self.lock_path = path.with_name(path.name + ".lock")
+        # Files kept alongside the journal, removed with it
+        self.summary_path = path.with_name(path.name + ".summary.json")
+        self.terms_path = path.with_name(path.name + ".terms.db")
+
+    def __len__(self) -> int:
+        try:
+            size = self.index_path.stat().st_size
+        except FileNotFoundError:
+            return 0
+        return max(0, size - _ID_SIZE) // _RECORD.size
+
+    def _header(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path, "rb") as journal:
+                return json.loads(journal.readline())
+        except (OSError, ValueError):
+            return None
+
+    def _journal_id(self) -> Optional[bytes]:
+        header = self._header()
+        if header is None:
+            return None
+        return uuid.UUID(header["journal"]).bytes
+
+    def base(self) -> int:
+        """Number of messages dropped from the start of the history by compaction"""
+        header = self._header()
+        return header.get("base", 0) if header else 0
+
+    def _create(self, messages: Optional[List[Dict[str, Any]]] = None, base: int = 0):
+        """Start a new journal holding messages, replacing the current one"""
+        messages = messages or []
+        journal_id = uuid.uuid4()
+        header = {"journal": str(journal_id)}
+        if base:
+            header["base"] = base
+        header = json.dumps(header).encode() + b"\n"
+        lines = [encode(message) for message in messages]
+
+        index = bytearray(journal_id.bytes)
+        offset = len(header)
+        for line, message in zip(lines, messages):
+            index += _RECORD.pack(offset, len(line), message.get("tokens", 0))
+            offset += len(line)
+
+        # The journal is moved into place first, if that's all that happens the
+        # index is rebuilt the next time the history is opened
+        atomic_write(self.path, header + b"".join(lines))
+        atomic_write(self.index_path, bytes(index))
+
+    def _repair(self):
+        """Bring the index in line with the journal, must hold the lock"""
+        journal_id = self._journal_id()
+        if journal_id is None:
+            if self.path.exists():
+                os.replace(self.path, self.path.with_name(self.path.name + ".corrupt"))
+            self._create()
+            return
+
+        with open(self.index_path, "a+b") as index:
+            index.seek(0)
+            if index.read(_ID_SIZE) != journal_id:
+                index.truncate(0)
+                index.write(journal_id)
+
+            index_size = index.seek(0, os.SEEK_END)
+            index_size -= (index_size - _ID_SIZE) % _RECORD.size
+            if index_size > _ID_SIZE:
+                index.seek(index_size - _RECORD.size)
+                offset, length, _ = _RECORD.unpack(index.read(_RECORD.size))
+                indexed = offset + length
+            else:
+                with open(self.path, "rb") as journal:
+                    indexed = len(journal.readline())
+
+            journal_size = self.path.stat().st_size
+            if indexed > journal_size:
+                # Journal is shorter than the index says, start over
+                index.truncate(_ID_SIZE)
+                index_size = _ID_SIZE
+                with open(self.path, "rb") as journal:
+                    indexed = len(journal.readline())
+            index.truncate(index_size)
+
+            if indexed == journal_size:
+                return
+
+            # Index entries appended to the journal but missing from the index, and
+            # drop a partially written last line
+            records = bytearray()
+            with open(self.path, "r+b") as journal:
+                journal.seek(indexed)
+                for line in journal:
+                    if not line.endswith(b"\n"):
+                        journal.truncate(indexed)
+                        break
+                    tokens = json.loads(line).get("tokens", 0)
+                    records += _RECORD.pack(indexed, len(line), tokens)
+                    indexed += len(line)
+
+            index.seek(0, os.SEEK_END)
+            index.write(records)
+
+    def append(self, messages: List[Dict[str, Any]]):
+        """Append messages to the history as one write"""
+        lines = [encode(message) for message in messages]
+        with file_lock(self.lock_path):
+            self._repair()
+            with open(self.path, "ab") as journal:
+                offset = journal.seek(0, os.SEEK_END)
+                journal.write(b"".join(lines))
+
+            records = bytearray()
+            for line, message in zip(lines, messages):
+                records += _RECORD.pack(offset, len(line), message.get("tokens", 0))
+                offset += len(line)
+
+            with open(self.index_path, "ab") as index:
+                index.write(records)
+
+    def load(self, context_limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Most recent messages, enough to fill context_limit tokens plus the one that
+        didn't fit (or every message, if no limit is given)
+        """
+        if not self.path.exists():
+            return []
+
+        with file_lock(self.lock_path):
+            self._repair()
+            with open(self.index_path, "rb") as index:
+                count = (index.seek(0, os.SEEK_END) - _ID_SIZE) // _RECORD.size
+                if count == 0:
+                    return []
+
+                start = 0
+                if context_limit is not None:
+                    start = _find_start(index, count, context_limit)
+
+                index.seek(_ID_SIZE + start * _RECORD.size)
+                offset, _, _ = _RECORD.unpack(index.read(_RECORD.size))
+
+            with open(self.path, "rb") as journal:
+                journal.seek(offset)
+                return [json.loads(line) for line in journal]
+
+    def read(self, start: int, stop: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Messages from position start up to stop, counted from the start of the journal"""
+        if not self.path.exists():
+            return []
+
+        with file_lock(self.lock_path):
+            self._repair()
+            with open(self.index_path, "rb") as index:
+                count = (index.seek(0, os.SEEK_END) - _ID_SIZE) // _RECORD.size
+                stop = count if stop is None else min(stop, count)
+                if start >= stop:
+                    return []
+
+                index.seek(_ID_SIZE + start * _RECORD.size)
+                offset, _, _ = _RECORD.unpack(index.read(_RECORD.size))
+                index.seek(_ID_SIZE + (stop - 1) * _RECORD.size)
+                last, length, _ = _RECORD.unpack(index.read(_RECORD.size))
+
+            with open(self.path, "rb") as journal:
+                journal.seek(offset)
+                block = journal.read(last + length - offset)
+            return [json.loads(line) for line in block.splitlines()]
+
+    def clear(self):
+        with file_lock(self.lock_path):
+            self._create()
+            for path in [self.summary_path, self.terms_path]:
+                if path.exists():
+                    path.unlink()
+
+    def remove(self):
+        with file_lock(self.lock_path):
+            for path in [
+                self.path,
+                self.index_path,
+                self.summary_path,
+                self.terms_path,
+            ]:
+                if path.exists():
+                    path.unlink()
+
+    def token_total(self) -> int:
+        """Tokens in the whole history, read from the index alone"""
+        try:
+            index = self.index_path.read_bytes()[_ID_SIZE:]
+        except FileNotFoundError:
+            return 0
+        index = index[: len(index) - len(index) % _RECORD.size]
+        return sum(tokens for _, _, tokens in _RECORD.iter_unpack(index))
+
+    def compact(self, keep: int) -> bool:
+        """
+        Drop all but the last keep messages once the history holds twice that many,
+        every message if keep is 0
+
+        Skipped if another process holds the lock, it'll happen on a later call.
+        Returns True if the history was compacted.
+        """
+        if len(self) <= 2 * keep:
+            return False
+
+        with file_lock(self.lock_path, blocking=False) as locked:
+            if not locked:
+                return False
+            self._repair()
+            with open(self.path, "rb") as journal:
+                header = json.loads(journal.readline())
+                messages = [json.loads(line) for line in journal]
+            base = header.get("base", 0) + len(messages) - keep
+            self._create(messages[len(messages) - keep :], base)
+        return True
+
+
+def encode(message: Dict[str, Any]) -> bytes:
+    """message as a line of the journal"""
+    return json.dumps(message, ensure_ascii=False).encode() + b"\n"
+
+
+def estimate_tokens(size: int) -> int:
+    """Tokens in a message saved without a count, from the size of its journal line"""
+    return size // 4
+
+
+def _find_start(index, count: int, context_limit: int) -> int:
+    """Scan index records from the end until context_limit tokens are covered"""
+    total = 0
+    end = count
+    while end > 0:
+        start = max(0, end - _SCAN_RECORDS)
+        index.seek(_ID_SIZE + start * _RECORD.size)
+        block = index.read((end - start) * _RECORD.size)
+        for position in range(end - start - 1, -1, -1):
+            _, length, tokens = _RECORD.unpack_from(block, position * _RECORD.size)
+            total += tokens or estimate_tokens(length)
+            if total >= context_limit:
+                return start + position
+        end = start
+    return 0
@@ -12,7 +12,7 @@ from typing import BinaryIO
 import click
 import openai
 
-from skainet import utils
+from skainet import api, utils
 from skainet.data import CONFIG
 
 DEFAULT_NUM = int(CONFIG["image"]["num"])
@@ -84,7 +84,9 @@ def create(prompt: str, num: int, size: str, format: str, print_response: bool):
     """
 
     try:
-        response = openai.Image.create(
+        response = api.call(
+            openai.Image.create,
+            idempotent=False,
             prompt=prompt,
             n=num,
             size=size,
@@ -120,7 +122,9 @@ def edit(
     """
 
     try:
-        response = openai.Image.create_edit(
+        response = api.call(
+            openai.Image.create_edit,
+            idempotent=False,
             image=image,
             mask=mask,
             prompt=prompt,
@@ -150,7 +154,9 @@ def variation(
     input_image = image.read()
 
     try:
-        response = openai.Image.create_variation(
+        response = api.call(
+            openai.Image.create_variation,
+            idempotent=False,
             image=input_image,
             n=num,
             size=size,
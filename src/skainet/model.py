@@ -3,7 +3,7 @@ import sys
 import click
 import openai
 
-from skainet import utils
+from skainet import api, utils
 
 
 @click.group("model", help="Get information about available models")
@@ -16,7 +16,7 @@ def model():
 def list():
     """List available models"""
     try:
-        model_list = openai.Model.list()["data"]
+        model_list = api.call(openai.Model.list)["data"]
     except openai.OpenAIError as e:
         utils.handle_openai_error(e)
     else:
@@ -31,7 +31,7 @@ def list():
 def show(model_name: str):
     """Get information about a model"""
     try:
-        model_list = openai.Model.list()["data"]
+        model_list = api.call(openai.Model.list)["data"]
     except openai.OpenAIError as e:
         utils.handle_openai_error(e)
     else:
@@ -1,7 +1,7 @@
 import click
 import openai
 
-from skainet import utils
+from skainet import api, utils
 from skainet.data import CONFIG
 
 DEFAULT_CHAT_MODEL = CONFIG["moderation"]["model"]
@@ -19,7 +19,8 @@ DEFAULT_CHAT_MODEL = CONFIG["moderation"]["model"]
 def moderate(input: str, model: str):
     """Check if text violates OpenAI's Content Policy"""
     try:
-        response = openai.Moderation.create(
+        response = api.call(
+            openai.Moderation.create,
             input=input,
             model=model,
         )
@@ -0,0 +1,123 @@
+import atexit
+import builtins
+import contextlib
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+PSTATS_SUFFIXES = [".prof", ".pstats"]
+
+# Instrumentation for `skai --profile`, everything below is a no-op until enable()
+# is called so hot paths can record timings unconditionally
+
+_enabled = False
+_output: Optional[str] = None
+_profiler = None
+_start = time.perf_counter()
+
+_timings: Dict[str, float] = {}
+_counters: Dict[str, int] = {}
+_imports: Dict[str, Dict[str, float]] = {}
+
+_original_import = builtins.__import__
+_import_stack: List[float] = []
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    _import_stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        children = _import_stack.pop()
+        if _import_stack:
+            _import_stack[-1] += elapsed
+        if name not in _imports:
+            _imports[name] = {"self": elapsed - children, "cumulative": elapsed}
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def enable(output: str):
+    """
+    Start recording, the report is written to output when the process exits
+
+    If output ends in .prof or .pstats the whole run is profiled with cProfile and
+    written as a pstats file, otherwise a JSON report is written ("-" for stderr)
+    """
+    global _enabled, _output, _profiler
+    if _enabled:
+        return
+
+    _enabled = True
+    _output = output
+    builtins.__import__ = _timed_import
+
+    if Path(output).suffix in PSTATS_SUFFIXES:
+        import cProfile
+
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+    atexit.register(dump)
+
+
+def record(name: str, seconds: float):
+    if _enabled:
+        _timings[name] = seconds
+
+
+def add(name: str, seconds: float):
+    if _enabled:
+        _timings[name] = _timings.get(name, 0.0) + seconds
+
+
+def incr(name: str, count: int = 1):
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + count
+
+
+@contextlib.contextmanager
+def timer(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - start)
+
+
+def report() -> dict:
+    return {
+        "argv": sys.argv,
+        "total": time.perf_counter() - _start,
+        "timings": dict(_timings),
+        "counters": dict(_counters),
+        "imports": dict(
+            sorted(_imports.items(), key=lambda item: -item[1]["cumulative"])
+        ),
+    }
+
+
+def dump():
+    global _enabled
+    if not _enabled:
+        return
+
+    _enabled = False
+    builtins.__import__ = _original_import
+
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_output)
+    elif _output == "-":
+        sys.stderr.write(json.dumps(report(), indent=2) + "\n")
+    else:
+        Path(_output).write_text(json.dumps(report(), indent=2))
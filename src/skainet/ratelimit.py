@@ -0,0 +1,109 @@
+import asyncio
+import json
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from skainet import data, perf
+
+_STATE_FILE = data.DATA_DIR / "ratelimit.json"
+_STATE_LOCK = data.DATA_DIR / "ratelimit.lock"
+
+# Limits of models without their own entry in the [ratelimit] config
+DEFAULT_LIMIT = "default"
+
+# Longest single sleep while waiting, the buckets are checked again after it
+MAX_WAIT = 5.0
+
+_EPSILON = 1e-6
+
+
+def limits(model: Optional[str]) -> Tuple[str, int, int]:
+    """
+    Bucket name, and requests and tokens per minute allowed for model (0 for no limit)
+
+    Set in the [ratelimit] config as "<model> = <requests> <tokens>". Models without
+    their own entry share the default bucket.
+    """
+    config = data.load_config()
+    if not config.has_section("ratelimit"):
+        return DEFAULT_LIMIT, 0, 0
+
+    section = config["ratelimit"]
+    key = model if model and model in section else DEFAULT_LIMIT
+    try:
+        requests, tokens = (int(limit) for limit in section.get(key, "").split())
+    except ValueError:
+        return key, 0, 0
+    return key, requests, tokens
+
+
+def _refill(bucket: Dict[str, float], rpm: int, tpm: int, now: float):
+    elapsed = max(0.0, now - bucket["time"])
+    bucket["requests"] = min(rpm, bucket["requests"] + elapsed * rpm / 60)
+    bucket["tokens"] = min(tpm, bucket["tokens"] + elapsed * tpm / 60)
+    bucket["time"] = now
+
+
+def _take(key: str, rpm: int, tpm: int, tokens: int) -> float:
+    """Take a request and tokens from the key's buckets, or return how long to wait"""
+    with data.file_lock(_STATE_LOCK):
+        try:
+            with open(_STATE_FILE) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            state = {}
+
+        now = time.time()
+        bucket = state.get(key) or {"requests": rpm, "tokens": tpm, "time": now}
+        _refill(bucket, rpm, tpm, now)
+
+        # Refills are fractional, a bucket within rounding of enough is enough
+        wait = 0.0
+        if rpm and bucket["requests"] < 1 - _EPSILON:
+            wait = (1 - bucket["requests"]) * 60 / rpm
+        if tpm and bucket["tokens"] < tokens - _EPSILON:
+            wait = max(wait, (tokens - bucket["tokens"]) * 60 / tpm)
+
+        if not wait:
+            bucket["requests"] -= 1 if rpm else 0
+            bucket["tokens"] -= tokens if tpm else 0
+        state[key] = bucket
+        data.atomic_write(_STATE_FILE, json.dumps(state))
+    return wait
+
+
+def _waits(model: Optional[str], estimate: Callable[[], int]) -> Iterator[float]:
+    # Seconds to sleep before trying again, until the request fits in the budget
+    key, rpm, tpm = limits(model)
+    if not rpm and not tpm:
+        return
+
+    # A request larger than the whole budget waits for a full bucket
+    tokens = min(estimate(), tpm) if tpm else 0
+
+    start = time.perf_counter()
+    while True:
+        wait = _take(key, rpm, tpm, tokens)
+        if not wait:
+            break
+        perf.incr("ratelimit_waits")
+        yield min(wait, MAX_WAIT)
+    perf.add("ratelimit_wait", time.perf_counter() - start)
+
+
+def acquire(model: Optional[str], estimate: Callable[[], int]):
+    """
+    Wait until model's request and token budgets allow one more request
+
+    estimate is called for the tokens the request may use, only if there is a token
+    limit to check them against. The buckets are kept in a file under DATA_DIR, so
+    every skai process on the machine draws from the same budget.
+    """
+    for wait in _waits(model, estimate):
+        time.sleep(wait)
+
+
+async def aacquire(model: Optional[str], estimate: Callable[[], int]):
+    """acquire, waiting without blocking the event loop"""
+    for wait in _waits(model, estimate):
+        await asyncio.sleep(wait)
@@ -0,0 +1,225 @@
+import contextlib
+import math
+import re
+import sqlite3
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from skainet.history import History, encode, estimate_tokens
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Share of the context budget kept for the most recent messages, the rest goes to
+# the earlier messages most relevant to the prompt
+RECENT_SHARE = 0.5
+
+_WORD = re.compile(r"\w+")
+STOP_WORDS = frozenset(
+    "a an and are as at be but by can do for from has have how i in is it me my of "
+    "on or so that the this to was we what when where which who why will with you".split()
+)
+
+
+def terms(text: str) -> Dict[str, int]:
+    return Counter(
+        word for word in _WORD.findall(text.lower()) if word not in STOP_WORDS
+    )
+
+
+# Postings of each term, length (in terms) and tokens of each message, and the
+# totals BM25 needs, kept up to date as messages are added and removed
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    n INTEGER PRIMARY KEY, tokens INTEGER NOT NULL, length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL, n INTEGER NOT NULL, tf INTEGER NOT NULL,
+    PRIMARY KEY (term, n)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_n ON postings (n);
+CREATE TABLE IF NOT EXISTS totals (messages INTEGER NOT NULL, length INTEGER NOT NULL);
+INSERT INTO totals SELECT 0, 0 WHERE NOT EXISTS (SELECT 1 FROM totals);
+"""
+
+# Seconds to wait for another process updating the index
+BUSY_TIMEOUT = 10
+
+
+class TermIndex:
+    """
+    An inverted index of the messages in a history, for ranking them with BM25
+
+    Kept in an SQLite database next to the journal, so adding a message takes time
+    in proportion to its length and ranking reads only the postings of the query's
+    terms. Messages appended without updating the index are added when it's loaded,
+    and those dropped by compaction are removed then.
+    """
+
+    def __init__(self, history: History):
+        self.history = history
+        self.path = history.terms_path
+        # Token counts of the messages returned by rank
+        self.tokens: Dict[int, int] = {}
+
+    @contextlib.contextmanager
+    def _connect(self, write: bool = False) -> Iterator[sqlite3.Connection]:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if not self.path.exists():
+            # Replaces the JSON lines index of earlier versions, <history>.terms
+            with contextlib.suppress(OSError):
+                self.path.with_suffix("").unlink()
+        connection = sqlite3.connect(
+            str(self.path), timeout=BUSY_TIMEOUT, isolation_level=None
+        )
+        try:
+            connection.executescript(_SCHEMA)
+            if write:
+                # Taken before reading, so concurrent updates can't both apply
+                connection.execute("BEGIN IMMEDIATE")
+            yield connection
+            if write:
+                connection.execute("COMMIT")
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+    def add(self, messages: Dict[int, Dict[str, Any]]):
+        """Index messages, keyed by their position in the whole conversation"""
+        with self._connect(write=True) as connection:
+            _insert(connection, messages)
+
+    def load(self) -> "TermIndex":
+        """Bring the index up to date with the history"""
+        base = self.history.base()
+        end = base + len(self.history)
+        with self._connect(write=True) as connection:
+            first, last = connection.execute(
+                "SELECT min(n), max(n) FROM messages"
+            ).fetchone()
+            if first is not None and (first < base or last >= end):
+                # Dropped by compaction, or indexed before the history was cleared
+                _delete(connection, base, end)
+                (last,) = connection.execute("SELECT max(n) FROM messages").fetchone()
+
+            start = base if last is None else max(base, last + 1)
+            if start < end:
+                messages = self.history.read(start - base)
+                _insert(connection, {start + i: m for i, m in enumerate(messages)})
+        return self
+
+    def rank(self, query: str) -> List[Tuple[float, int]]:
+        """(score, position) of every message sharing a term with query, best first"""
+        with self._connect() as connection:
+            count, total_length = connection.execute(
+                "SELECT messages, length FROM totals"
+            ).fetchone()
+            if not count:
+                return []
+            average_length = total_length / count or 1
+
+            scores: Dict[int, float] = defaultdict(float)
+            for term in terms(query):
+                postings = connection.execute(
+                    "SELECT p.n, p.tf, m.length, m.tokens FROM postings p"
+                    " JOIN messages m ON m.n = p.n WHERE p.term = ?",
+                    (term,),
+                ).fetchall()
+                if not postings:
+                    continue
+                idf = math.log(
+                    1 + (count - len(postings) + 0.5) / (len(postings) + 0.5)
+                )
+                for n, frequency, length, tokens in postings:
+                    length_norm = 1 - B + B * length / average_length
+                    scores[n] += (
+                        idf * frequency * (K1 + 1) / (frequency + K1 * length_norm)
+                    )
+                    self.tokens[n] = tokens
+
+        return sorted(((score, n) for n, score in scores.items()), reverse=True)
+
+
+def _insert(connection: sqlite3.Connection, messages: Dict[int, Dict[str, Any]]):
+    added = 0
+    added_length = 0
+    for n, message in messages.items():
+        frequencies = terms(message["content"])
+        length = sum(frequencies.values())
+        tokens = message.get("tokens") or estimate_tokens(len(encode(message)))
+        inserted = connection.execute(
+            "INSERT OR IGNORE INTO messages VALUES (?, ?, ?)", (n, tokens, length)
+        ).rowcount
+        if inserted:
+            connection.executemany(
+                "INSERT INTO postings VALUES (?, ?, ?)",
+                [(term, n, count) for term, count in frequencies.items()],
+            )
+            added += 1
+            added_length += length
+    connection.execute(
+        "UPDATE totals SET messages = messages + ?, length = length + ?",
+        (added, added_length),
+    )
+
+
+def _delete(connection: sqlite3.Connection, base: int, end: int):
+    outside = "n < ? OR n >= ?"
+    removed, removed_length = connection.execute(
+        f"SELECT count(*), coalesce(sum(length), 0) FROM messages WHERE {outside}",
+        (base, end),
+    ).fetchone()
+    connection.execute(f"DELETE FROM postings WHERE {outside}", (base, end))
+    connection.execute(f"DELETE FROM messages WHERE {outside}", (base, end))
+    connection.execute(
+        "UPDATE totals SET messages = messages - ?, length = length - ?",
+        (removed, removed_length),
+    )
+
+
+def context(
+    history: History,
+    prompt: Dict[str, Any],
+    budget: int,
+    tokens: Callable[[Dict[str, Any]], int],
+) -> List[Dict[str, Any]]:
+    """
+    The earlier messages most relevant to prompt followed by the most recent ones and
+    prompt, in conversation order, within budget tokens
+    """
+    recent_budget = int(budget * RECENT_SHARE)
+    total = tokens(prompt)
+    recent = []
+    for message in reversed(history.load(recent_budget)):
+        if total + tokens(message) > recent_budget:
+            break
+        total += tokens(message)
+        recent.append(message)
+    recent.reverse()
+
+    base = history.base()
+    first_recent = base + len(history) - len(recent)
+    index = TermIndex(history).load()
+
+    remaining = budget - total
+    selected = []
+    for _, n in index.rank(prompt["content"]):
+        if n < first_recent and index.tokens[n] <= remaining:
+            selected.append(n)
+            remaining -= index.tokens[n]
+
+    # Read the selected messages a run of consecutive positions at a time
+    earlier = []
+    selected.sort()
+    while selected:
+        run = 1
+        while run < len(selected) and selected[run] == selected[0] + run:
+            run += 1
+        earlier += history.read(selected[0] - base, selected[0] - base + run)
+        selected = selected[run:]
+
+    return earlier + recent + [prompt]
@@ -0,0 +1,138 @@
+import re
+from typing import Awaitable, Callable, List, Optional
+
+from skainet import batch, perf, tokenizer
+
+# Off unless asked for, an instruction like "sort the lines" or "add the imports" needs
+# the whole input at once
+DEFAULT_SECTION_SIZE = 0
+
+# An instruction that only renames or replaces one literal, e.g. "Rename `load_all`
+# to fetch_all" or "replace 'colour' with 'color'", with nothing else asked for
+_WORD = r"`[^`]+`|\"[^\"]+\"|'[^']+'|[^\s`\"']+"
+_REPLACE = re.compile(
+    rf"(?:rename|replace)\s+(?:(?:all|every)\s+)?(?:(?:occurrences|uses)\s+of\s+)?"
+    rf"(?P<old>{_WORD})\s+(?:to|with|by)\s+(?:{_WORD})\s*\.?",
+    re.IGNORECASE,
+)
+# Words that can only be code: snake_case, camelCase, dotted.names and calls()
+_CODE_WORD = re.compile(r"\w*(?:_\w|[a-z][A-Z])\w*|\w+(?:\.\w+)+|\w+\(\)")
+
+
+def _indent(line: str) -> int:
+    return len(line) - len(line.lstrip())
+
+
+def _blocks(lines: List[str], indent: int) -> List[List[str]]:
+    # Runs of lines split before a line indented at most indent that follows a
+    # blank line, paragraphs of prose or top level blocks of code
+    blocks = [[]]
+    for i, line in enumerate(lines):
+        if (
+            i
+            and line.strip()
+            and not lines[i - 1].strip()
+            and _indent(line) <= indent
+            and blocks[-1]
+        ):
+            blocks.append([])
+        blocks[-1].append(line)
+    return blocks
+
+
+def split(text: str, size: int) -> List[str]:
+    """
+    text split into sections of about size tokens, which join back into text
+
+    Sections end at blank lines before paragraphs or top level blocks, so each can
+    be edited on its own. A block larger than size is split at blank lines within
+    it, one that is still too large is kept whole.
+    """
+    lines = text.splitlines(keepends=True)
+    indent = min((_indent(line) for line in lines if line.strip()), default=0)
+    blocks = []
+    for block in _blocks(lines, indent):
+        if tokenizer.count("".join(block)) > size:
+            nested = max((_indent(line) for line in block if line.strip()), default=0)
+            blocks += _blocks(block, nested)
+        else:
+            blocks.append(block)
+
+    # Neighbouring small blocks share a section
+    sections: List[str] = []
+    total = 0
+    for block in blocks:
+        block_text = "".join(block)
+        tokens = tokenizer.count(block_text)
+        if sections and total + tokens <= size:
+            sections[-1] += block_text
+            total += tokens
+        else:
+            sections.append(block_text)
+            total = tokens
+    return sections or [text]
+
+
+def replaced(instruction: str) -> Optional[str]:
+    """
+    The text instruction replaces, if all it asks for is one rename or replacement
+
+    None for any other instruction, which may affect any section. Words in those,
+    e.g. the snake_case in "convert all names to snake_case", describe the change
+    rather than text it must be made in.
+    """
+    match = _REPLACE.fullmatch(instruction.strip())
+    if not match:
+        return None
+    old = match.group("old")
+    if old[0] in "`\"'":
+        return old[1:-1]
+    # An unquoted plain word, as in "rename variables to snake_case", may be a kind
+    # of thing rather than the text to replace
+    return old if _CODE_WORD.fullmatch(old) else None
+
+
+def affected(section: str, old: Optional[str]) -> bool:
+    """False only if section provably can't be affected by replacing old"""
+    if not section.strip():
+        return False
+    # Case insensitive, a rename may be asked for in other words than the code uses
+    return old is None or old.lower() in section.lower()
+
+
+def _keep_ending(original: str, edited: str) -> str:
+    # Sections are joined as they were split, whatever line breaks the edit ends with
+    ending = original[len(original.rstrip()) :]
+    return edited.rstrip() + ending
+
+
+async def edit(
+    request: Callable[[str], Awaitable[str]],
+    text: str,
+    instruction: str,
+    size: int,
+    concurrency: int,
+) -> str:
+    """
+    Edit text a section at a time, concurrency sections at once
+
+    request sends one section and returns its edit. Sections a rename or replace
+    instruction can't affect are kept as they are, the rest are edited and joined in
+    order, so a large input takes about as long as its largest section.
+    """
+    sections = split(text, size)
+    if len(sections) == 1:
+        return await request(text)
+
+    old = replaced(instruction)
+
+    async def edit_section(section: str) -> str:
+        if not affected(section, old):
+            perf.incr("sections_skipped")
+            return section
+        perf.incr("sections_edited")
+        return _keep_ending(section, await request(section))
+
+    return "".join(
+        [edited async for _, edited in batch.run(edit_section, sections, concurrency)]
+    )
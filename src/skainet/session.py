@@ -0,0 +1,138 @@
+import json
+import re
+import sys
+import time
+from typing import Any, Dict, List
+
+import click
+
+from skainet import data
+from skainet.history import History
+
+DEFAULT_SESSION = "default"
+SESSIONS_DIR = data.DATA_DIR / "sessions"
+
+# name -> {"messages": int, "tokens": int, "last_used": float}
+# Small enough to rewrite on every turn, so listing sessions never has to open
+# their histories
+_INDEX_FILE = data.DATA_DIR / "sessions.json"
+_INDEX_LOCK = data.DATA_DIR / "sessions.json.lock"
+
+_NAME_PATTERN = re.compile(r"[A-Za-z0-9_][A-Za-z0-9_.-]*")
+
+
+class SessionName(click.ParamType):
+    name = "session"
+
+    def convert(self, value, param, ctx):
+        if not _NAME_PATTERN.fullmatch(value):
+            self.fail(
+                f"{value!r} is not a valid session name, use letters, numbers, '.', '_' and '-'",
+                param,
+                ctx,
+            )
+        return value
+
+
+def history(name: str) -> History:
+    if name == DEFAULT_SESSION:
+        return data.chat_history()
+    return History(SESSIONS_DIR / f"{name}.jsonl")
+
+
+def load_index() -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(_INDEX_FILE) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _update_index(name: str, entry: Dict[str, Any]):
+    with data.file_lock(_INDEX_LOCK):
+        index = load_index()
+        if entry:
+            index[name] = entry
+        else:
+            index.pop(name, None)
+        data.atomic_write(_INDEX_FILE, json.dumps(index, indent=2))
+
+
+def record_turn(name: str, messages: List[Dict[str, Any]], compacted: bool = False):
+    """Update a session's metadata after messages were appended to its history"""
+    session_history = history(name)
+    # Read and written under one lock, or concurrent turns lose each other's tokens
+    with data.file_lock(_INDEX_LOCK):
+        index = load_index()
+        entry = index.get(name)
+        if entry is None or compacted:
+            tokens = session_history.token_total()
+        else:
+            tokens = entry["tokens"] + sum(m.get("tokens", 0) for m in messages)
+
+        index[name] = {
+            "messages": len(session_history),
+            "tokens": tokens,
+            "last_used": time.time(),
+        }
+        data.atomic_write(_INDEX_FILE, json.dumps(index, indent=2))
+
+
+def record_clear(name: str):
+    _update_index(name, {"messages": 0, "tokens": 0, "last_used": time.time()})
+
+
+@click.group(help="Manage chat sessions")
+def session():
+    pass
+
+
+@session.command()
+def list():
+    """List chat sessions, most recently used first"""
+    index = load_index()
+
+    # The default session's history may predate the session index
+    default_history = history(DEFAULT_SESSION)
+    if DEFAULT_SESSION not in index and len(default_history):
+        index[DEFAULT_SESSION] = {
+            "messages": len(default_history),
+            "tokens": default_history.token_total(),
+            "last_used": default_history.path.stat().st_mtime,
+        }
+
+    if not index:
+        click.echo("No sessions")
+        return
+
+    entries = sorted(index.items(), key=lambda item: -item[1]["last_used"])
+    width = max(len(name) for name, _ in entries)
+    for name, entry in entries:
+        last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_used"]))
+        click.echo(
+            f"{name:<{width}}  {entry['messages']:>6} messages  {entry['tokens']:>8} tokens  {last_used}"
+        )
+
+
+@session.command()
+@click.argument("name", type=SessionName())
+def show(name: str):
+    """Show the messages in a session"""
+    if name not in load_index() and not len(history(name)):
+        click.echo(f"No session with name '{name}' found.", err=True)
+        sys.exit(1)
+
+    for message in history(name).load():
+        click.echo(f"{message['role']}: {message['content']}")
+
+
+@session.command()
+@click.argument("name", type=SessionName())
+def rm(name: str):
+    """Delete a session and its history"""
+    if name not in load_index() and not len(history(name)):
+        click.echo(f"No session with name '{name}' found.", err=True)
+        sys.exit(1)
+
+    history(name).remove()
+    _update_index(name, {})
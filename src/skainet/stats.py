@@ -0,0 +1,289 @@
+import asyncio
+import json
+import math
+import os
+import re
+import struct
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import click
+
+from skainet import data
+
+_STATS_FILE = data.DATA_DIR / "stats.bin"
+# The file is moved here once it outgrows max_size, replacing the one before
+_OLD_STATS_FILE = data.DATA_DIR / "stats.1.bin"
+_STATS_LOCK = data.DATA_DIR / "stats.lock"
+
+DEFAULT_MAX_SIZE = 8  # MB, per file
+
+# time, total, ttfb and ttft seconds (ttft is -1 if nothing was streamed), prompt
+# and completion tokens, retries, failed, then the lengths of the endpoint and model
+# names that follow the record
+_RECORD = struct.Struct("<dfffIIHBBB")
+
+PERCENTILES = (50, 95, 99)
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)([smhdw])")
+_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+
+
+def _settings() -> Tuple[bool, int]:
+    config = data.load_config()
+    enabled = config.getboolean("stats", "enabled", fallback=True)
+    max_size = config.getfloat("stats", "max_size", fallback=DEFAULT_MAX_SIZE)
+    return enabled, int(max_size * 1024 * 1024)
+
+
+def _append(entry: bytes, max_size: int):
+    try:
+        fd = os.open(_STATS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    except FileNotFoundError:
+        data.make_data_dir()
+        fd = os.open(_STATS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        # One write per record, so records from concurrent processes don't interleave
+        os.write(fd, entry)
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+    if size > max_size:
+        with data.file_lock(_STATS_LOCK):
+            if _STATS_FILE.exists() and _STATS_FILE.stat().st_size > max_size:
+                os.replace(_STATS_FILE, _OLD_STATS_FILE)
+
+
+def record(
+    endpoint: str,
+    model: str,
+    total: float,
+    ttfb: float,
+    ttft: Optional[float],
+    prompt_tokens: int,
+    completion_tokens: int,
+    retries: int,
+    failed: bool,
+):
+    """Append a call to the stats file, unless stats are disabled in the config"""
+    enabled, max_size = _settings()
+    if not enabled:
+        return
+
+    endpoint_name = endpoint.encode()[:255]
+    model_name = model.encode()[:255]
+    entry = _RECORD.pack(
+        time.time(),
+        total,
+        ttfb,
+        -1.0 if ttft is None else ttft,
+        min(prompt_tokens, 2**32 - 1),
+        min(completion_tokens, 2**32 - 1),
+        min(retries, 2**16 - 1),
+        failed,
+        len(endpoint_name),
+        len(model_name),
+    )
+    try:
+        _append(entry + endpoint_name + model_name, max_size)
+    except OSError:
+        pass  # stats are never worth failing a call over
+
+
+class Call:
+    """
+    Timings and token usage of one API call, recorded once it finishes
+
+    Created before the first attempt. The API module counts retries, marks the
+    response and stream chunks as they arrive, then finishes the call.
+    """
+
+    def __init__(self, function: Callable, kwargs: Dict[str, Any]):
+        self.start = time.perf_counter()
+        name = function.__name__
+        if asyncio.iscoroutinefunction(function) and name.startswith("a"):
+            name = name[1:]  # acreate is timed as create
+        resource = getattr(getattr(function, "__self__", None), "OBJECT_NAME", None)
+        self.endpoint = f"{resource}.{name}" if resource else name
+        self.model = kwargs.get("model") or ""
+        self.ttfb = 0.0
+        self.ttft: Optional[float] = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+
+    def responded(self, response: Any):
+        if not self.ttfb:  # a resumed stream keeps the first response's time
+            self.ttfb = time.perf_counter() - self.start
+        usage = response.get("usage") if isinstance(response, dict) else None
+        if usage:
+            self.prompt_tokens = usage.get("prompt_tokens") or 0
+            self.completion_tokens = usage.get("completion_tokens") or 0
+
+    def chunk(self, chunk: Dict[str, Any]):
+        # Streams don't report usage, each chunk carries about one token per choice
+        for choice in chunk.get("choices", []):
+            if choice.get("text") or (choice.get("delta") or {}).get("content"):
+                if self.ttft is None:
+                    self.ttft = time.perf_counter() - self.start
+                self.completion_tokens += 1
+
+    def finish(self, failed: bool = False):
+        record(
+            self.endpoint,
+            self.model,
+            time.perf_counter() - self.start,
+            self.ttfb,
+            self.ttft,
+            self.prompt_tokens,
+            self.completion_tokens,
+            self.retries,
+            failed,
+        )
+
+
+def read(since: float = 0.0) -> Iterator[Dict[str, Any]]:
+    """Calls recorded at or after since, oldest first"""
+    for path in (_OLD_STATS_FILE, _STATS_FILE):
+        try:
+            content = path.read_bytes()
+        except FileNotFoundError:
+            continue
+
+        offset = 0
+        while offset + _RECORD.size <= len(content):
+            fields = _RECORD.unpack_from(content, offset)
+            endpoint_start = offset + _RECORD.size
+            model_start = endpoint_start + fields[8]
+            offset = model_start + fields[9]
+            if offset > len(content):
+                break  # still being written
+            if fields[0] < since:
+                continue
+            yield {
+                "time": fields[0],
+                "total": fields[1],
+                "ttfb": fields[2],
+                "ttft": None if fields[3] < 0 else fields[3],
+                "prompt_tokens": fields[4],
+                "completion_tokens": fields[5],
+                "retries": fields[6],
+                "failed": bool(fields[7]),
+                "endpoint": content[endpoint_start:model_start].decode(),
+                "model": content[model_start:offset].decode(),
+            }
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(calls: Iterator[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Counts, token totals and latency percentiles per model and endpoint"""
+    groups: Dict[Tuple[str, str], List[Dict[str, Any]]] = defaultdict(list)
+    for call in calls:
+        groups[call["model"], call["endpoint"]].append(call)
+
+    rows = []
+    for (model, endpoint), group in sorted(groups.items()):
+        row = {
+            "model": model,
+            "endpoint": endpoint,
+            "calls": len(group),
+            "failed": sum(call["failed"] for call in group),
+            "retries": sum(call["retries"] for call in group),
+            "prompt_tokens": sum(call["prompt_tokens"] for call in group),
+            "completion_tokens": sum(call["completion_tokens"] for call in group),
+        }
+        for metric in ("total", "ttfb", "ttft"):
+            values = sorted(call[metric] for call in group if call[metric] is not None)
+            for p in PERCENTILES:
+                row[f"{metric}_p{p}"] = percentile(values, p)
+        rows.append(row)
+    return rows
+
+
+class Duration(click.ParamType):
+    """A time window like 90s, 30m, 12h, 7d or 2w, in seconds"""
+
+    name = "duration"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, (int, float)):
+            return float(value)
+        match = _DURATION.fullmatch(value.strip().lower())
+        if not match:
+            self.fail(f"{value!r} is not a duration like 30m, 12h or 7d", param, ctx)
+        return float(match.group(1)) * _UNITS[match.group(2)]
+
+
+def _seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.2f}"
+
+
+@click.command(context_settings={"show_default": True})
+@click.option(
+    "-s",
+    "--since",
+    type=Duration(),
+    default="1d",
+    help="Only calls made in this window, e.g. 30m, 12h or 7d",
+)
+@click.option("-m", "--model", help="Only calls to this model")
+@click.option(
+    "-e", "--endpoint", help="Only calls to this endpoint, e.g. completions.create"
+)
+@click.option("--json", "as_json", is_flag=True, help="Output as JSON")
+def stats(since: float, model: Optional[str], endpoint: Optional[str], as_json: bool):
+    """Latency and token usage of API calls
+
+    Show latency percentiles (total, time to first byte and time to first token, in
+    seconds), retries and token usage per model and endpoint. Streamed completion
+    tokens are counted from the chunks received.
+    """
+    calls = (
+        call
+        for call in read(time.time() - since)
+        if (model is None or call["model"] == model)
+        and (endpoint is None or call["endpoint"] == endpoint)
+    )
+    rows = summarize(calls)
+
+    if as_json:
+        click.echo(json.dumps(rows, indent=2))
+        return
+    if not rows:
+        click.echo("No calls recorded")
+        return
+
+    headers = ["model", "endpoint", "calls", "failed", "retries"]
+    headers += [f"p{p}" for p in PERCENTILES] + ["ttfb p50", "ttft p50", "tokens"]
+    table = [headers]
+    for row in rows:
+        table.append(
+            [
+                row["model"] or "-",
+                row["endpoint"],
+                str(row["calls"]),
+                str(row["failed"]),
+                str(row["retries"]),
+                *(_seconds(row[f"total_p{p}"]) for p in PERCENTILES),
+                _seconds(row["ttfb_p50"]),
+                _seconds(row["ttft_p50"]),
+                f"{row['prompt_tokens']}+{row['completion_tokens']}",
+            ]
+        )
+
+    widths = [max(len(line[i]) for line in table) for i in range(len(headers))]
+    for line in table:
+        click.echo(
+            "  ".join(
+                cell.ljust(width) if i < 2 else cell.rjust(width)
+                for i, (cell, width) in enumerate(zip(line, widths))
+            ).rstrip()
+        )
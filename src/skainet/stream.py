@@ -0,0 +1,137 @@
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, TextIO
+
+import click
+
+from skainet import perf
+
+# Buffered text is written once it reaches this many characters
+FLUSH_SIZE = 8192
+
+# On a terminal, text is also written at every newline and whenever this long has
+# passed since the last write
+FLUSH_INTERVAL = 0.05
+
+
+class StreamWriter:
+    """
+    Collects streamed deltas and writes them in as few calls as possible
+
+    A terminal is written to at newlines, every FLUSH_INTERVAL seconds or FLUSH_SIZE
+    characters, so text still appears as it arrives. A pipe or file is only written
+    to every FLUSH_SIZE characters and when the writer is closed. The interval is
+    checked as deltas arrive, a pause in the stream leaves at most one interval's
+    worth of text waiting for the next delta.
+    """
+
+    def __init__(
+        self,
+        file: Optional[TextIO] = None,
+        interactive: Optional[bool] = None,
+        flush_size: int = FLUSH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+    ):
+        self.file = file if file is not None else click.get_text_stream("stdout")
+        self.interactive = self.file.isatty() if interactive is None else interactive
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buffer: List[str] = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+
+    def write(self, text: str):
+        if not text:
+            return
+        self._buffer.append(text)
+        self._size += len(text)
+
+        if self._size >= self.flush_size:
+            self.flush()
+        elif self.interactive and (
+            "\n" in text or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            start = time.perf_counter()
+            click.echo("".join(self._buffer), file=self.file, nl=False)
+            perf.add("output_write", time.perf_counter() - start)
+            perf.incr("output_writes")
+            self._buffer.clear()
+            self._size = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self) -> "StreamWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ChoiceWriter:
+    """
+    Writes several choices of one response while they stream in
+
+    Every complete line is written as soon as it arrives, prefixed with the index of
+    its choice, so the choices are interleaved line by line. With an output
+    directory each choice is written to its own file instead. Partial lines are
+    collected in lists and joined once, rather than concatenated delta by delta.
+    """
+
+    def __init__(
+        self, file: Optional[TextIO] = None, output_dir: Optional[Path] = None
+    ):
+        self.output_dir = output_dir
+        self.output = StreamWriter(file)
+        self._line: Dict[int, List[str]] = {}
+        self._files: Dict[int, StreamWriter] = {}
+
+    def path(self, index: int) -> Path:
+        return self.output_dir / f"choice-{index}.txt"
+
+    def write(self, index: int, text: str):
+        if not text:
+            return
+
+        if self.output_dir is not None:
+            if index not in self._files:
+                self.output_dir.mkdir(parents=True, exist_ok=True)
+                file = open(self.path(index), "w", encoding="utf-8")
+                # Written line by line, so the files can be followed as they grow
+                self._files[index] = StreamWriter(file, interactive=True)
+            self._files[index].write(text)
+            return
+
+        line = self._line.setdefault(index, [])
+        if "\n" not in text:
+            line.append(text)
+            return
+
+        head, _, tail = text.rpartition("\n")
+        lines = "".join(line + [head]).split("\n")
+        self.output.write("".join(f"({index}) {complete}\n" for complete in lines))
+        self._line[index] = [tail] if tail else []
+
+    def close(self):
+        for index in sorted(self._line):
+            if self._line[index]:
+                self.output.write(f"({index}) {''.join(self._line[index])}\n")
+        self._line.clear()
+
+        for index in sorted(self._files):
+            self._files[index].close()
+            self._files[index].file.close()
+            self.output.write(f"({index}) {self.path(index)}\n")
+        self._files.clear()
+        self.output.close()
+
+    def __enter__(self) -> "ChoiceWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
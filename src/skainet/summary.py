@@ -0,0 +1,139 @@
+import json
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import click
+import openai
+
+from skainet import api, data, perf
+from skainet.history import History
+
+# Context reserved for the summary message, a little of it goes to the heading and
+# message format around the summary itself
+SUMMARY_TOKENS = 256
+_SUMMARY_OVERHEAD = 16
+
+# Most tokens of dropped messages folded into the summary at once, when a summary
+# is started on a long history only its most recent messages are summarized
+SUMMARY_INPUT_TOKENS = 3000
+
+SUMMARY_PROMPT = (
+    "You keep a running summary of a conversation between a user and an assistant. "
+    "Update the summary with the new messages, keeping names, facts, decisions and "
+    "open questions. Reply with the updated summary only, in under 150 words."
+)
+
+
+def load(history: History) -> Dict[str, Any]:
+    """
+    The session's summary: its content and the position of the first message it
+    doesn't cover, counted over the whole conversation
+    """
+    try:
+        with open(history.summary_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {"content": "", "covered": 0}
+
+
+def save(history: History, state: Dict[str, Any]):
+    data.atomic_write(history.summary_path, json.dumps(state, ensure_ascii=False))
+
+
+def message(state: Dict[str, Any]) -> Optional[Dict[str, str]]:
+    if not state["content"]:
+        return None
+    return {
+        "role": "system",
+        "content": f"Summary of the earlier conversation:\n{state['content']}",
+    }
+
+
+def summarize(model: str, content: str, messages: List[Dict[str, Any]]) -> str:
+    """Fold messages into the summary content"""
+    transcript = "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    response = api.call(
+        openai.ChatCompletion.create,
+        model=model,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {
+                "role": "user",
+                "content": f"Summary so far:\n{content or '(none)'}\n\nNew messages:\n{transcript}",
+            },
+        ],
+        temperature=0,
+        max_tokens=SUMMARY_TOKENS - _SUMMARY_OVERHEAD,
+    )
+    return response["choices"][0]["message"]["content"].strip()
+
+
+def context(
+    history: History,
+    prompt: Dict[str, Any],
+    budget: int,
+    model: str,
+    tokens: Callable[[Dict[str, Any]], int],
+) -> Tuple[Optional[Dict[str, str]], List[Dict[str, Any]]]:
+    """
+    Summary message and the messages after it that fit in budget, ending with prompt
+
+    The context is the summary followed by every message it doesn't cover. Once
+    those outgrow the budget, the oldest are folded into the summary until they fill
+    half of it, so a summary request is made every few turns rather than on each
+    one. The summary is saved with the session and reused until the next fold.
+    """
+    budget -= SUMMARY_TOKENS
+    state = load(history)
+    base = history.base()
+    count = len(history)
+
+    messages = history.load(budget)
+    start = base + count - len(messages)
+    if state["covered"] > start:
+        messages = messages[state["covered"] - start :]
+        start = state["covered"]
+    messages.append(prompt)
+
+    total = sum(tokens(m) for m in messages)
+    if total < budget and start <= state["covered"]:
+        return message(state), messages
+
+    # Messages between the summary and the window, those that didn't fit in the
+    # budget, are folded first
+    folded = []
+    if start > state["covered"]:
+        gap = history.read(max(state["covered"], base) - base, start - base)
+        gap_tokens = 0
+        for gap_message in reversed(gap):
+            gap_tokens += tokens(gap_message)
+            if gap_tokens > SUMMARY_INPUT_TOKENS:
+                break
+            folded.append(gap_message)
+        folded.reverse()
+
+    while len(messages) > 1 and total > budget // 2:
+        total -= tokens(messages[0])
+        folded.append(messages.pop(0))
+        start += 1
+
+    if not folded:
+        return message(state), messages
+
+    summary_start = time.perf_counter()
+    try:
+        content = summarize(model, state["content"], folded)
+    except openai.OpenAIError as e:
+        click.echo(
+            click.style(
+                f"Warning: could not update the chat summary ({e}), older messages were dropped",
+                fg="yellow",
+            ),
+            err=True,
+        )
+        return message(state), messages
+    perf.record("summary", time.perf_counter() - summary_start)
+
+    state = {"content": content, "covered": start}
+    save(history, state)
+    return message(state), messages
@@ -1,34 +1,85 @@
+import asyncio
+import difflib
 import functools
+import json
+import stat
 import sys
-from typing import Dict, List
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 
 import click
 import openai
 
-from skainet import utils
-from skainet.data import CONFIG, load_chat, save_chat
+from skainet import (
+    aio,
+    api,
+    batch,
+    cache,
+    chunked,
+    data,
+    perf,
+    relevance,
+    sections,
+    session,
+    stream,
+    summary,
+    tokenizer,
+    utils,
+)
+from skainet.data import CONFIG
+
+# Tokens the chat format adds around every message
+MESSAGE_TOKENS = 4
 
 
 def calculate_tokens(string: str) -> int:
-    return len(string.split())
+    return tokenizer.count(string)
+
+
+# Keys message_tokens stores on messages, which the API doesn't accept
+_BOOKKEEPING_KEYS = ("tokens", "tokenizer")
+
 
+def message_tokens(message: Dict[str, Any]) -> int:
+    """Token count of a message, stored on the message so it's saved with the history"""
+    if "tokens" not in message or message.get("tokenizer") != tokenizer.name():
+        message["tokens"] = calculate_tokens(message["content"]) + MESSAGE_TOKENS
+        message["tokenizer"] = tokenizer.name()
+    return message["tokens"]
 
-def calculate_context(message_list: List[Dict[str, str]]):
-    return sum([calculate_tokens(msg["content"]) for msg in message_list])
+
+def calculate_context(message_list: List[Dict[str, Any]]):
+    return sum(message_tokens(msg) for msg in message_list)
 
 
 def truncate_context(
-    message_list: List[Dict[str, str]], context_limit: int
-) -> List[Dict[str, str]]:
-    context = []
-    for message in reversed(message_list):
-        new_tokens = calculate_tokens(message["content"])
-        if calculate_context(context) + new_tokens < context_limit:
-            context.insert(0, message)
-        else:
-            break
+    message_list: List[Dict[str, Any]], context_limit: int
+) -> List[Dict[str, Any]]:
+    """Most recent messages that fit within context_limit tokens"""
+    total = 0
+    for start in range(len(message_list) - 1, -1, -1):
+        total += message_tokens(message_list[start])
+        if total >= context_limit:
+            return message_list[start + 1 :]
+
+    return list(message_list)
+
+
+def request_messages(message_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Strip the bookkeeping saved with the history, the API rejects unknown keys"""
+    return [
+        {key: value for key, value in message.items() if key not in _BOOKKEEPING_KEYS}
+        for message in message_list
+    ]
 
-    return context
+
+def write(text: str, **kwargs):
+    """click.echo, timed for the profiling report"""
+    start = time.perf_counter()
+    click.echo(text, **kwargs)
+    perf.add("output_write", time.perf_counter() - start)
 
 
 def text_options(model, num, temp):
@@ -68,22 +119,34 @@ SYSTEM_MESSAGE = {
     "role": "system",
     "content": CONFIG["chat"]["seed_prompt"],
 }
-SYSTEM_MESSAGE_LEN = calculate_tokens(SYSTEM_MESSAGE["content"])
 DEFAULT_CHAT_CONTEXT = int(CONFIG["chat"]["context"])
 DEFAULT_CHAT_MODEL = CONFIG["chat"]["model"]
 DEFAULT_CHAT_TEMPERATURE = int(CONFIG["chat"]["temperature"])
 DEFAULT_CHAT_MAX_TOKENS = int(CONFIG["chat"]["max_tokens"])
 DEFAULT_CHAT_NUM = int(CONFIG["chat"]["num"])
+CHAT_HISTORY_SIZE = CONFIG.getint("chat", "history_size", fallback=1000)
+DEFAULT_CHAT_SUMMARIZE = CONFIG.getboolean("chat", "summarize", fallback=False)
+DEFAULT_CHAT_RELEVANT = CONFIG.getboolean("chat", "relevant", fallback=False)
+
+
+def validate_context(ctx: click.Context, param: click.Parameter, value: int) -> int:
+    # Checked here rather than with IntRange, so the tokenizer is only loaded when
+    # chat actually runs
+    maximum = MAXIMUM_CONTEXT - message_tokens(SYSTEM_MESSAGE)
+    if value > maximum:
+        raise click.BadParameter(f"{value} is larger than the maximum of {maximum}")
+    return value
 
 
 @click.command(context_settings={"show_default": True})
-@click.argument("prompt", type=utils.Prompt(), default="")
+@click.argument("prompt", type=utils.Prompt(max_tokens=MAXIMUM_CONTEXT), default="")
 @text_options(DEFAULT_CHAT_MODEL, DEFAULT_CHAT_NUM, DEFAULT_CHAT_TEMPERATURE)
 @click.option(
     "-c",
     "--context",
-    type=click.IntRange(min=1, max=MAXIMUM_CONTEXT - SYSTEM_MESSAGE_LEN),
+    type=click.IntRange(min=1),
     default=DEFAULT_CHAT_CONTEXT,
+    callback=validate_context,
     help=f"Context length, for chat",
 )
 @click.option("-ch", "--clearhistory", is_flag=True, help="Clear entire chat history")
@@ -103,6 +166,34 @@ DEFAULT_CHAT_NUM = int(CONFIG["chat"]["num"])
 )
 @click.option("-ns", "--no-stream", is_flag=True, help=f"Disable response streaming")
 @click.option("-nu", "--no-update", is_flag=True, help=f"Do not update chat history")
+@click.option(
+    "-S",
+    "--session",
+    "session_name",
+    type=session.SessionName(),
+    default=session.DEFAULT_SESSION,
+    envvar="SKAI_SESSION",
+    help="Named chat session to continue, each session has its own history",
+)
+@click.option(
+    "--summarize/--no-summarize",
+    default=DEFAULT_CHAT_SUMMARIZE,
+    help="Keep a running summary of messages that no longer fit in the context, instead of dropping them",
+)
+@click.option(
+    "--relevant/--recent",
+    default=DEFAULT_CHAT_RELEVANT,
+    help="Fill half the context with the earlier messages most relevant to the prompt, instead of only the most recent",
+)
+@click.option(
+    "-od",
+    "--output-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="With --num > 1, write each choice to its own file in this directory",
+)
+@batch.batch_options
+@chunked.chunked_options
+@cache.cache_option
 def chat(
     prompt: str,
     model: str,
@@ -114,15 +205,71 @@ def chat(
     stop: int,
     no_stream: bool,
     no_update: bool,
+    session_name: str,
+    batch_file,
+    concurrency: int,
+    completion_order: bool,
+    chunked: bool,
+    chunk_size: int,
+    chunk_overlap: int,
+    use_cache: bool,
+    output_dir: Optional[Path],
+    summarize: bool,
+    relevant: bool,
 ):
     """Chat with ChatGPT
 
     Send PROMPT to ChatGPT. PROMPT can be a string, filepath, or piped in.
     If no PROMPT is given, Skai will open $EDITOR or your configured text editor.
+
+    With --batch, every prompt in the file is sent on its own, without the chat
+    history, and the results are written as JSON lines.
+
+    With --chunked, PROMPT is answered for each chunk of the piped input, without
+    the chat history, and the answers are combined into one.
     """
+    check_modes(batch_file, chunked, num)
+    if chunked:
+        parameters = {
+            "model": model,
+            "temperature": temp,
+            "stop": stop or None,
+            "max_tokens": None if maxtokens < 0 else maxtokens,
+        }
+
+        async def request(content: str) -> str:
+            messages = [SYSTEM_MESSAGE, {"role": "user", "content": content}]
+            response = await cache.acreate(
+                openai.ChatCompletion,
+                use_cache,
+                messages=request_messages(messages),
+                **parameters,
+            )
+            return response["choices"][0]["message"]["content"]
+
+        run_chunked(request, prompt, chunk_size, chunk_overlap, concurrency)
+        return
+
+    if batch_file is not None:
+        chat_batch(
+            batch_file,
+            concurrency,
+            not completion_order,
+            use_cache,
+            model=model,
+            n=num,
+            temperature=temp,
+            stop=stop or None,
+            max_tokens=None if maxtokens < 0 else maxtokens,
+        )
+        return
+
+    build_start = time.perf_counter()
+    history = session.history(session_name)
 
     if clearhistory is True:
-        save_chat([])
+        history.clear()
+        session.record_clear(session_name)
 
     if maxtokens < 0:
         maxtokens = None
@@ -130,29 +277,51 @@ def chat(
     if not stop:
         stop = None
 
-    # Load chat history and append new prompt
-    chat_history = load_chat()
+    # Load the end of the chat history and append new prompt
+    available_context = context - message_tokens(SYSTEM_MESSAGE)
     new_prompt = {"role": "user", "content": prompt}
-    chat_history.append(new_prompt)
-
-    # Limit chat context & instert seed prompt
-    available_context = context - SYSTEM_MESSAGE_LEN
-    current_context = truncate_context(chat_history, available_context)
-    if current_context != chat_history:
-        click.echo(
-            click.style(
-                "Warning: your chat history has been truncated to fit the context limit",
-                fg="yellow",
-            ),
-            err=True,
+    if summarize and relevant:
+        raise click.UsageError("--summarize and --relevant can't be used together")
+
+    if summarize:
+        # Older messages are kept as a running summary instead of being dropped
+        summary_message, current_context = summary.context(
+            history, new_prompt, available_context, model, message_tokens
+        )
+        if summary_message is not None:
+            current_context.insert(0, summary_message)
+    elif relevant:
+        # Earlier messages that match the prompt are kept along with the latest
+        current_context = relevance.context(
+            history, new_prompt, available_context, message_tokens
         )
+    else:
+        chat_history = history.load(available_context)
+        chat_history.append(new_prompt)
+
+        # Limit chat context
+        current_context = truncate_context(chat_history, available_context)
+        if len(current_context) < len(history) + 1:
+            click.echo(
+                click.style(
+                    "Warning: your chat history has been truncated to fit the context limit",
+                    fg="yellow",
+                ),
+                err=True,
+            )
+
+    # Insert seed prompt
     current_context.insert(0, SYSTEM_MESSAGE)
+    perf.record("request_build", time.perf_counter() - build_start)
 
     # Send request
+    request_start = time.perf_counter()
     try:
-        response = openai.ChatCompletion.create(
+        response = cache.create(
+            openai.ChatCompletion,
+            use_cache,
             model=model,
-            messages=current_context,
+            messages=request_messages(current_context),
             temperature=temp,
             # top_p=args.top_p,
             n=num,
@@ -166,53 +335,176 @@ def chat(
     except openai.OpenAIError as e:
         utils.handle_openai_error(e)
     else:
+        perf.record("ttfb", time.perf_counter() - request_start)
         if num > 1:
-            if no_stream:
-                for index, choice in enumerate(response["choices"]):
-                    content = choice["message"]["content"]
-                    click.echo(f"({index}) {content}")
-            else:
-                messages = {}
-                for chunk in response:
-                    for choice in chunk["choices"]:
-                        index = choice["index"]
-                        if index not in messages:
-                            messages[index] = ""
-
-                        delta = choice["delta"]
-                        if "content" in delta:
-                            content = delta["content"]
-                            messages[index] += content
-
-                for index in range(len(messages)):
-                    click.echo(f"({index}) {messages[index]}")
+            with stream.ChoiceWriter(output_dir=output_dir) as output:
+                if no_stream:
+                    for choice in response["choices"]:
+                        output.write(choice["index"], choice["message"]["content"])
+                else:
+                    first_token = True
+                    for chunk in response:
+                        for choice in chunk["choices"]:
+                            content = choice["delta"].get("content")
+                            if content and first_token:
+                                perf.record("ttft", time.perf_counter() - request_start)
+                                first_token = False
+                            output.write(choice["index"], content)
+            if not no_stream:
+                perf.record("stream", time.perf_counter() - request_start)
         else:
             if no_stream:
                 new_response = response["choices"][0]["message"]
-                click.echo(new_response["content"])
+                write(new_response["content"])
             else:
                 new_response = {"role": "", "content": ""}
-                for chunk in response:
-                    # Parse response chunk
-                    choice = chunk["choices"][0]
-                    delta = choice["delta"]
-                    if "role" in delta:
-                        new_response["role"] = delta["role"]
-                        text = ""
-                    elif "content" in delta:
-                        new_response["content"] += delta["content"]
-                        text = delta["content"]
-                    elif not delta:
-                        text = "\n"
-                    else:
-                        text = ""
-
-                    click.echo(text, nl=False)
+                with stream.StreamWriter() as output:
+                    for chunk in response:
+                        # Parse response chunk
+                        choice = chunk["choices"][0]
+                        delta = choice["delta"]
+                        if "role" in delta:
+                            new_response["role"] = delta["role"]
+                            text = ""
+                        elif "content" in delta:
+                            if not new_response["content"]:
+                                perf.record("ttft", time.perf_counter() - request_start)
+                            new_response["content"] += delta["content"]
+                            text = delta["content"]
+                        elif not delta:
+                            text = "\n"
+                        else:
+                            text = ""
+
+                        output.write(text)
+                perf.record("stream", time.perf_counter() - request_start)
 
             if not no_update:
-                chat_history.append(new_response)
-                chat_history = truncate_context(chat_history, MAXIMUM_CONTEXT)
-                save_chat(chat_history)
+                message_tokens(new_response)
+                history.append([new_prompt, new_response])
+                if relevant:
+                    position = history.base() + len(history) - 2
+                    relevance.TermIndex(history).add(
+                        {position: new_prompt, position + 1: new_response}
+                    )
+                compacted = history.compact(CHAT_HISTORY_SIZE)
+                session.record_turn(session_name, [new_prompt, new_response], compacted)
+
+
+def check_modes(batch_file, chunked: bool, num: int):
+    if chunked and batch_file is not None:
+        raise click.UsageError("--chunked can't be used with --batch")
+    if chunked and num > 1:
+        raise click.UsageError("--chunked can't be used with --num")
+
+
+def run_chunked(
+    request: Callable[[str], Awaitable[str]],
+    prompt: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    concurrency: int,
+):
+    """Map-reduce the piped input with request and write the answer"""
+    if sys.stdin.isatty():
+        raise click.UsageError("--chunked needs input piped to skai")
+    if not prompt:
+        raise click.UsageError("--chunked needs a PROMPT to answer for the input")
+    if chunk_overlap * 2 > chunk_size:
+        # Each chunk would move on by only a few tokens, a request for every few
+        raise click.UsageError("--chunk-overlap can be at most half of --chunk-size")
+
+    try:
+        answer = aio.run(
+            chunked.run(
+                request, prompt, sys.stdin, chunk_size, chunk_overlap, concurrency
+            )
+        )
+    except openai.OpenAIError as e:
+        utils.handle_openai_error(e)
+    else:
+        write(answer)
+
+
+def chat_batch(
+    batch_file, concurrency: int, ordered: bool, use_cache: bool, **parameters
+):
+    """
+    Send each prompt in batch_file as a separate chat request
+
+    Lines are a prompt, or an object with a "prompt" or "messages" and an optional
+    "id" that is copied to its result. Failed requests are reported in their result
+    and make skai exit with 1 once every prompt has run.
+    """
+
+    async def send(item: Dict[str, Any]) -> Dict[str, Any]:
+        result = {"id": item["id"]} if "id" in item else {}
+        if "messages" in item:
+            messages = item["messages"]
+            if not _valid_messages(messages):
+                result["error"] = {
+                    "type": "InvalidItem",
+                    "message": "messages must be objects with a role and content",
+                }
+                return result
+        elif isinstance(item.get("prompt"), str):
+            messages = [SYSTEM_MESSAGE, {"role": "user", "content": item["prompt"]}]
+        else:
+            result["error"] = {
+                "type": "InvalidItem",
+                "message": "no prompt or messages",
+            }
+            return result
+
+        try:
+            response = await cache.acreate(
+                openai.ChatCompletion,
+                use_cache,
+                messages=request_messages(messages),
+                **parameters,
+            )
+        except openai.OpenAIError as e:
+            result["error"] = batch.error_result(e)
+        else:
+            result["choices"] = [
+                choice["message"]["content"] for choice in response["choices"]
+            ]
+        return result
+
+    items = batch.read_items(batch_file)
+    write_results(batch.run(send, items, concurrency, ordered))
+
+
+def _valid_messages(messages: Any) -> bool:
+    return (
+        isinstance(messages, list)
+        and bool(messages)
+        and all(
+            isinstance(message, dict)
+            and isinstance(message.get("role"), str)
+            and isinstance(message.get("content"), str)
+            for message in messages
+        )
+    )
+
+
+def write_results(results: AsyncIterator[Tuple[int, Dict[str, Any]]]):
+    """Write (index, result) pairs as JSON lines, exit with 1 if any result failed"""
+
+    async def write_all() -> bool:
+        failed = False
+        async for index, result in results:
+            failed = failed or "error" in result
+            write(json.dumps({"index": index, **result}, ensure_ascii=False))
+            perf.incr("batch_items")
+        return failed
+
+    start = time.perf_counter()
+    failed = aio.run(write_all())
+    perf.record("batch", time.perf_counter() - start)
+
+    if failed:
+        sys.exit(1)
 
 
 DEFAULT_COMPLETE_MODEL = CONFIG["completion"]["model"]
@@ -223,7 +515,7 @@ DEFAULT_COMPLETE_NUM = int(CONFIG["completion"]["num"])
 
 
 @click.command(context_settings={"show_default": True})
-@click.argument("prompt", type=utils.Prompt(), default="")
+@click.argument("prompt", type=utils.Prompt(max_tokens=MAXIMUM_CONTEXT), default="")
 @text_options(
     DEFAULT_COMPLETE_MODEL, DEFAULT_COMPLETE_NUM, DEFAULT_COMPLETE_TEMPERATURE
 )
@@ -252,6 +544,15 @@ DEFAULT_COMPLETE_NUM = int(CONFIG["completion"]["num"])
 @click.option(
     "--echo", is_flag=True, help=f"Echo back the prompt in addition to the completion"
 )
+@click.option(
+    "-od",
+    "--output-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="With --num > 1, write each choice to its own file in this directory",
+)
+@batch.batch_options
+@chunked.chunked_options
+@cache.cache_option
 def complete(
     prompt: str,
     model: str,
@@ -262,12 +563,28 @@ def complete(
     echo: bool,
     stop: List[str],
     no_stream: bool,
+    use_cache: bool,
+    output_dir: Optional[Path],
+    batch_file,
+    concurrency: int,
+    completion_order: bool,
+    chunked: bool,
+    chunk_size: int,
+    chunk_overlap: int,
 ):
     """Text Completion
 
     Return a completion for a given prompt. PROMPT can be a string, filepath, or piped in.
     If no PROMPT is given, Skai will open $EDITOR or your configured text editor.
+
+    With --batch, consecutive prompts in the file are packed into shared requests
+    and the results are written as JSON lines.
+
+    With --chunked, PROMPT is answered for each chunk of the piped input and the
+    answers are combined into one.
     """
+    check_modes(batch_file, chunked, num)
+    build_start = time.perf_counter()
 
     if maxtokens < 0:
         maxtokens = None
@@ -278,9 +595,46 @@ def complete(
     if not stop:
         stop = None
 
+    if batch_file is not None:
+        complete_batch(
+            batch_file,
+            concurrency,
+            not completion_order,
+            use_cache,
+            model=model,
+            suffix=suffix,
+            max_tokens=maxtokens,
+            temperature=temp,
+            n=num,
+            echo=echo,
+            stop=stop,
+        )
+        return
+
+    if chunked:
+
+        async def request(content: str) -> str:
+            response = await cache.acreate(
+                openai.Completion,
+                use_cache,
+                model=model,
+                prompt=content,
+                max_tokens=maxtokens,
+                temperature=temp,
+                stop=stop,
+            )
+            return response["choices"][0]["text"]
+
+        run_chunked(request, prompt, chunk_size, chunk_overlap, concurrency)
+        return
+    perf.record("request_build", time.perf_counter() - build_start)
+
     # Send request
+    request_start = time.perf_counter()
     try:
-        response = openai.Completion.create(
+        response = cache.create(
+            openai.Completion,
+            use_cache,
             model=model,
             prompt=prompt,
             suffix=suffix,
@@ -300,32 +654,107 @@ def complete(
     except openai.OpenAIError as e:
         utils.handle_openai_error(e)
     else:
+        perf.record("ttfb", time.perf_counter() - request_start)
         if num > 1:
-            if no_stream:
-                for index, choice in enumerate(response["choices"]):
-                    text = choice["text"]
-                    click.echo(f"({index}) {text}")
-            else:
-                messages = {}
-                for chunk in response:
-                    for choice in chunk["choices"]:
-                        index = choice["index"]
-                        if index not in messages:
-                            messages[index] = ""
-
-                        text = choice["text"]
-                        messages[index] += text
-
-                for index, text in messages.items():
-                    click.echo(f"({index}) {text}")
+            with stream.ChoiceWriter(output_dir=output_dir) as output:
+                if no_stream:
+                    for choice in response["choices"]:
+                        output.write(choice["index"], choice["text"])
+                else:
+                    first_token = True
+                    for chunk in response:
+                        for choice in chunk["choices"]:
+                            text = choice["text"]
+                            if text and first_token:
+                                perf.record("ttft", time.perf_counter() - request_start)
+                                first_token = False
+                            output.write(choice["index"], text)
+            if not no_stream:
+                perf.record("stream", time.perf_counter() - request_start)
         else:
             if no_stream:
                 text = response["choices"][0]["text"]
-                click.echo(text, nl=False)
+                write(text, nl=False)
+            else:
+                first_token = True
+                with stream.StreamWriter() as output:
+                    for chunk in response:
+                        text = chunk["choices"][0]["text"]
+                        if text and first_token:
+                            perf.record("ttft", time.perf_counter() - request_start)
+                            first_token = False
+                        output.write(text)
+                perf.record("stream", time.perf_counter() - request_start)
+
+
+# Most prompts the API accepts in one completion request, and the most tokens packed
+# into one, counting every prompt and the completions asked for it
+BATCH_PROMPTS = 20
+BATCH_TOKENS = 8000
+
+
+def complete_batch(
+    batch_file, concurrency: int, ordered: bool, use_cache: bool, **parameters
+):
+    """
+    Send the prompts in batch_file as completion requests of up to BATCH_PROMPTS
+
+    Lines are a prompt, or an object with a "prompt" and an optional "id" that is
+    copied to its result. The choices of a request are matched back to its prompts
+    by index. A failed request is reported in the result of each of its prompts,
+    and makes skai exit with 1 once every prompt has run.
+    """
+    num = parameters["n"]
+    completion_tokens = (
+        parameters["max_tokens"] or api.DEFAULT_COMPLETION_TOKENS
+    ) * num
+
+    def cost(item: Dict[str, Any]) -> int:
+        prompt = item.get("prompt")
+        if not isinstance(prompt, str):
+            return 0
+        return tokenizer.count(prompt) + completion_tokens
+
+    async def send(group: List[Tuple[int, Dict[str, Any]]]):
+        results = []
+        prompts = []
+        sent = []
+        for index, item in group:
+            result = {"id": item["id"]} if "id" in item else {}
+            if isinstance(item.get("prompt"), str):
+                prompts.append(item["prompt"])
+                sent.append(result)
             else:
-                for chunk in response:
-                    text = chunk["choices"][0]["text"]
-                    click.echo(text, nl=False)
+                result["error"] = {"type": "InvalidItem", "message": "no prompt"}
+            results.append((index, result))
+        if not prompts:
+            return results
+
+        try:
+            response = await cache.acreate(
+                openai.Completion, use_cache, prompt=prompts, **parameters
+            )
+        except openai.OpenAIError as e:
+            for result in sent:
+                result["error"] = batch.error_result(e)
+        else:
+            # Choice i * n + j is the jth completion of the ith prompt
+            for result in sent:
+                result["choices"] = []
+            for choice in sorted(response["choices"], key=lambda c: c["index"]):
+                sent[choice["index"] // num]["choices"].append(choice["text"])
+        perf.incr("batch_requests")
+        return results
+
+    async def results():
+        groups = batch.pack(
+            batch.read_items(batch_file), BATCH_PROMPTS, BATCH_TOKENS, cost
+        )
+        async for _, group_results in batch.run(send, groups, concurrency, ordered):
+            for result in group_results:
+                yield result
+
+    write_results(results())
 
 
 DEFAULT_EDIT_MODEL = CONFIG["edit"]["model"]
@@ -333,20 +762,277 @@ DEFAULT_EDIT_TEMPERATURE = int(CONFIG["edit"]["temperature"])
 DEFAULT_EDIT_NUM = int(CONFIG["edit"]["num"])
 
 
+def edit_output_path(output_dir: Path, path: Path) -> Path:
+    # Relative paths keep their directories, anything else is written by name
+    if path.is_absolute() or ".." in path.parts:
+        return output_dir / path.name
+    return output_dir / path
+
+
+def unified_diff(path: Path, original: str, edited: str) -> str:
+    lines = difflib.unified_diff(
+        original.splitlines(keepends=True),
+        edited.splitlines(keepends=True),
+        f"a/{path.as_posix()}",
+        f"b/{path.as_posix()}",
+    )
+    return "".join(
+        line if line.endswith("\n") else line + "\n\\ No newline at end of file\n"
+        for line in lines
+    )
+
+
+async def edit_text(
+    text: str,
+    instruction: str,
+    section_size: int,
+    concurrency: int,
+    use_cache: Optional[bool],
+    limit: Optional[asyncio.Semaphore] = None,
+    **parameters,
+) -> str:
+    """
+    The edit of text, made a section at a time if it's over section_size tokens
+
+    At most concurrency requests are sent at once, or as many as limit allows when
+    it's shared with other edits.
+    """
+    if limit is None:
+        limit = asyncio.Semaphore(concurrency)
+
+    async def request(input: str) -> str:
+        async with limit:
+            response = await cache.acreate(
+                openai.Edit,
+                use_cache,
+                input=input,
+                instruction=instruction,
+                **parameters,
+            )
+        return response["choices"][0]["text"]
+
+    # A text no longer in characters than the limit is within it in tokens
+    if not section_size or len(text) <= section_size:
+        return await request(text)
+    return await sections.edit(request, text, instruction, section_size, concurrency)
+
+
+def write_edited(source: Path, target: Path, text: str):
+    """
+    Write the edit of source to target, with source's permissions
+
+    text is written as UTF-8 with its line endings as they are, as it was read.
+    """
+    mode = stat.S_IMODE(source.stat().st_mode)
+    data.atomic_write(target, text.encode("utf-8"))
+    target.chmod(mode)
+
+
+def edit_files(
+    instruction: str,
+    paths: List[Path],
+    concurrency: int,
+    use_cache: Optional[bool],
+    in_place: bool,
+    output_dir: Optional[Path],
+    section_size: int,
+    **parameters,
+):
+    """
+    Apply instruction to every file in paths, several at once
+
+    Each result is written back in place, to output_dir or otherwise as a unified
+    diff on stdout, in the order the files were given. The time each file took is
+    reported on stderr. A file that failed makes skai exit with 1 once every file
+    is done.
+    """
+
+    async def send(path: Path, limit: asyncio.Semaphore) -> Dict[str, Any]:
+        start = time.perf_counter()
+        result: Dict[str, Any] = {}
+        try:
+            # Line endings are kept as they are, for in place edits and diffs
+            with open(path, encoding="utf-8", newline="") as file:
+                result["original"] = file.read()
+            result["edited"] = await edit_text(
+                result["original"],
+                instruction,
+                section_size,
+                concurrency,
+                use_cache,
+                limit,
+                **parameters,
+            )
+        except (OSError, UnicodeDecodeError, openai.OpenAIError) as e:
+            result["error"] = e
+        result["seconds"] = time.perf_counter() - start
+        return result
+
+    async def edit_all() -> bool:
+        failed = False
+        # Shared by the files and their sections, so -j bounds the requests in flight
+        limit = asyncio.Semaphore(concurrency)
+        results = batch.run(lambda path: send(path, limit), paths, concurrency)
+        async for index, result in results:
+            path = paths[index]
+            perf.incr("edit_files")
+            if "error" in result:
+                failed = True
+                status = f"{result['error'].__class__.__name__}: {result['error']}"
+            elif result["edited"] == result["original"]:
+                status = "unchanged"
+            else:
+                status = "edited"
+
+            if "edited" in result:
+                if in_place:
+                    if status == "edited":
+                        write_edited(path, path, result["edited"])
+                elif output_dir is not None:
+                    target = edit_output_path(output_dir, path)
+                    write_edited(path, target, result["edited"])
+                else:
+                    write(
+                        unified_diff(path, result["original"], result["edited"]),
+                        nl=False,
+                    )
+            click.echo(f"{path}: {status} ({result['seconds']:.2f}s)", err=True)
+        return failed
+
+    start = time.perf_counter()
+    failed = aio.run(edit_all())
+    perf.record("edit_files", time.perf_counter() - start)
+
+    if failed:
+        sys.exit(1)
+
+
 @click.command(context_settings={"show_default": True})
 @click.argument("instruction", type=str)
-@click.argument("input", type=utils.Prompt(), default="")
+@click.argument("inputs", metavar="[INPUT]...", nargs=-1)
 @text_options(DEFAULT_EDIT_MODEL, DEFAULT_EDIT_NUM, DEFAULT_EDIT_TEMPERATURE)
-def edit(instruction: str, input: str, model: str, temp: float, num: int):
+@click.option(
+    "-i",
+    "--in-place",
+    is_flag=True,
+    help="Edit every INPUT file in place",
+)
+@click.option(
+    "-od",
+    "--output-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="Write the edit of every INPUT file to this directory",
+)
+@click.option(
+    "-d",
+    "--diff",
+    is_flag=True,
+    help="Print the edits of every INPUT file as a unified diff",
+)
+@click.option(
+    "-j",
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=batch.DEFAULT_CONCURRENCY,
+    help="Number of files, or sections of a file, to edit at once",
+)
+@click.option(
+    "-ss",
+    "--section-size",
+    type=click.IntRange(min=0),
+    default=sections.DEFAULT_SECTION_SIZE,
+    help="Edit inputs longer than this many tokens a section at a time, for inputs too large for one request. 0 sends them whole",
+)
+@cache.cache_option
+def edit(
+    instruction: str,
+    inputs: Tuple[str, ...],
+    model: str,
+    temp: float,
+    num: int,
+    in_place: bool,
+    output_dir: Optional[Path],
+    diff: bool,
+    concurrency: int,
+    section_size: int,
+    use_cache: bool,
+):
     """Text editing
 
     Edit a given input according to the instruction. INPUT a string, filepath, or piped in.
     If no INPUT is given, Skai will open $EDITOR or your configured text editor.
+
+    With --in-place, --output-dir or --diff every INPUT is a file, and the files are
+    edited several at once. Files are edited through the response cache unless
+    --no-cache is given, so unchanged files aren't sent again.
+
+    With --section-size, long inputs are split into sections at blank lines before
+    paragraphs or top level blocks. The sections are edited at the same time,
+    skipping those without any quoted or code-like words the instruction names. Each
+    section is edited on its own, so don't use it for instructions that need the
+    whole input, like sorting or adding imports.
     """
+    modes = in_place + (output_dir is not None) + diff
+    if modes > 1:
+        raise click.UsageError("Use only one of --in-place, --output-dir and --diff")
+    if modes:
+        if not inputs:
+            raise click.UsageError("No files to edit")
+        if num > 1:
+            raise click.UsageError("--num can't be used when editing files")
+        if output_dir is not None:
+            targets = Counter(
+                edit_output_path(output_dir, Path(input)) for input in inputs
+            )
+            duplicates = [str(target) for target, count in targets.items() if count > 1]
+            if duplicates:
+                raise click.UsageError(
+                    f"More than one file would be written to {', '.join(duplicates)}"
+                )
+        edit_files(
+            instruction,
+            [Path(input) for input in inputs],
+            concurrency,
+            True if use_cache is None else use_cache,
+            in_place,
+            output_dir,
+            section_size,
+            model=model,
+            temperature=temp,
+        )
+        return
+    if len(inputs) > 1:
+        raise click.UsageError(
+            "Editing several files needs --in-place, --output-dir or --diff"
+        )
+    input = utils.Prompt().convert(
+        inputs[0] if inputs else "", None, click.get_current_context()
+    )
+
+    # Long inputs are edited a section at a time
+    if num == 1 and section_size and len(input) > section_size:
+        try:
+            text = aio.run(
+                edit_text(
+                    input,
+                    instruction,
+                    section_size,
+                    concurrency,
+                    use_cache,
+                    model=model,
+                    temperature=temp,
+                )
+            )
+        except openai.OpenAIError as e:
+            utils.handle_openai_error(e)
+        click.echo(text)
+        return
 
     # Send request
     try:
-        response = openai.Edit.create(
+        response = cache.create(
+            openai.Edit,
+            use_cache,
             model=model,
             input=input,
             instruction=instruction,
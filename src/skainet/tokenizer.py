@@ -0,0 +1,195 @@
+import base64
+import functools
+import hashlib
+import http.client
+import marshal
+import math
+import re
+import time
+import urllib.request
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from skainet import data, perf
+
+# Byte pair encoding used by the chat models
+ENCODING = "cl100k_base"
+ENCODING_URL = (
+    f"https://openaipublic.blob.core.windows.net/encodings/{ENCODING}.tiktoken"
+)
+# sha256 of the vocabulary file, as published with tiktoken
+ENCODING_SHA256 = "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7"
+DOWNLOAD_TIMEOUT = 5
+DOWNLOAD_RETRY_SECONDS = 24 * 60 * 60
+
+# Pieces longer than this are merged in windows, byte pair merging is quadratic
+MAX_PIECE_BYTES = 512
+
+_ENCODING_FILE = data.DATA_DIR / f"{ENCODING}.tiktoken"
+_RANKS_CACHE = data.DATA_DIR / f"{ENCODING}.marshal"
+_DOWNLOAD_FAILED = data.DATA_DIR / f"{ENCODING}.failed"
+
+try:
+    import regex
+
+    _PATTERN = regex.compile(
+        r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+    )
+except ImportError:
+    # Closest the standard library gets to the pattern above, [^\W\d_] is \p{L}
+    _PATTERN = re.compile(
+        r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|(?:[^\r\n\w]|_)?[^\W\d_]+|\d{1,3}| ?(?:[^\s\w]|_)+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _tiktoken_encoding():
+    """tiktoken's encoder, if it's installed (Python 3.8+)"""
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(ENCODING)
+    except Exception:
+        return None
+
+
+def _download() -> Optional[bytes]:
+    if _DOWNLOAD_FAILED.exists():
+        if time.time() - _DOWNLOAD_FAILED.stat().st_mtime < DOWNLOAD_RETRY_SECONDS:
+            return None
+
+    try:
+        with urllib.request.urlopen(ENCODING_URL, timeout=DOWNLOAD_TIMEOUT) as response:
+            content = response.read()
+    except (OSError, http.client.HTTPException):
+        content = None
+
+    # A proxy or captive portal page is as good as no download
+    if content is None or hashlib.sha256(content).hexdigest() != ENCODING_SHA256:
+        data.make_data_dir()
+        _DOWNLOAD_FAILED.touch()
+        return None
+
+    data.atomic_write(_ENCODING_FILE, content)
+    return content
+
+
+def _vocabulary() -> Optional[bytes]:
+    """The encoding file, downloaded if it's missing or doesn't match its hash"""
+    try:
+        content = _ENCODING_FILE.read_bytes()
+    except FileNotFoundError:
+        return _download()
+
+    if hashlib.sha256(content).hexdigest() == ENCODING_SHA256:
+        return content
+    # Saved before downloads were checked, or damaged since
+    try:
+        _ENCODING_FILE.unlink()
+    except OSError:
+        pass
+    return _download()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_ranks() -> Optional[Dict[bytes, int]]:
+    """
+    Merge ranks of the encoding, downloaded on first use
+
+    The parsed table is kept as a marshal snapshot, which loads far faster than
+    decoding the original file. Without a vocabulary counts are estimated.
+    """
+    with perf.timer("tokenizer_load"):
+        try:
+            return marshal.loads(_RANKS_CACHE.read_bytes())
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+        content = _vocabulary()
+        if content is None:
+            return None
+
+        ranks = {}
+        for line in content.splitlines():
+            if line:
+                token, rank = line.split()
+                ranks[base64.b64decode(token)] = int(rank)
+
+        data.atomic_write(_RANKS_CACHE, marshal.dumps(ranks))
+        return ranks
+
+
+def name() -> str:
+    """Name of the tokenizer in use, counts from different tokenizers don't mix"""
+    if _tiktoken_encoding() is not None or _load_ranks() is not None:
+        return ENCODING
+    return "estimate"
+
+
+def _byte_pair_merge(piece: bytes, ranks: Dict[bytes, int]) -> List[bytes]:
+    parts = [piece[i : i + 1] for i in range(len(piece))]
+    while len(parts) > 1:
+        min_rank = None
+        min_index = 0
+        for i in range(len(parts) - 1):
+            rank = ranks.get(parts[i] + parts[i + 1])
+            if rank is not None and (min_rank is None or rank < min_rank):
+                min_rank = rank
+                min_index = i
+
+        if min_rank is None:
+            break
+        parts[min_index : min_index + 2] = [parts[min_index] + parts[min_index + 1]]
+
+    return parts
+
+
+@functools.lru_cache(maxsize=65536)
+def _count_piece(piece: str) -> int:
+    encoded = piece.encode()
+    ranks = _load_ranks()
+    if ranks is None:
+        # No vocabulary available, roughly 4 bytes per token
+        return max(1, math.ceil(len(encoded) / 4))
+
+    if encoded in ranks:
+        return 1
+
+    return sum(
+        len(_byte_pair_merge(encoded[i : i + MAX_PIECE_BYTES], ranks))
+        for i in range(0, len(encoded), MAX_PIECE_BYTES)
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def count(text: str) -> int:
+    """Number of tokens in text"""
+    encoding = _tiktoken_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    return sum(_count_piece(piece) for piece in _PATTERN.findall(text))
+
+
+def pieces(text: str) -> Iterator[Tuple[str, int]]:
+    """
+    text split where tokens can end, with the number of tokens in each piece
+
+    Tokens never span pieces, so joining whole pieces never splits a token.
+    """
+    encoding = _tiktoken_encoding()
+    for piece in _PATTERN.findall(text):
+        if encoding is not None:
+            yield piece, len(encoding.encode(piece, disallowed_special=()))
+        else:
+            yield piece, _count_piece(piece)
+
+
+def stream_pieces(blocks: Iterable[str]) -> Iterator[Tuple[str, int]]:
+    """pieces of the text made up of blocks, split a block at a time"""
+    carry = ""
+    for block in blocks:
+        split = list(pieces(carry + block))
+        # The last piece may continue in the next block
+        carry = split.pop()[0] if split else ""
+        yield from split
+    yield from pieces(carry)
@@ -1,17 +1,25 @@
-import functools
+import codecs
+import io
+import mmap
 import os
+import stat
 import subprocess
 import sys
 import tempfile
 import uuid
 from pathlib import Path
-from typing import Any, Callable, List, Optional
+from typing import Any, BinaryIO, Callable, Iterator, List, Optional, TextIO, Tuple
 
 import click
 import openai
 
+from skainet import connection
+from skainet.daemon import TerminalRequired
 from skainet.data import CONFIG
 
+# Cleared by the daemon, which has no terminal to open an editor in
+INTERACTIVE = True
+
 
 def create_tempfile(ext: str) -> Path:
     temp_file = Path(tempfile.gettempdir()) / str(uuid.uuid4())
@@ -47,16 +55,139 @@ class File(click.File):
         return file
 
 
+# Bytes of a prompt file or piped prompt read at a time
+READ_SIZE = 64 * 1024
+
+
+def _byte_blocks(file: BinaryIO) -> Iterator[bytes]:
+    # Regular files are mapped rather than read, pipes are read a block at a time
+    mapped = None
+    try:
+        if stat.S_ISREG(os.fstat(file.fileno()).st_mode):
+            start = file.tell()
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        pass  # empty files can't be mapped, in-memory streams have no file
+
+    if mapped is None:
+        yield from iter(lambda: file.read(READ_SIZE), b"")
+        return
+
+    with mapped:
+        for offset in range(start, len(mapped), READ_SIZE):
+            yield mapped[offset : offset + READ_SIZE]
+
+
+def _text_blocks(file: BinaryIO, encoding: str) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for block in _byte_blocks(file):
+        yield decoder.decode(block)
+    yield decoder.decode(b"", final=True)
+
+
+def read_text(
+    file: BinaryIO, encoding: str = "utf-8", max_tokens: Optional[int] = None
+) -> Tuple[str, bool]:
+    """
+    Text of file, decoded as it's read, and whether it was cut short
+
+    With max_tokens, reading stops once the text reaches that many tokens, so no
+    more of a huge input is read than could be sent.
+    """
+    blocks = _text_blocks(file, encoding)
+    if max_tokens is None:
+        return "".join(blocks), False
+
+    from skainet import tokenizer
+
+    text = []
+    tokens = 0
+    for piece, count in tokenizer.stream_pieces(blocks):
+        tokens += count
+        if tokens > max_tokens:
+            return "".join(text), True
+        text.append(piece)
+    return "".join(text), False
+
+
+def _may_block(file: TextIO) -> bool:
+    # Terminals and pipes wait for their writer, files and in-memory input don't
+    try:
+        return not stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return False
+
+
 class Prompt(click.ParamType):
+    """
+    A prompt given as text, a file path or - for stdin, followed by any piped input
+
+    Files and stdin are decoded as they're read. With max_tokens, reading stops
+    once the prompt reaches that many tokens, the most the command can send. While
+    waiting for the editor or a pipe, the API connection is opened in the background.
+    """
+
     name = "prompt"
 
+    def __init__(self, max_tokens: Optional[int] = None):
+        self.max_tokens = max_tokens
+
+    def _remaining(self, text: str) -> Optional[int]:
+        if self.max_tokens is None:
+            return None
+        if not text:
+            return self.max_tokens
+
+        from skainet import tokenizer
+
+        return max(0, self.max_tokens - tokenizer.count(text))
+
     def convert(self, value: str, param, ctx):
-        if not sys.stdin.isatty():
+        if ctx is not None and (
+            ctx.meta.get("skainet.batch") or ctx.meta.get("skainet.chunked")
+        ):
+            # Stdin is the batch file or the input to split, not part of the prompt
+            return value
+
+        cut = False
+        read_stdin = value == "-" or not sys.stdin.isatty()
+        if read_stdin and _may_block(sys.stdin):
+            connection.prewarm()
+
+        if value == "-":
+            value = ""
+        elif value and "\n" not in value and os.path.isfile(value):
+            try:
+                with open(value, "rb") as file:
+                    value, cut = read_text(file, max_tokens=self._remaining(""))
+            except UnicodeDecodeError:
+                self.fail(f"{value} is not a UTF-8 text file", param, ctx)
+
+        if read_stdin and not cut:
             if value:
                 value = value + "\n"
-            value += sys.stdin.read()
+            stdin, cut = self._read_stdin(self._remaining(value))
+            value += stdin
+
+        if cut:
+            click.echo(
+                click.style(
+                    f"Warning: the prompt was cut to {self.max_tokens} tokens, the most that can be sent",
+                    fg="yellow",
+                ),
+                err=True,
+            )
 
         if not value:
+            if not INTERACTIVE:
+                raise TerminalRequired()
+            connection.prewarm()
             value = click.edit()
 
         return value
+
+    def _read_stdin(self, max_tokens: Optional[int]) -> Tuple[str, bool]:
+        buffer = getattr(sys.stdin, "buffer", None)
+        if buffer is None:
+            return sys.stdin.read(), False
+        return read_text(buffer, sys.stdin.encoding or "utf-8", max_tokens)
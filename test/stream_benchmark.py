@@ -0,0 +1,77 @@
+"""
+Write syscalls and time per streamed response, echo per delta vs StreamWriter
+
+    python test/stream_benchmark.py [deltas]
+"""
+import io
+import sys
+import time
+
+import click
+
+from skainet.stream import StreamWriter
+
+WORDS = "the quick brown fox jumps over the lazy dog".split()
+
+
+class CountingRaw(io.RawIOBase):
+    """Stands in for the stdout file descriptor, counting write syscalls"""
+
+    def __init__(self):
+        self.writes = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.writes += 1
+        return len(b)
+
+
+def deltas(count: int):
+    # Deltas the size of a token, with a line break every dozen
+    return [(" " if i % 12 else "\n") + WORDS[i % len(WORDS)] for i in range(count)]
+
+
+def stdout():
+    raw = CountingRaw()
+    return raw, io.TextIOWrapper(io.BufferedWriter(raw), encoding="utf-8")
+
+
+def echo_per_delta(response):
+    raw, file = stdout()
+    for text in response:
+        click.echo(text, file=file, nl=False)
+    return raw.writes
+
+
+def stream_writer(response, interactive: bool):
+    raw, file = stdout()
+    with StreamWriter(file, interactive=interactive) as output:
+        for text in response:
+            output.write(text)
+    file.flush()
+    return raw.writes
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    response = deltas(count)
+    runs = 200
+    cases = [
+        ("click.echo per delta", lambda: echo_per_delta(response)),
+        ("StreamWriter, terminal", lambda: stream_writer(response, True)),
+        ("StreamWriter, pipe", lambda: stream_writer(response, False)),
+    ]
+
+    print(f"{count} deltas per response, {runs} responses")
+    for name, case in cases:
+        start = time.perf_counter()
+        for _ in range(runs):
+            writes = case()
+        elapsed = (time.perf_counter() - start) / runs
+        print(f"{name:<24} {writes:>6} writes  {elapsed * 1e6:>8.0f} us/response")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""
+Time to truncate a chat history to the context, before and after its messages are
+counted
+
+    python test/truncate_benchmark.py [messages]
+"""
+import sys
+import time
+
+from skainet import text
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    history = [{"role": "user", "content": f"message number {i}"} for i in range(count)]
+    limit = text.DEFAULT_CHAT_CONTEXT
+
+    print(f"{count} messages, truncated to {limit} tokens")
+    for name in ("cold", "warm"):
+        start = time.perf_counter()
+        text.truncate_context(history, limit)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<6} {elapsed * 1e3:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
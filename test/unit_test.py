@@ -0,0 +1,1919 @@
+import asyncio
+import contextlib
+import http.client
+import io
+import json
+import os
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+import time
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import click
+import openai
+import pytest
+from click.testing import CliRunner
+
+from skainet import aio
+from skainet import api as api_module
+from skainet import batch, cache, chunked, connection
+from skainet import daemon as daemon_module
+from skainet import (
+    data,
+    perf,
+    ratelimit,
+    relevance,
+    sections,
+    session,
+    stats,
+    stream,
+    summary,
+    text,
+    tokenizer,
+    utils,
+)
+from skainet.__main__ import COMMANDS, main
+from skainet.history import History
+
+
+@pytest.fixture
+def runner():
+    return CliRunner()
+
+
+@pytest.fixture(autouse=True)
+def offline_tokenizer(monkeypatch: pytest.MonkeyPatch):
+    """Count tokens with the built in estimate, without downloading a vocabulary"""
+    monkeypatch.setattr(tokenizer, "_tiktoken_encoding", lambda: None)
+    monkeypatch.setattr(tokenizer, "_load_ranks", lambda: None)
+    tokenizer.count.cache_clear()
+    tokenizer._count_piece.cache_clear()
+    yield
+    tokenizer.count.cache_clear()
+    tokenizer._count_piece.cache_clear()
+
+
+@pytest.fixture
+def skai_env(tmp_path: Path):
+    """Environment for running skai in a subprocess against an empty home directory"""
+    env = dict(os.environ)
+    env["HOME"] = str(tmp_path)
+    env["LOCALAPPDATA"] = str(tmp_path)
+    env["OPENAI_API_KEY"] = "sk-test"
+    return env
+
+
+@pytest.fixture
+def data_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """Point skainet.data at an empty data directory"""
+    data_dir = tmp_path / "skainet"
+    monkeypatch.setattr(data, "DATA_DIR", data_dir)
+    monkeypatch.setattr(data, "_KEY_FILE", data_dir / "api_key")
+    monkeypatch.setattr(data, "_CHAT_FILE", data_dir / "chat_history.jsonl")
+    monkeypatch.setattr(data, "_LEGACY_CHAT_FILE", data_dir / "chat_history.json")
+    monkeypatch.setattr(data, "_CONFIG_FILE", data_dir / "config.ini")
+    monkeypatch.setattr(data, "_CONFIG_CACHE", data_dir / "config.cache.json")
+    monkeypatch.setattr(data, "_config", None)
+    monkeypatch.setattr(data, "_config_stamp", None)
+    monkeypatch.setattr(session, "SESSIONS_DIR", data_dir / "sessions")
+    monkeypatch.setattr(session, "_INDEX_FILE", data_dir / "sessions.json")
+    monkeypatch.setattr(session, "_INDEX_LOCK", data_dir / "sessions.json.lock")
+    monkeypatch.setattr(cache, "CACHE_DIR", data_dir / "cache")
+    monkeypatch.setattr(cache, "_size", None)
+    monkeypatch.setattr(ratelimit, "_STATE_FILE", data_dir / "ratelimit.json")
+    monkeypatch.setattr(ratelimit, "_STATE_LOCK", data_dir / "ratelimit.lock")
+    monkeypatch.setattr(stats, "_STATS_FILE", data_dir / "stats.bin")
+    monkeypatch.setattr(stats, "_OLD_STATS_FILE", data_dir / "stats.1.bin")
+    monkeypatch.setattr(stats, "_STATS_LOCK", data_dir / "stats.lock")
+    return data_dir
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the OpenAI API, answers every prompt with RESPONSE"""
+
+    protocol_version = "HTTP/1.1"
+
+    RESPONSE = ["Hel", "lo", " world"]
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, body: dict):
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def write_chunk(self, payload: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(payload), payload))
+        self.wfile.flush()
+
+    def send_stream(self, chunks: list):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, chunk in enumerate(chunks):
+            if i == self.server.break_stream_at:
+                # Drop the connection mid-response, once
+                self.server.break_stream_at = None
+                self.close_connection = True
+                return
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def send_api_error(self, status: int, message: str, headers=None, code=None):
+        error = {"message": message, "type": "error", "code": code}
+        payload = json.dumps({"error": error}).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_HEAD(self):
+        self.server.requests.append((self.path, None))
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((self.path, body))
+        if self.server.failures:
+            self.send_api_error(*self.server.failures.pop(0))
+            return
+        if body.get("messages", [{}])[-1].get("content") == "fail":
+            self.send_api_error(400, "rejected")
+            return
+        num = body.get("n") or 1
+        text = "".join(self.RESPONSE)
+
+        if self.path.endswith("/chat/completions"):
+            if body.get("stream"):
+                chunks = [
+                    {"choices": [{"index": i, "delta": {"role": "assistant"}}]}
+                    for i in range(num)
+                ]
+                for piece in self.RESPONSE:
+                    chunks += [
+                        {"choices": [{"index": i, "delta": {"content": piece}}]}
+                        for i in range(num)
+                    ]
+                chunks += [{"choices": [{"index": i, "delta": {}}]} for i in range(num)]
+                self.send_stream(chunks)
+            else:
+                message = {"role": "assistant", "content": text}
+                choices = [{"index": i, "message": message} for i in range(num)]
+                self.send_json({"choices": choices})
+        elif self.path.endswith("/completions"):
+            if body.get("stream"):
+                chunks = [
+                    {"choices": [{"index": i, "text": piece}]}
+                    for piece in self.RESPONSE
+                    for i in range(num)
+                ]
+                self.send_stream(chunks)
+            elif isinstance(body["prompt"], list):
+                # Reversed, the API doesn't promise the order of choices
+                choices = [
+                    {"index": p * num + i, "text": f"{prompt} {i}"}
+                    for p, prompt in enumerate(body["prompt"])
+                    for i in range(num)
+                ]
+                self.send_json({"choices": choices[::-1]})
+            else:
+                choices = [{"index": i, "text": text} for i in range(num)]
+                usage = {"prompt_tokens": 1, "completion_tokens": 3 * num}
+                self.send_json({"choices": choices, "usage": usage})
+        elif self.path.endswith("/edits"):
+            edited = body["input"]
+            if body["instruction"] == "upper":
+                edited = edited.upper()
+            choices = [{"index": i, "text": edited} for i in range(num)]
+            self.send_json({"choices": choices})
+        else:
+            self.send_error(404)
+
+
+@pytest.fixture
+def fake_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAPIHandler)
+    server.requests = []
+    # send_api_error arguments for the next requests, and a stream chunk to break on
+    server.failures = []
+    server.break_stream_at = None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def api(fake_api, data_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    """Point the in-process openai client at the fake API"""
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr(openai, "api_base", fake_api.url)
+    return fake_api
+
+
+def run_python(code: str, env: dict) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True
+    )
+
+
+class Test_Startup:
+    def test_help_lists_every_command(self, runner: CliRunner):
+        result = runner.invoke(main, ["--help"])
+        assert result.exit_code == 0, result.output
+        for name in COMMANDS:
+            assert name in result.output
+
+    def test_lazy_short_help_matches_command(self):
+        ctx = click.Context(main)
+        for name, (_, _, short_help) in COMMANDS.items():
+            command = main.get_command(ctx, name)
+            assert command.get_short_help_str(limit=80) == short_help
+
+    @pytest.mark.parametrize("args", [["--help"], ["config", "path"]])
+    def test_openai_not_imported(self, skai_env: dict, args: list):
+        code = (
+            "import sys\n"
+            "from skainet.__main__ import main\n"
+            f"main({args!r}, standalone_mode=False)\n"
+            "assert 'openai' not in sys.modules, 'openai was imported'\n"
+        )
+        result = run_python(code, skai_env)
+        assert result.returncode == 0, result.stderr
+
+
+class Test_Data:
+    def test_import_has_no_side_effects(self, skai_env: dict, tmp_path: Path):
+        result = run_python("import skainet.data", skai_env)
+        assert result.returncode == 0, result.stderr
+        assert not (tmp_path / ".local").exists()
+
+    def test_config_created_from_default(self, data_dir: Path):
+        config = data.load_config()
+        assert (data_dir / "config.ini").exists()
+        assert config["general"]["editor"]
+        for section in data.DEFAULT_CONFIG.sections():
+            assert section in config
+
+    def test_warm_start_does_not_parse_or_write(
+        self, data_dir: Path, monkeypatch: pytest.MonkeyPatch
+    ):
+        data.load_config()
+        monkeypatch.setattr(data, "_config", None)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("config was parsed or written on a warm start")
+
+        monkeypatch.setattr(data.ConfigParser, "read", fail)
+        monkeypatch.setattr(data, "atomic_write", fail)
+        assert data.load_config()["chat"]["model"]
+
+    def test_memoized_until_file_changes(self, data_dir: Path):
+        config = data.load_config()
+        assert data.load_config() is config
+
+        config["chat"]["context"] = "123"
+        data.save_config(config)
+        assert data.load_config()["chat"]["context"] == "123"
+
+    def test_newer_default_is_merged(self, data_dir: Path):
+        data_dir.mkdir()
+        config_file = data_dir / "config.ini"
+        config_file.write_text("[chat]\ncontext = 10\n")
+        os.utime(config_file, ns=(0, 0))
+
+        config = data.load_config()
+        assert config["chat"]["context"] == "10"
+        assert config["chat"]["model"] == data.DEFAULT_CONFIG["chat"]["model"]
+        assert "model" in config_file.read_text()
+
+    def test_older_default_is_not_merged(self, data_dir: Path):
+        data_dir.mkdir()
+        config_file = data_dir / "config.ini"
+        config_file.write_text("[chat]\ncontext = 10\n")
+
+        config = data.load_config()
+        assert "model" not in config["chat"]
+        assert config_file.read_text() == "[chat]\ncontext = 10\n"
+
+    def test_newer_config_without_new_keys(self, skai_env: dict, tmp_path: Path):
+        # Keys added since the user's config was written aren't merged into it
+        config_dir = tmp_path / ".local" / "share" / "skainet"
+        config_dir.mkdir(parents=True)
+        default = (Path(data.__file__).parent / "config.ini").read_text()
+        config = "".join(
+            line
+            for line in default.splitlines(keepends=True)
+            if not line.startswith("history_size")
+        )
+        (config_dir / "config.ini").write_text(config)
+        result = subprocess.run(
+            [sys.executable, "-m", "skainet", "chat", "--help"],
+            env=skai_env,
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0, result.stderr
+
+
+class Test_Profile:
+    def test_json_report(self, skai_env: dict, fake_api, tmp_path: Path):
+        report = tmp_path / "report.json"
+        skai_env["OPENAI_API_BASE"] = fake_api.url
+        result = subprocess.run(
+            [sys.executable, "-m", "skainet", "--profile", str(report), "chat", "hi"],
+            env=skai_env,
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0, result.stderr
+        assert result.stdout == "Hello world\n"
+
+        timings = json.loads(report.read_text())["timings"]
+        for name in ["config_load", "request_build", "ttfb", "ttft", "stream"]:
+            assert name in timings
+        assert "openai" in json.loads(report.read_text())["imports"]
+
+    def test_pstats_from_env(self, skai_env: dict, tmp_path: Path):
+        import pstats
+
+        report = tmp_path / "skai.prof"
+        skai_env["SKAI_PROFILE"] = str(report)
+        result = subprocess.run(
+            [sys.executable, "-m", "skainet", "config", "path"],
+            env=skai_env,
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0, result.stderr
+        assert pstats.Stats(str(report)).total_calls
+
+
+@pytest.mark.skipif(not hasattr(__import__("socket"), "AF_UNIX"), reason="Unix only")
+class Test_Daemon:
+    @pytest.fixture
+    def daemon(self, skai_env: dict, fake_api, tmp_path: Path):
+        socket_file = tmp_path / "skai.sock"
+        skai_env["SKAI_SOCKET"] = str(socket_file)
+        skai_env["OPENAI_API_BASE"] = fake_api.url
+        process = subprocess.Popen(
+            [sys.executable, "-m", "skainet", "serve"],
+            env=skai_env,
+            stdin=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        process.stderr.readline()  # "Listening on ..." once warmed up
+        yield socket_file
+        process.terminate()
+        process.wait(timeout=10)
+        assert not socket_file.exists()
+
+    def skai(self, env: dict, *args: str, input: str = ""):
+        # The client can't import openai, only the daemon can answer
+        path = Path(env["HOME"]) / "no_openai"
+        path.mkdir(exist_ok=True)
+        (path / "openai.py").write_text("raise ImportError('openai is unavailable')")
+        python_path = os.pathsep.join(filter(None, [str(path), env.get("PYTHONPATH")]))
+        env = dict(env, PYTHONPATH=python_path)
+        return subprocess.run(
+            [sys.executable, "-m", "skainet", *args],
+            env=env,
+            input=input,
+            capture_output=True,
+            text=True,
+            timeout=30,
+        )
+
+    def test_forwarded(self, daemon: Path, skai_env: dict, fake_api):
+        result = self.skai(skai_env, "chat", "hi")
+        assert result.returncode == 0, result.stderr
+        assert result.stdout == "Hello world\n"
+
+    def test_stdin_forwarded(self, daemon: Path, skai_env: dict, fake_api):
+        result = self.skai(skai_env, "edit", "do nothing", input="piped")
+        assert result.returncode == 0, result.stderr
+        assert result.stdout == "piped\n"
+        assert fake_api.requests[-1][1]["input"] == "piped"
+
+    def test_stdin_read_as_needed(self, data_dir: Path):
+        client, server = socket.socketpair()
+        requested = []
+
+        def serve():
+            # Answers block requests from 100 KiB of stdin, as the client does
+            stdin = io.BytesIO(b"x" * 100 * 1024)
+            while True:
+                kind, payload = daemon_module._recv_frame(client)
+                if kind != daemon_module._STDIN_REQUEST:
+                    return
+                (size,) = struct.unpack("!I", payload)
+                requested.append(size)
+                daemon_module._send_frame(
+                    client, daemon_module._STDIN, stdin.read(size)
+                )
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        stdin = daemon_module._RemoteStdin(server, isatty=False)
+        assert stdin.read(10) == "x" * 10
+        # Only as much as the read needed was asked for
+        assert len(requested) == 1
+        assert requested[0] <= daemon_module.STDIN_BLOCK_SIZE
+        assert len(stdin.read()) == 100 * 1024 - 10
+        assert stdin.read() == ""
+
+        daemon_module._send_frame(server, daemon_module._EXIT)
+        thread.join()
+        client.close()
+        server.close()
+
+    def test_session_forwarded(self, daemon: Path, skai_env: dict):
+        result = self.skai(dict(skai_env, SKAI_SESSION="work"), "chat", "hi")
+        assert result.returncode == 0, result.stderr
+        result = self.skai(skai_env, "session", "list")
+        assert result.stdout.startswith("work"), result.stdout
+
+    def test_handed_back_for_other_openai_settings(
+        self, daemon: Path, skai_env: dict, fake_api
+    ):
+        # openai reads these at import, the daemon's can't be changed per invocation
+        for name, value in [
+            ("OPENAI_ORGANIZATION", "org-other"),
+            ("OPENAI_API_BASE", "http://127.0.0.1:9/v1"),
+        ]:
+            result = self.skai(dict(skai_env, **{name: value}), "chat", "hi")
+            assert result.returncode != 0
+            assert "openai is unavailable" in result.stderr
+        assert not fake_api.requests
+
+    def test_exit_code_forwarded(self, daemon: Path, skai_env: dict):
+        result = self.skai(skai_env, "config", "set", "nope", "nope", "value")
+        assert result.returncode == 1
+        assert "does not exist" in result.stderr
+
+    def test_fallback_without_daemon(self, skai_env: dict, tmp_path: Path):
+        skai_env["SKAI_SOCKET"] = str(tmp_path / "missing.sock")
+        result = self.skai(skai_env, "config", "path")
+        assert result.returncode == 0, result.stderr
+
+
+class Test_Context:
+    @pytest.fixture
+    def history(self):
+        return [
+            {"role": "user", "content": f"message number {i}"} for i in range(20000)
+        ]
+
+    def test_truncate_keeps_most_recent(self):
+        # 3 tokens of content and 4 for the message format
+        history = [{"role": "user", "content": "a b c"} for _ in range(5)]
+        assert text.truncate_context(history, 15) == history[-2:]
+        assert text.truncate_context(history, 100) == history
+        assert text.truncate_context(history, 1) == []
+
+    def test_request_messages_strip_token_counts(self):
+        history = [{"role": "user", "content": "a b c"}]
+        text.calculate_context(history)
+        assert history[0]["tokens"] == 7
+        assert text.request_messages(history) == [{"role": "user", "content": "a b c"}]
+
+    def test_request_messages_keep_api_keys(self):
+        message = {"role": "user", "name": "ann", "content": "hi", "tokens": 5}
+        assert text.request_messages([message]) == [
+            {"role": "user", "name": "ann", "content": "hi"}
+        ]
+
+    def test_counts_from_another_tokenizer_are_recounted(self):
+        message = {"role": "user", "content": "a b c", "tokens": 1, "tokenizer": "x"}
+        assert text.message_tokens(message) == 7
+        assert message["tokenizer"] == tokenizer.name()
+
+    def test_truncate_is_linear(self, history: list, monkeypatch: pytest.MonkeyPatch):
+        calls = []
+        calculate_tokens = text.calculate_tokens
+        monkeypatch.setattr(
+            text, "calculate_tokens", lambda s: calls.append(s) or calculate_tokens(s)
+        )
+
+        context = text.truncate_context(history, text.calculate_context(history))
+        assert len(calls) == len(history)
+        assert context == history[1:]
+
+        # Counts are stored on the messages, so later passes don't recount
+        text.truncate_context(history, 1000)
+        assert len(calls) == len(history)
+
+
+class Test_Tokenizer:
+    @pytest.fixture
+    def ranks(self, monkeypatch: pytest.MonkeyPatch):
+        ranks = {bytes([i]): i for i in range(256)}
+        for rank, token in enumerate([b"he", b"ll", b"hell", b"hello", b" w"], 256):
+            ranks[token] = rank
+        monkeypatch.setattr(tokenizer, "_load_ranks", lambda: ranks)
+        return ranks
+
+    def test_byte_pair_merge(self, ranks: dict):
+        assert tokenizer._byte_pair_merge(b"hello", ranks) == [b"hello"]
+        assert tokenizer._byte_pair_merge(b"hellx", ranks) == [b"hell", b"x"]
+        assert tokenizer._byte_pair_merge(b"xyz", ranks) == [b"x", b"y", b"z"]
+
+    def test_count(self, ranks: dict):
+        # "hello" | " w" "o" "r" "l" "d" | "!" "!"
+        assert tokenizer.count("hello world!!") == 1 + 5 + 2
+        assert tokenizer.count("") == 0
+
+    def test_estimate_without_vocabulary(self):
+        assert tokenizer.name() == "estimate"
+        assert tokenizer.count("hello") == 2
+        assert tokenizer.count("a b c") == 3
+
+    @pytest.fixture
+    def vocabulary(self, data_dir: Path, monkeypatch: pytest.MonkeyPatch):
+        """A small valid vocabulary, served by a stand-in for urlopen"""
+        content = b"aGU= 0\nbGw= 1\n"
+        monkeypatch.setattr(tokenizer, "ENCODING_SHA256", sha256(content).hexdigest())
+        monkeypatch.setattr(tokenizer, "_ENCODING_FILE", data_dir / "vocab.tiktoken")
+        monkeypatch.setattr(tokenizer, "_DOWNLOAD_FAILED", data_dir / "vocab.failed")
+        served = [content]
+        monkeypatch.setattr(
+            tokenizer.urllib.request, "urlopen", lambda *args, **kwargs: served[0]
+        )
+        return served
+
+    def test_download(self, vocabulary: list, data_dir: Path):
+        vocabulary[0] = io.BytesIO(vocabulary[0])
+        assert tokenizer._vocabulary() == b"aGU= 0\nbGw= 1\n"
+        assert (data_dir / "vocab.tiktoken").exists()
+
+    def test_portal_page_rejected(self, vocabulary: list, data_dir: Path):
+        vocabulary[0] = io.BytesIO(b"<html>Sign in to the network</html>")
+        assert tokenizer._vocabulary() is None
+        assert not (data_dir / "vocab.tiktoken").exists()
+        assert (data_dir / "vocab.failed").exists()
+
+    def test_incomplete_download(self, vocabulary: list, data_dir: Path):
+        class Broken(io.BytesIO):
+            def read(self, *args):
+                raise http.client.IncompleteRead(b"aGU=")
+
+        vocabulary[0] = Broken()
+        assert tokenizer._vocabulary() is None
+
+    def test_damaged_file_replaced(self, vocabulary: list, data_dir: Path):
+        data.make_data_dir()
+        (data_dir / "vocab.tiktoken").write_bytes(b"<html>not a vocabulary</html>")
+        vocabulary[0] = io.BytesIO(vocabulary[0])
+        assert tokenizer._vocabulary() == b"aGU= 0\nbGw= 1\n"
+
+        (data_dir / "vocab.tiktoken").write_bytes(b"<html>not a vocabulary</html>")
+        vocabulary[0] = io.BytesIO(b"<html>still not</html>")
+        assert tokenizer._vocabulary() is None
+        assert not (data_dir / "vocab.tiktoken").exists()
+
+    def test_pieces_are_memoized(self, ranks: dict):
+        tokenizer.count("hello hello hello")
+        info = tokenizer._count_piece.cache_info()
+        assert info.misses == 2 and info.hits == 1
+
+
+class Test_History:
+    @pytest.fixture
+    def history(self, data_dir: Path):
+        return History(data_dir / "chat.jsonl")
+
+    def messages(self, count: int, tokens: int = 10):
+        return [
+            {"role": "user", "content": f"message {i}", "tokens": tokens}
+            for i in range(count)
+        ]
+
+    def test_append_and_load(self, history: History):
+        assert history.load() == []
+        history.append(self.messages(3))
+        history.append(self.messages(2))
+        assert len(history) == 5
+        assert [m["content"] for m in history.load()] == [
+            "message 0",
+            "message 1",
+            "message 2",
+            "message 0",
+            "message 1",
+        ]
+
+    def test_load_tail_for_budget(self, history: History):
+        history.append(self.messages(1000))
+        tail = history.load(context_limit=35)
+        # enough to cover the budget, plus the message that doesn't fit
+        assert [m["content"] for m in tail] == [
+            f"message {i}" for i in range(996, 1000)
+        ]
+
+    def test_clear(self, history: History):
+        history.append(self.messages(3))
+        history.clear()
+        assert len(history) == 0
+        assert history.load() == []
+
+    def test_partial_write_is_dropped(self, history: History):
+        history.append(self.messages(2))
+        with open(history.path, "ab") as journal:
+            journal.write(b'{"role": "user", "cont')
+        assert len(history.load()) == 2
+
+        history.append(self.messages(1))
+        assert len(history.load()) == 3
+
+    def test_missing_index_entries_are_rebuilt(self, history: History):
+        history.append(self.messages(2))
+        with open(history.path, "ab") as journal:
+            journal.write(b'{"role": "user", "content": "late", "tokens": 1}\n')
+        assert history.load(context_limit=1) == [
+            {"role": "user", "content": "late", "tokens": 1}
+        ]
+
+        history.index_path.unlink()
+        assert len(history.load()) == 3
+        assert len(history) == 3
+
+    def test_compact(self, history: History):
+        history.append(self.messages(10))
+        history.compact(keep=5)
+        assert len(history) == 10
+
+        history.append(self.messages(1))
+        history.compact(keep=5)
+        assert len(history) == 5
+        assert history.load()[-1]["content"] == "message 0"
+
+    def test_compact_keep_nothing(self, history: History):
+        history.append(self.messages(3))
+        assert history.compact(keep=0)
+        assert len(history) == 0
+        assert history.base() == 3
+
+    def test_concurrent_appends(self, history: History, tmp_path: Path):
+        code = (
+            "import sys\n"
+            "from pathlib import Path\n"
+            "from skainet.history import History\n"
+            f"history = History(Path({str(history.path)!r}))\n"
+            "for i in range(50):\n"
+            "    history.append([{'role': 'user', 'content': sys.argv[1]}] * 2)\n"
+        )
+        processes = [
+            subprocess.Popen([sys.executable, "-c", code, str(n)]) for n in range(4)
+        ]
+        for process in processes:
+            assert process.wait(timeout=60) == 0
+
+        messages = history.load()
+        assert len(messages) == 400
+        # each turn was written as one unit
+        for first, second in zip(messages[::2], messages[1::2]):
+            assert first == second
+
+    def test_legacy_history_is_imported(self, data_dir: Path):
+        data_dir.mkdir()
+        legacy = [{"role": "user", "content": "old"}]
+        (data_dir / "chat_history.json").write_text(json.dumps(legacy))
+        assert data.load_chat() == legacy
+        assert not (data_dir / "chat_history.json").exists()
+
+
+class Test_Session:
+    def test_sessions_are_separate(self, runner: CliRunner, api):
+        for args in [["--session", "work"], ["--session", "work"], []]:
+            result = runner.invoke(main, ["chat", "hi", *args])
+            assert result.exit_code == 0, result.output
+
+        # the second chat in "work" was sent the first turn as context
+        assert len(api.requests[1][1]["messages"]) == 4
+        assert len(api.requests[2][1]["messages"]) == 2
+        assert len(session.history("work")) == 4
+        assert len(session.history("default")) == 2
+
+    def test_list(self, runner: CliRunner, api):
+        runner.invoke(main, ["chat", "hi", "--session", "work"])
+        runner.invoke(main, ["chat", "hi", "--session", "home"])
+
+        index = session.load_index()
+        assert index["work"]["messages"] == 2
+        assert index["work"]["tokens"] == session.history("work").token_total()
+
+        result = runner.invoke(main, ["session", "list"])
+        assert result.exit_code == 0, result.output
+        lines = result.output.splitlines()
+        assert lines[0].startswith("home") and lines[1].startswith("work")
+
+    def test_show_and_rm(self, runner: CliRunner, api):
+        runner.invoke(main, ["chat", "hi", "--session", "work"])
+
+        result = runner.invoke(main, ["session", "show", "work"])
+        # prompts read from a pipe keep their trailing newline
+        assert result.output == "user: hi\n\nassistant: Hello world\n"
+
+        result = runner.invoke(main, ["session", "rm", "work"])
+        assert result.exit_code == 0, result.output
+        assert "work" not in session.load_index()
+
+        result = runner.invoke(main, ["session", "show", "work"])
+        assert result.exit_code == 1
+
+    def test_concurrent_turns_counted(self, data_dir: Path):
+        session.record_turn("work", [])
+        messages = [{"role": "user", "content": "hi", "tokens": 1}]
+        threads = [
+            threading.Thread(
+                target=lambda: [session.record_turn("work", messages) for _ in range(5)]
+            )
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert session.load_index()["work"]["tokens"] == 20
+
+    def test_invalid_name(self, runner: CliRunner, api):
+        result = runner.invoke(main, ["chat", "hi", "--session", "../etc"])
+        assert result.exit_code == 2
+
+
+class Test_Batch:
+    def test_chat_batch(self, runner: CliRunner, api, tmp_path: Path):
+        prompts = tmp_path / "prompts.jsonl"
+        prompts.write_text('one\n{"id": "b", "prompt": "two"}\n\n"three"\n')
+        result = runner.invoke(main, ["chat", "--batch", str(prompts)])
+        assert result.exit_code == 0, result.output
+
+        lines = [json.loads(line) for line in result.output.splitlines()]
+        assert [line["index"] for line in lines] == [0, 1, 2]
+        assert lines[1]["id"] == "b"
+        assert all(line["choices"] == ["Hello world"] for line in lines)
+        sent = sorted(body["messages"][-1]["content"] for _, body in api.requests)
+        assert sent == ["one", "three", "two"]
+        assert not len(session.history(session.DEFAULT_SESSION))
+
+    def test_errors_are_reported_per_item(self, runner: CliRunner, api):
+        result = runner.invoke(
+            main, ["chat", "--batch", "-", "-j", "2"], input="one\nfail\ntwo\n"
+        )
+        assert result.exit_code == 1
+
+        lines = [json.loads(line) for line in result.output.splitlines()]
+        assert len(lines) == 3
+        assert lines[1]["error"] == {
+            "type": "InvalidRequestError",
+            "message": "rejected",
+        }
+        assert "error" not in lines[0] and "error" not in lines[2]
+
+    def test_invalid_items_reported(self, runner: CliRunner, api):
+        items = [
+            '{"messages": [{"content": "x"}]}',
+            '{"messages": "hi"}',
+            '{"prompt": 3}',
+            '{"id": "ok", "messages": [{"role": "user", "content": "hi"}]}',
+        ]
+        result = runner.invoke(main, ["chat", "--batch", "-"], input="\n".join(items))
+        assert result.exit_code == 1
+
+        lines = [json.loads(line) for line in result.output.splitlines()]
+        assert [line.get("error", {}).get("type") for line in lines] == [
+            "InvalidItem",
+            "InvalidItem",
+            "InvalidItem",
+            None,
+        ]
+        assert lines[3]["choices"] == ["Hello world"]
+        assert len(api.requests) == 1
+
+    def test_complete_batch(self, runner: CliRunner, api, monkeypatch):
+        monkeypatch.setattr(text, "BATCH_PROMPTS", 3)
+        prompts = "".join(f"p{i}\n" for i in range(7)) + '{"id": "x"}\n'
+        result = runner.invoke(
+            main, ["complete", "--batch", "-", "-n", "2"], input=prompts
+        )
+        assert result.exit_code == 1
+
+        lines = [json.loads(line) for line in result.output.splitlines()]
+        assert [line["index"] for line in lines] == list(range(8))
+        assert lines[5]["choices"] == ["p5 0", "p5 1"]
+        assert lines[7] == {
+            "index": 7,
+            "id": "x",
+            "error": {"type": "InvalidItem", "message": "no prompt"},
+        }
+        assert [len(body["prompt"]) for _, body in api.requests] == [3, 3, 1]
+
+    def test_complete_batch_failed_request(self, runner: CliRunner, api):
+        api.failures.append((400, "bad"))
+        result = runner.invoke(
+            main, ["complete", "--batch", "-", "-j", "1"], input="a\nb\n"
+        )
+        assert result.exit_code == 1
+        lines = [json.loads(line) for line in result.output.splitlines()]
+        assert all(line["error"]["message"] == "bad" for line in lines)
+        assert len(api.requests) == 1
+
+    def test_pack(self):
+        items = [{"cost": cost} for cost in [3, 3, 5, 20, 1, 1, 1]]
+        groups = batch.pack(items, 3, 10, lambda item: item["cost"])
+        assert [[index for index, _ in group] for group in groups] == [
+            [0, 1],
+            [2],
+            [3],
+            [4, 5, 6],
+        ]
+
+    def collect(self, results) -> list:
+        async def collect():
+            return [result async for result in results]
+
+        return asyncio.run(collect())
+
+    def test_order(self):
+        async def work(item):
+            await asyncio.sleep(item["delay"])
+            return item["delay"]
+
+        items = [{"delay": delay} for delay in [0.2, 0.1, 0]]
+        ordered = self.collect(batch.run(work, items, concurrency=3))
+        assert [index for index, _ in ordered] == [0, 1, 2]
+
+        finished = self.collect(batch.run(work, items, concurrency=3, ordered=False))
+        assert [index for index, _ in finished] == [2, 1, 0]
+
+    def test_concurrency(self):
+        running = []
+        most = []
+
+        async def work(item):
+            running.append(item)
+            most.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(item)
+
+        items = [{"i": i} for i in range(10)]
+        assert len(self.collect(batch.run(work, items, concurrency=3))) == 10
+        assert max(most) == 3
+
+    def test_items_are_read_lazily(self):
+        read = []
+
+        def items():
+            for i in range(100):
+                read.append(i)
+                yield {"i": i}
+
+        async def work(item):
+            return item
+
+        async def check():
+            async for index, _ in batch.run(work, items(), concurrency=2):
+                assert len(read) <= index + 1 + 4
+
+        asyncio.run(check())
+        assert len(read) == 100
+
+    def test_connections_shared(self, runner: CliRunner, api, monkeypatch):
+        counters = {}
+        monkeypatch.setattr(perf, "_enabled", True)
+        monkeypatch.setattr(perf, "_counters", counters)
+        result = runner.invoke(
+            main, ["chat", "--batch", "-", "-j", "1"], input="a\nb\nc\n"
+        )
+        assert result.exit_code == 0, result.output
+        assert counters["http_connections_opened"] == 1
+        assert counters["http_connections_reused"] == 2
+
+
+class Test_EditFiles:
+    @pytest.fixture
+    def files(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / "src").mkdir()
+        (tmp_path / "src" / "a.py").write_text("print('a')\n")
+        (tmp_path / "b.txt").write_text("b\r\nB\r\n")
+        return [Path("src/a.py"), Path("b.txt")]
+
+    def test_in_place(self, runner: CliRunner, api, files):
+        files[0].chmod(0o755)
+        result = runner.invoke(main, ["edit", "upper", "-i", *map(str, files)])
+        assert result.exit_code == 0, result.output
+        assert files[0].read_text() == "PRINT('A')\n"
+        assert files[1].read_bytes() == b"B\r\nB\r\n"
+        assert files[0].stat().st_mode & 0o777 == 0o755
+        assert "src/a.py: edited (" in result.output
+
+    def test_output_dir(self, runner: CliRunner, api, files, tmp_path: Path):
+        files[0].chmod(0o644)
+        out = tmp_path / "out"
+        result = runner.invoke(main, ["edit", "upper", "-od", str(out), "src/a.py"])
+        assert result.exit_code == 0, result.output
+        assert (out / "src" / "a.py").read_text() == "PRINT('A')\n"
+        assert files[0].read_text() == "print('a')\n"
+        assert (out / "src" / "a.py").stat().st_mode & 0o777 == 0o644
+
+    def test_written_as_utf8(self, runner: CliRunner, api, files):
+        files[1].write_bytes("ŝa\r\nЖ\r\n".encode("utf-8"))
+        result = runner.invoke(main, ["edit", "upper", "-i", str(files[1])])
+        assert result.exit_code == 0, result.output
+        assert files[1].read_bytes() == "ŜA\r\nЖ\r\n".encode("utf-8")
+
+    def test_diff(self, api, files):
+        runner = CliRunner(mix_stderr=False)
+        result = runner.invoke(main, ["edit", "upper", "--diff", *map(str, files)])
+        assert result.exit_code == 0, result.stderr
+        assert result.stdout.splitlines()[:4] == [
+            "--- a/src/a.py",
+            "+++ b/src/a.py",
+            "@@ -1 +1 @@",
+            "-print('a')",
+        ]
+        assert "+++ b/b.txt" in result.stdout
+        assert files[0].read_text() == "print('a')\n"
+
+    def test_cached_files_not_sent(self, runner: CliRunner, api, files):
+        for _ in range(2):
+            result = runner.invoke(main, ["edit", "upper", "-d", *map(str, files)])
+            assert result.exit_code == 0, result.output
+        assert len(api.requests) == 2
+
+    def test_failed_file(self, runner: CliRunner, api, files):
+        result = runner.invoke(main, ["edit", "upper", "-i", "missing", "src/a.py"])
+        assert result.exit_code == 1
+        assert "missing: FileNotFoundError" in result.output
+        assert files[0].read_text() == "PRINT('A')\n"
+
+    def test_concurrency_shared_with_sections(
+        self, runner: CliRunner, api, files, monkeypatch: pytest.MonkeyPatch
+    ):
+        for path in files:
+            path.write_text("".join(f"word {i}\n\n" for i in range(20)))
+        running = []
+        most = 0
+
+        async def acreate(resource, use_cache, input, **kwargs):
+            nonlocal most
+            running.append(input)
+            most = max(most, len(running))
+            await asyncio.sleep(0.01)
+            running.remove(input)
+            return {"choices": [{"text": input}]}
+
+        monkeypatch.setattr(text.cache, "acreate", acreate)
+        args = ["edit", "upper", "-d", "-j", "3", "-ss", "2", *map(str, files)]
+        result = runner.invoke(main, args)
+        assert result.exit_code == 0, result.output
+        assert most == 3
+
+    def test_output_dir_duplicate_targets(
+        self, runner: CliRunner, api, files, tmp_path: Path
+    ):
+        (tmp_path / "other").mkdir()
+        (tmp_path / "other" / "a.py").write_text("a\n")
+        args = [str(tmp_path / "src" / "a.py"), str(tmp_path / "other" / "a.py")]
+        result = runner.invoke(main, ["edit", "upper", "-od", "out", *args])
+        assert result.exit_code == 2
+        assert "More than one file would be written to out/a.py" in result.output
+        assert not api.requests
+
+    @pytest.mark.parametrize(
+        "args",
+        [["-i", "-d", "a"], ["-i"], ["-i", "-n", "2", "a"], ["a", "b"]],
+    )
+    def test_usage(self, runner: CliRunner, api, args: list):
+        result = runner.invoke(main, ["edit", "upper", *args])
+        assert result.exit_code == 2
+        assert not api.requests
+
+
+class Test_Chunked:
+    TEXT = "".join(f"Line {i}: the quick brown fox jumps.\n" for i in range(200))
+
+    @pytest.fixture(autouse=True)
+    def small_reads(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(chunked, "READ_SIZE", 100)
+
+    def tokens(self, text: str) -> int:
+        return sum(count for _, count in tokenizer.pieces(text))
+
+    def test_chunks_cover_input(self):
+        parts = list(chunked.chunks(io.StringIO(self.TEXT), 50, 0))
+        assert "".join(parts) == self.TEXT
+        assert len(parts) > 1
+        assert all(self.tokens(part) <= 50 for part in parts)
+
+    def test_overlap(self):
+        parts = list(chunked.chunks(io.StringIO(self.TEXT), 50, 10))
+        assert all(self.tokens(part) <= 50 for part in parts)
+        for before, after in zip(parts, parts[1:]):
+            repeated = next(
+                n for n in range(len(after), 0, -1) if before.endswith(after[:n])
+            )
+            assert 0 < self.tokens(after[:repeated]) <= 10
+
+    def test_empty_input(self):
+        assert list(chunked.chunks(io.StringIO(""), 50, 10)) == []
+
+    def test_chat(self, runner: CliRunner, api):
+        result = runner.invoke(
+            main,
+            ["chat", "--chunked", "--chunk-size", "200", "Find the foxes"],
+            input=self.TEXT,
+        )
+        assert result.exit_code == 0, result.output
+        assert result.output == "Hello world\n"
+
+        contents = [body["messages"][-1]["content"] for _, body in api.requests]
+        mapped = [c for c in contents if not c.startswith("The input was too long")]
+        assert len(mapped) == len(
+            list(chunked.chunks(io.StringIO(self.TEXT), 200, 100))
+        )
+        assert all(c.startswith("Find the foxes\n\n") for c in mapped)
+        assert "Answer for part 2:\nHello world" in contents[-1]
+        assert not len(session.history(session.DEFAULT_SESSION))
+
+    def test_answers_reduced_as_they_arrive(self, monkeypatch: pytest.MonkeyPatch):
+        requests = []
+
+        async def request(content: str) -> str:
+            requests.append(content)
+            return "word " * 30
+
+        answer = aio.run(chunked.run(request, "Go", io.StringIO(self.TEXT), 100, 0, 2))
+        assert answer == "word " * 30
+        reduces = [r for r in requests if r.startswith("The input was too long")]
+        # No reduce request gets more answers than fit in a chunk
+        assert len(reduces) > 1
+        assert all(r.count("Answer for part") <= 4 for r in reduces)
+
+    def test_complete(self, runner: CliRunner, api):
+        result = runner.invoke(
+            main, ["complete", "--chunked", "Summarize"], input="short input"
+        )
+        assert result.exit_code == 0, result.output
+        assert result.output == "Hello world\n"
+        assert [body["prompt"] for _, body in api.requests] == [
+            "Summarize\n\nshort input"
+        ]
+
+    @pytest.mark.parametrize(
+        "args",
+        [
+            ["--chunked"],
+            ["--chunked", "hi", "-n", "2"],
+            ["--chunked", "-b", "-"],
+            ["--chunked", "hi", "--chunk-size", "100", "--chunk-overlap", "100"],
+            ["--chunked", "hi", "--chunk-size", "100", "--chunk-overlap", "51"],
+        ],
+    )
+    def test_usage(self, runner: CliRunner, api, args: list):
+        result = runner.invoke(main, ["chat", *args], input="text")
+        assert result.exit_code == 2
+        assert not api.requests
+
+
+class Test_Sections:
+    CODE = "".join(
+        f"def function_{i}(x):\n    y = x + {i}\n\n    return y\n\n\n"
+        for i in range(20)
+    )
+
+    def test_split_joins_back(self):
+        parts = sections.split(self.CODE, 40)
+        assert "".join(parts) == self.CODE
+        assert len(parts) > 1
+        # Functions aren't split at the blank line inside them
+        assert all(part.startswith("def ") for part in parts)
+
+    def test_large_block_split_inside(self):
+        text = "intro\n\n" + "".join(f"    line {i}\n\n" for i in range(100))
+        parts = sections.split(text, 20)
+        assert "".join(parts) == text
+        assert len(parts) > 2
+
+    @pytest.mark.parametrize(
+        "instruction, old",
+        [
+            ("Rename `load_all` to fetchAll", "load_all"),
+            ("replace 'colour' with 'color'.", "colour"),
+            ("Rename all uses of config.load to config.read", "config.load"),
+            ("Fix the spelling", None),
+            # Words describing the change, not text the change must be made in
+            ("Convert all names to snake_case", None),
+            ("Use logging.info instead of print", None),
+            ("Rename variables to snake_case", None),
+            ("Rename `load_all` to fetchAll and add type hints", None),
+        ],
+    )
+    def test_replaced(self, instruction: str, old):
+        assert sections.replaced(instruction) == old
+
+    def test_edit_skips_unaffected(self, runner: CliRunner, api, tmp_path: Path):
+        source = tmp_path / "code.py"
+        source.write_text(self.CODE)
+        result = runner.invoke(
+            main,
+            ["edit", "Rename function_3 to fetch", "-ss", "40", "-i", str(source)],
+        )
+        assert result.exit_code == 0, result.output
+        # The fake API only uppercases for "upper", so check what was sent
+        sent = [body["input"] for _, body in api.requests]
+        assert len(sent) == 1 and "def function_3(x)" in sent[0]
+
+    @pytest.mark.parametrize(
+        "instruction",
+        ["Convert all names to snake_case", "Use logging.info instead of print"],
+    )
+    def test_edit_sends_every_section(
+        self, runner: CliRunner, api, tmp_path: Path, instruction: str
+    ):
+        source = tmp_path / "code.py"
+        source.write_text(self.CODE)
+        result = runner.invoke(
+            main, ["edit", instruction, "-ss", "40", "-i", str(source)]
+        )
+        assert result.exit_code == 0, result.output
+        assert len(api.requests) == len(sections.split(self.CODE, 40))
+
+    def test_sections_edited_and_joined(self, runner: CliRunner, api, tmp_path: Path):
+        source = tmp_path / "code.py"
+        source.write_text(self.CODE)
+        result = runner.invoke(main, ["edit", "upper", "-ss", "40", "-i", str(source)])
+        assert result.exit_code == 0, result.output
+        assert source.read_text() == self.CODE.upper()
+        assert len(api.requests) == len(sections.split(self.CODE, 40))
+
+    def test_whole_by_default(self, runner: CliRunner, api, tmp_path: Path):
+        source = tmp_path / "code.py"
+        source.write_text(self.CODE * 20)
+        result = runner.invoke(main, ["edit", "upper", "-i", str(source)])
+        assert result.exit_code == 0, result.output
+        assert len(api.requests) == 1
+
+    def test_single_input(self, runner: CliRunner, api):
+        result = runner.invoke(main, ["edit", "upper", "-ss", "40", self.CODE])
+        assert result.exit_code == 0, result.output
+        assert result.output.rstrip() == self.CODE.upper().rstrip()
+        assert len(api.requests) > 1
+
+
+class Test_Prompt:
+    class Terminal(io.StringIO):
+        def isatty(self) -> bool:
+            return True
+
+    class Pipe(io.BytesIO):
+        def __init__(self, data: bytes):
+            super().__init__(data)
+            self.bytes_read = 0
+
+        def read(self, size=-1) -> bytes:
+            data = super().read(size)
+            self.bytes_read += len(data)
+            return data
+
+    @pytest.fixture
+    def terminal(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(sys, "stdin", self.Terminal())
+
+    def pipe(self, monkeypatch: pytest.MonkeyPatch, data: bytes) -> "Pipe":
+        pipe = self.Pipe(data)
+        monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(pipe, encoding="utf-8"))
+        return pipe
+
+    def test_file_path(self, terminal, tmp_path: Path, monkeypatch):
+        monkeypatch.setattr(utils, "READ_SIZE", 7)
+        text = "héllo wörld ✓\n" * 100
+        prompt_file = tmp_path / "prompt.txt"
+        prompt_file.write_text(text, encoding="utf-8")
+
+        mapped = []
+        mmap = utils.mmap.mmap
+        monkeypatch.setattr(
+            utils.mmap,
+            "mmap",
+            lambda *args, **kwargs: mapped.append(args) or mmap(*args, **kwargs),
+        )
+        assert utils.Prompt().convert(str(prompt_file), None, None) == text
+        assert len(mapped) == 1
+
+    def test_text_is_not_a_path(self, terminal):
+        assert utils.Prompt().convert("no such file", None, None) == "no such file"
+
+    def test_stdin(self, monkeypatch: pytest.MonkeyPatch):
+        self.pipe(monkeypatch, b"piped")
+        assert utils.Prompt().convert("-", None, None) == "piped"
+        self.pipe(monkeypatch, b"piped")
+        assert utils.Prompt().convert("hi", None, None) == "hi\npiped"
+
+    def test_cap_stops_reading(self, monkeypatch: pytest.MonkeyPatch, capsys):
+        monkeypatch.setattr(utils, "READ_SIZE", 1024)
+        pipe = self.pipe(monkeypatch, b"word " * 100000)
+        prompt = utils.Prompt(max_tokens=100).convert("", None, None)
+        assert 0 < tokenizer.count(prompt) <= 100
+        assert pipe.bytes_read < 10 * 1024
+        assert "cut to 100 tokens" in capsys.readouterr().err
+
+    def test_cap_counts_argument(self, monkeypatch: pytest.MonkeyPatch):
+        self.pipe(monkeypatch, b"word " * 1000)
+        prompt = utils.Prompt(max_tokens=50).convert("one two", None, None)
+        assert prompt.startswith("one two\nword")
+        assert tokenizer.count(prompt) <= 51
+
+    def test_chat_reads_file(self, runner: CliRunner, api, tmp_path: Path):
+        prompt_file = tmp_path / "question.txt"
+        prompt_file.write_text("What is in this file?")
+        result = runner.invoke(main, ["chat", str(prompt_file), "--no-update"])
+        assert result.exit_code == 0, result.output
+        sent = api.requests[0][1]["messages"][-1]["content"]
+        assert sent.startswith("What is in this file?")
+
+
+class Test_Prewarm:
+    @pytest.fixture(autouse=True)
+    def reset(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(connection, "_prewarm", None)
+
+    def test_request_reuses_connection(self, runner: CliRunner, api, monkeypatch):
+        counters = {}
+        monkeypatch.setattr(perf, "_enabled", True)
+        monkeypatch.setattr(perf, "_counters", counters)
+        connection.prewarm()
+        result = runner.invoke(main, ["complete", "hi"])
+        assert result.exit_code == 0, result.output
+        assert [path for path, _ in api.requests] == ["/v1", "/v1/completions"]
+        assert counters["http_connections_opened"] == 1
+        assert counters["http_connections_reused"] == 1
+
+    def test_started_before_editor(self, api, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(sys, "stdin", Test_Prompt.Terminal())
+        started = []
+        monkeypatch.setattr(
+            click, "edit", lambda: started.append(connection._prewarm) or "hi"
+        )
+        assert utils.Prompt().convert("", None, None) == "hi"
+        assert started[0] is not None
+
+    def test_not_started_for_argument(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(sys, "stdin", Test_Prompt.Terminal())
+        utils.Prompt().convert("hi", None, None)
+        assert connection._prewarm is None
+
+    def test_failure_ignored(self, data_dir: Path, monkeypatch):
+        monkeypatch.setattr(openai, "api_base", "http://127.0.0.1:1")
+        connection.prewarm()
+        connection._prewarm.join()
+
+
+class Test_Cache:
+    @pytest.mark.parametrize(
+        "args",
+        [
+            ["complete", "hi"],
+            ["complete", "hi", "--no-stream", "-n", "2"],
+            ["chat", "hi", "--no-update"],
+            ["edit", "fix", "hi"],
+        ],
+    )
+    def test_hit_replays_response(self, runner: CliRunner, api, args: list):
+        first = runner.invoke(main, [*args, "--cache"])
+        second = runner.invoke(main, [*args, "--cache"])
+        assert first.exit_code == 0, first.output
+        assert second.output == first.output
+        assert len(api.requests) == 1
+
+    def test_disabled_by_default(self, runner: CliRunner, api, data_dir: Path):
+        runner.invoke(main, ["complete", "hi"])
+        runner.invoke(main, ["complete", "hi"])
+        assert len(api.requests) == 2
+        assert not (data_dir / "cache").exists()
+
+    def test_enabled_from_config(self, runner: CliRunner, api):
+        config = data.load_config()
+        config["cache"]["enabled"] = "true"
+        data.save_config(config)
+
+        runner.invoke(main, ["complete", "hi"])
+        runner.invoke(main, ["complete", "hi"])
+        assert len(api.requests) == 1
+
+    def test_key_covers_request(self, runner: CliRunner, api):
+        for args in [["hi"], ["hi", "-mt", "5"], ["hi", "-s", "x"], ["ho"]]:
+            runner.invoke(main, ["complete", *args, "--cache"])
+        assert len(api.requests) == 4
+
+    def test_nonzero_temperature_is_not_cached(self, runner: CliRunner, api):
+        runner.invoke(main, ["complete", "hi", "-t", "1", "--cache"])
+        runner.invoke(main, ["complete", "hi", "-t", "1", "--cache"])
+        assert len(api.requests) == 2
+
+    def test_expired(self, runner: CliRunner, api, monkeypatch: pytest.MonkeyPatch):
+        runner.invoke(main, ["complete", "hi", "--cache"])
+        monkeypatch.setattr(cache, "_ttl", lambda: -1)
+        runner.invoke(main, ["complete", "hi", "--cache"])
+        assert len(api.requests) == 2
+
+    def test_least_recently_used_evicted(self, data_dir: Path):
+        for key in ["aa1", "bb2", "cc3"]:
+            cache.store(key, "x" * 100)
+            time.sleep(0.01)
+        cache.load("aa1")
+
+        kept = [cache._path(key).stat().st_size for key in ["aa1", "cc3"]]
+        cache.evict(sum(kept))
+        assert cache.load("aa1") == "x" * 100
+        assert cache.load("bb2") is None
+        assert cache.load("cc3") == "x" * 100
+
+    def test_evicted_when_over_limit(self, data_dir: Path, monkeypatch):
+        config = data.load_config()
+        config["cache"]["max_size"] = "0.01"  # about 10 KB
+        data.save_config(config)
+        scans = []
+        evict = cache.evict
+        monkeypatch.setattr(
+            cache, "evict", lambda size: scans.append(size) or evict(size)
+        )
+
+        for i in range(200):
+            cache.store(f"{i:04}", "x" * 100)
+        size = sum(path.stat().st_size for path in (data_dir / "cache").rglob("*.json"))
+        assert size <= 0.01 * 1024 * 1024
+        # A scan for the first store, then one per tenth of the limit stored
+        assert len(scans) < 20
+
+
+class Test_Stream:
+    class File(io.StringIO):
+        def __init__(self):
+            super().__init__()
+            self.writes = []
+
+        def write(self, text: str) -> int:
+            self.writes.append(text)
+            return super().write(text)
+
+    def test_pipe_written_once(self):
+        file = self.File()
+        with stream.StreamWriter(file, interactive=False) as output:
+            for text in ["Hel", "lo\n", " world"]:
+                output.write(text)
+            assert file.writes == []
+        assert file.writes == ["Hello\n world"]
+
+    def test_pipe_flushed_by_size(self):
+        file = self.File()
+        with stream.StreamWriter(file, interactive=False, flush_size=4) as output:
+            for text in ["ab", "cd", "e"]:
+                output.write(text)
+        assert file.writes == ["abcd", "e"]
+
+    def test_terminal_flushed_at_newline(self):
+        file = self.File()
+        output = stream.StreamWriter(file, interactive=True, flush_interval=60)
+        for text in ["Hel", "lo\n", " world"]:
+            output.write(text)
+        assert file.writes == ["Hello\n"]
+        output.close()
+        assert file.getvalue() == "Hello\n world"
+
+    def test_terminal_flushed_by_timer(self):
+        file = self.File()
+        output = stream.StreamWriter(file, interactive=True, flush_interval=0)
+        for text in ["Hel", "lo"]:
+            output.write(text)
+        assert file.writes == ["Hel", "lo"]
+
+    def test_choices_interleaved_by_line(self):
+        file = self.File()
+        with stream.ChoiceWriter(file) as output:
+            output.write(0, "a")
+            output.write(1, "x\ny")
+            output.write(0, "b\nc\nd")
+            assert file.getvalue() == ""
+        assert file.getvalue() == "(1) x\n(0) ab\n(0) c\n(0) d\n(1) y\n"
+
+    @pytest.mark.parametrize("command", ["chat", "complete"])
+    def test_multiple_choices_streamed(self, runner: CliRunner, api, command: str):
+        result = runner.invoke(main, [command, "hi", "-n", "2"])
+        assert result.exit_code == 0, result.output
+        assert result.output == "(0) Hello world\n(1) Hello world\n"
+
+    def test_choices_to_output_dir(self, runner: CliRunner, api, tmp_path: Path):
+        output_dir = tmp_path / "choices"
+        result = runner.invoke(
+            main, ["complete", "hi", "-n", "2", "--output-dir", str(output_dir)]
+        )
+        assert result.exit_code == 0, result.output
+        assert result.output.splitlines() == [
+            f"({i}) {output_dir / f'choice-{i}.txt'}" for i in range(2)
+        ]
+        assert (output_dir / "choice-1.txt").read_text() == "Hello world"
+
+
+class Test_Summary:
+    @pytest.fixture
+    def history(self, data_dir: Path):
+        return History(data_dir / "history.jsonl")
+
+    def summary_requests(self, api) -> list:
+        return [
+            body
+            for _, body in api.requests
+            if body["messages"][0]["content"] == summary.SUMMARY_PROMPT
+        ]
+
+    def test_dropped_messages_are_summarized(self, runner: CliRunner, api):
+        # 40 tokens left for messages, each turn takes 14 and a fold leaves one
+        for _ in range(6):
+            result = runner.invoke(main, ["chat", "hi", "--summarize", "-c", "300"])
+            assert result.exit_code == 0, result.output
+            assert "Warning" not in result.output
+
+        # Folded on the 4th and 6th turns, not every turn
+        requests = self.summary_requests(api)
+        assert len(requests) == 2
+        assert "user: hi\n\n\nassistant: Hello world" in (
+            requests[0]["messages"][1]["content"]
+        )
+
+        history = session.history(session.DEFAULT_SESSION)
+        assert summary.load(history) == {"content": "Hello world", "covered": 8}
+        messages = api.requests[-1][1]["messages"]
+        assert messages[1]["content"].endswith("conversation:\nHello world")
+        assert [m["role"] for m in messages[2:]] == ["user", "assistant", "user"]
+
+    def test_summary_survives_compaction(self, history: History):
+        history.append([{"role": "user", "content": str(i)} for i in range(10)])
+        history.compact(3)
+        assert history.base() == 7
+        assert [m["content"] for m in history.read(1, 2)] == ["8"]
+        assert [m["content"] for m in history.read(0)] == ["7", "8", "9"]
+
+    def test_clear_removes_summary(self, history: History):
+        history.append([{"role": "user", "content": "hi"}])
+        summary.save(history, {"content": "x", "covered": 1})
+        history.clear()
+        assert summary.load(history) == {"content": "", "covered": 0}
+
+
+class Test_Relevance:
+    TOPICS = [
+        "How do I reverse a list in python?",
+        "Use slicing, items[::-1] returns a reversed copy.",
+        "What should I cook for dinner tonight?",
+        "A vegetable curry is quick and filling.",
+        "Explain the rust borrow checker",
+        "It makes sure references never outlive the value they borrow.",
+    ]
+
+    @pytest.fixture
+    def history(self, data_dir: Path):
+        history = session.history(session.DEFAULT_SESSION)
+        roles = ["user", "assistant"] * 3
+        history.append([{"role": r, "content": c} for r, c in zip(roles, self.TOPICS)])
+        return history
+
+    def test_rank(self, history: History):
+        index = relevance.TermIndex(history).load()
+        ranked = [n for _, n in index.rank("does the borrow checker slow rust down?")]
+        assert ranked[:2] == [4, 5]
+        assert 2 not in ranked
+
+    def indexed(self, history: History) -> list:
+        with contextlib.closing(sqlite3.connect(history.terms_path)) as connection:
+            rows = connection.execute("SELECT n FROM messages ORDER BY n").fetchall()
+            totals = connection.execute("SELECT messages FROM totals").fetchone()
+        assert totals == (len(rows),)
+        return [n for n, in rows]
+
+    def test_index_is_updated(self, history: History):
+        relevance.TermIndex(history).load()
+        assert self.indexed(history) == list(range(6))
+
+        history.append([{"role": "user", "content": "curry recipe"}])
+        index = relevance.TermIndex(history).load()
+        assert self.indexed(history) == list(range(7))
+        assert index.rank("curry")[0][1] in (3, 6)
+        assert index.tokens[6] > 0
+
+    def test_compacted_messages_removed(self, history: History):
+        relevance.TermIndex(history).load()
+        history.append([{"role": "user", "content": str(i)} for i in range(10)])
+        relevance.TermIndex(history).load()
+        history.compact(3)
+
+        index = relevance.TermIndex(history).load()
+        assert self.indexed(history) == [13, 14, 15]
+        assert [n for _, n in index.rank("python list borrow 9")] == [15]
+
+    def test_cleared_history_reindexed(self, history: History):
+        relevance.TermIndex(history).load()
+        history.clear()
+        history.append([{"role": "user", "content": "a fresh start"}])
+        index = relevance.TermIndex(history).load()
+        assert self.indexed(history) == [0]
+        assert [n for _, n in index.rank("fresh")] == [0]
+
+    def test_chat_sends_relevant_messages(self, runner: CliRunner, api, history):
+        history.append([{"role": "user", "content": "filler " * 40}] * 2)
+        result = runner.invoke(
+            main, ["chat", "more on the python list question", "--relevant", "-c", "80"]
+        )
+        assert result.exit_code == 0, result.output
+
+        contents = [m["content"] for m in api.requests[-1][1]["messages"]]
+        assert self.TOPICS[0] in contents
+        assert self.TOPICS[2] not in contents
+        assert contents[-1].startswith("more on the python list question")
+        # the new turn is indexed as it's saved
+        assert self.indexed(history) == list(range(10))
+
+    def test_summarize_and_relevant_conflict(self, runner: CliRunner, api):
+        result = runner.invoke(main, ["chat", "hi", "--relevant", "--summarize"])
+        assert result.exit_code == 2
+
+
+class Test_Retry:
+    @pytest.fixture(autouse=True)
+    def fast_backoff(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(api_module, "BASE_DELAY", 0.001)
+
+    def error(self, cls, headers=None, **kwargs):
+        return cls("error", headers=headers or {}, **kwargs)
+
+    @pytest.mark.parametrize(
+        "status, retried",
+        [(429, True), (500, True), (503, True), (400, False), (401, False)],
+    )
+    def test_errors_classified(self, runner: CliRunner, api, status, retried):
+        api.failures.append((status, "try again"))
+        result = runner.invoke(main, ["complete", "hi"])
+        assert len(api.requests) == (2 if retried else 1)
+        assert result.exit_code == (0 if retried else 1)
+
+    def test_gives_up(self, runner: CliRunner, api):
+        api.failures += [(502, "down")] * 10
+        result = runner.invoke(main, ["complete", "hi"])
+        assert result.exit_code == 1
+        assert len(api.requests) == 1 + api_module.DEFAULT_RETRIES
+
+    def test_image_not_retried(self, runner: CliRunner, api):
+        # The images may have been made, and billed, before the error
+        api.failures.append((500, "server error"))
+        result = runner.invoke(main, ["image", "create", "a cat"])
+        assert result.exit_code == 1
+        assert len(api.requests) == 1
+
+    def test_insufficient_quota_not_retried(self, runner: CliRunner, api):
+        api.failures.append((429, "quota", None, "insufficient_quota"))
+        result = runner.invoke(main, ["complete", "hi"])
+        assert result.exit_code == 1
+        assert len(api.requests) == 1
+
+    def test_retry_after(self, data_dir: Path):
+        error = self.error(openai.error.RateLimitError, {"retry-after": "3"})
+        assert api_module._delay(error, 0, idempotent=True) == 3
+        error = self.error(openai.error.RateLimitError, {"retry-after": "600"})
+        assert api_module._delay(error, 0, idempotent=True) is None
+
+    def test_not_idempotent(self, data_dir: Path):
+        server_error = self.error(openai.error.APIError, http_status=500)
+        rate_limit = self.error(openai.error.RateLimitError)
+        assert api_module._delay(server_error, 0, idempotent=False) is None
+        assert api_module._delay(rate_limit, 0, idempotent=False) is not None
+
+    def test_backoff_is_capped(self, data_dir: Path, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(api_module, "BASE_DELAY", 1)
+        monkeypatch.setattr(api_module.random, "uniform", lambda low, high: high)
+        error = self.error(openai.error.Timeout)
+        delays = [api_module._delay(error, attempt, True) for attempt in range(4)]
+        assert delays == [1, 2, 4, 8]
+        config = data.load_config()
+        config["api"]["max_delay"] = "3"
+        data.save_config(config)
+        assert api_module._delay(error, 3, True) == 3
+
+    @pytest.mark.parametrize("command", ["chat", "complete"])
+    def test_stream_resumed(self, runner: CliRunner, api, command: str):
+        # Breaks after "Hel" for both commands
+        api.break_stream_at = 2 if command == "chat" else 1
+        result = runner.invoke(main, [command, "hi"])
+        assert result.exit_code == 0, result.output
+        assert result.output.rstrip("\n") == "Hello world"
+        assert len(api.requests) == 2
+
+    def test_nondeterministic_stream_not_resumed(self, runner: CliRunner, api):
+        api.break_stream_at = 1
+        result = runner.invoke(main, ["complete", "hi", "-t", "1"])
+        assert result.exit_code != 0
+        assert len(api.requests) == 1
+
+    def test_async_retry(self, api):
+        api.failures.append((503, "busy"))
+        response = aio.run(
+            api_module.acall(
+                openai.Completion.acreate, api_key="sk-test", model="ada", prompt="hi"
+            )
+        )
+        assert response["choices"][0]["text"] == "Hello world"
+        assert len(api.requests) == 2
+
+    def test_async_stream_resumed(self, api):
+        api.break_stream_at = 1
+
+        async def stream():
+            response = await api_module.acall(
+                openai.Completion.acreate,
+                api_key="sk-test",
+                model="ada",
+                prompt="hi",
+                temperature=0,
+                stream=True,
+            )
+            return "".join([chunk["choices"][0]["text"] async for chunk in response])
+
+        assert aio.run(stream()) == "Hello world"
+        assert len(api.requests) == 2
+
+
+class Test_RateLimit:
+    class Clock:
+        def __init__(self):
+            self.now = 1000.0
+            self.sleeps = []
+
+        def time(self) -> float:
+            return self.now
+
+        def perf_counter(self) -> float:
+            return self.now
+
+        def sleep(self, seconds: float):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+    @pytest.fixture
+    def clock(self, monkeypatch: pytest.MonkeyPatch):
+        clock = self.Clock()
+        monkeypatch.setattr(ratelimit, "time", clock)
+        return clock
+
+    def set_limits(self, **limits):
+        config = data.load_config()
+        for model, value in limits.items():
+            config["ratelimit"][model.replace("_", "-")] = value
+        data.save_config(config)
+
+    def test_limits(self, data_dir: Path):
+        assert ratelimit.limits("gpt-4") == ("default", 0, 0)
+        self.set_limits(default="10 1000", gpt_4="2 50")
+        assert ratelimit.limits("gpt-4") == ("gpt-4", 2, 50)
+        assert ratelimit.limits("whisper-1") == ("default", 10, 1000)
+
+    def test_requests_per_minute(self, data_dir: Path, clock):
+        self.set_limits(gpt_4="2 0")
+        for _ in range(3):
+            ratelimit.acquire("gpt-4", lambda: 0)
+        # two from the full bucket, the third waits for a refill
+        assert sum(clock.sleeps) == pytest.approx(30)
+
+    def test_tokens_per_minute(self, data_dir: Path, clock):
+        self.set_limits(gpt_4="0 600")
+        ratelimit.acquire("gpt-4", lambda: 500)
+        assert clock.sleeps == []
+        ratelimit.acquire("gpt-4", lambda: 200)
+        assert sum(clock.sleeps) == pytest.approx(10)
+        # larger than the whole budget, waits for a full bucket
+        ratelimit.acquire("gpt-4", lambda: 5000)
+        assert sum(clock.sleeps) == pytest.approx(70)
+
+    def test_unlimited_skips_estimate(self, data_dir: Path):
+        ratelimit.acquire("gpt-4", lambda: pytest.fail("estimated"))
+        assert not ratelimit._STATE_FILE.exists()
+
+    def test_shared_between_processes(self, skai_env: dict, data_dir: Path):
+        self.set_limits(default="0 1000")
+        code = f"""
+from skainet import ratelimit
+from pathlib import Path
+ratelimit._STATE_FILE = Path({str(ratelimit._STATE_FILE)!r})
+ratelimit._STATE_LOCK = Path({str(ratelimit._STATE_LOCK)!r})
+ratelimit.limits = lambda model: ("default", 0, 1000)
+ratelimit.acquire(None, lambda: 400)
+"""
+        for _ in range(2):
+            run_python(code, skai_env)
+        state = json.loads(ratelimit._STATE_FILE.read_text())
+        assert state["default"]["tokens"] == pytest.approx(200, abs=5)
+
+    def test_api_calls_acquire(self, runner: CliRunner, api):
+        self.set_limits(default="0 100000")
+        runner.invoke(main, ["complete", "hi", "-mt", "50", "-n", "2"])
+        state = json.loads(ratelimit._STATE_FILE.read_text())
+        used = 100000 - state["default"]["tokens"]
+        assert used == pytest.approx(100 + tokenizer.count("hi"), abs=2)
+
+
+class Test_Connection:
+    @pytest.fixture
+    def counters(self, monkeypatch: pytest.MonkeyPatch):
+        counters = {}
+        monkeypatch.setattr(perf, "_enabled", True)
+        monkeypatch.setattr(perf, "_counters", counters)
+        return counters
+
+    def set_api(self, **settings):
+        config = data.load_config()
+        for key, value in settings.items():
+            config["api"][key] = value
+        data.save_config(config)
+
+    def test_connection_reused(self, runner: CliRunner, api, counters):
+        for _ in range(3):
+            result = runner.invoke(main, ["complete", "hi"])
+            assert result.exit_code == 0, result.output
+        assert counters["http_requests"] == 3
+        assert counters["http_connections_opened"] == 1
+        assert counters["http_connections_reused"] == 2
+
+    def test_async_proxy(self, api, monkeypatch: pytest.MonkeyPatch):
+        # The fake API stands in for the proxy, the API host doesn't resolve
+        self.set_api(proxy=api.url[: -len("/v1")])
+        monkeypatch.setattr(openai, "api_base", "http://api.invalid/v1")
+
+        async def create():
+            return await api_module.acall(
+                openai.Completion.acreate, api_key="sk-test", model="ada", prompt="hi"
+            )
+
+        assert aio.run(create())["choices"][0]["text"] == "Hello world"
+        assert api.requests[0][0] == "http://api.invalid/v1/completions"
+
+    def test_shared_between_threads(self, data_dir: Path):
+        sessions = []
+
+        def use():
+            connection.use()
+            sessions.append(openai.api_requestor._thread_context.session)
+
+        threads = [threading.Thread(target=use) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sessions == [connection.session()] * 3
+
+    def test_settings(self, data_dir: Path):
+        self.set_api(
+            connect_timeout="2.5", read_timeout="30", proxy="http://proxy:3128"
+        )
+        session = connection.session()
+        assert session.get_adapter("https://api.openai.com").timeout == (2.5, 30.0)
+        assert session.proxies == {
+            "http": "http://proxy:3128",
+            "https": "http://proxy:3128",
+        }
+
+        # a changed config gets a new session
+        self.set_api(proxy="")
+        assert connection.session() is not session
+        assert connection.session().proxies == {}
+
+
+class Test_Stats:
+    def test_calls_recorded(self, runner: CliRunner, api):
+        runner.invoke(main, ["complete", "hi"])
+        runner.invoke(main, ["complete", "hi", "--no-stream"])
+        runner.invoke(main, ["chat", "hi", "--no-update"])
+        streamed, plain, chat = stats.read()
+
+        assert streamed["endpoint"] == "completions.create"
+        assert streamed["model"] == text.DEFAULT_COMPLETE_MODEL
+        assert streamed["completion_tokens"] == 3
+        # Streams report no usage, the prompt is counted as it was sent
+        for call, (_, body) in [(streamed, api.requests[0]), (chat, api.requests[2])]:
+            assert call["prompt_tokens"] == api_module.prompt_tokens(body) > 0
+        assert 0 < streamed["ttfb"] <= streamed["ttft"] <= streamed["total"]
+        assert (plain["prompt_tokens"], plain["completion_tokens"]) == (1, 3)
+        assert plain["ttft"] is None
+        assert chat["endpoint"] == "chat.completions.create"
+        assert not any(call["retries"] or call["failed"] for call in stats.read())
+
+    def test_unreported_usage_not_counted(self, runner: CliRunner, api):
+        # Only streams are counted, image and moderation calls aren't billed by token
+        runner.invoke(main, ["edit", "upper", "hi"])
+        (edit,) = stats.read()
+        assert edit["endpoint"] == "edits.create"
+        assert edit["prompt_tokens"] == 0
+
+    def test_retries_and_failures(self, runner: CliRunner, api):
+        api.failures.append((500, "try again"))
+        runner.invoke(main, ["complete", "hi"])
+        api.break_stream_at = 1
+        runner.invoke(main, ["complete", "hi"])
+        api.failures.append((400, "bad"))
+        runner.invoke(main, ["complete", "hi"])
+        calls = list(stats.read())
+        assert [call["retries"] for call in calls] == [1, 1, 0]
+        assert [call["failed"] for call in calls] == [False, False, True]
+
+    def test_async_recorded(self, api):
+        async def create():
+            return await api_module.acall(
+                openai.Completion.acreate, api_key="sk-test", model="ada", prompt="hi"
+            )
+
+        aio.run(create())
+        (call,) = stats.read()
+        assert (call["endpoint"], call["model"]) == ("completions.create", "ada")
+
+    def test_command(self, runner: CliRunner, api):
+        for _ in range(2):
+            runner.invoke(main, ["complete", "hi"])
+        runner.invoke(main, ["chat", "hi", "--no-update"])
+
+        result = runner.invoke(main, ["stats"])
+        assert result.exit_code == 0, result.output
+        header, *rows = result.output.splitlines()
+        assert header.split()[:5] == ["model", "endpoint", "calls", "failed", "retries"]
+        assert [row.split()[1:3] for row in rows] == [
+            ["chat.completions.create", "1"],
+            ["completions.create", "2"],
+        ]
+
+        result = runner.invoke(main, ["stats", "--json", "-m", text.DEFAULT_CHAT_MODEL])
+        (row,) = json.loads(result.output)
+        assert row["calls"] == 1
+        assert row["total_p50"] == row["total_p99"] > 0
+
+        result = runner.invoke(main, ["stats", "--since", "1s"])
+        assert result.exit_code == 0
+        assert runner.invoke(main, ["stats", "--since", "soon"]).exit_code == 2
+
+    def test_since(self, data_dir: Path, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(stats.time, "time", lambda: 1000.0)
+        stats.record("edits.create", "m", 1, 1, None, 0, 0, 0, False)
+        monkeypatch.setattr(stats.time, "time", lambda: 2000.0)
+        stats.record("edits.create", "m", 2, 1, None, 0, 0, 0, False)
+        assert [call["total"] for call in stats.read(1500)] == [2]
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert [stats.percentile(values, p) for p in (50, 95, 99)] == [50, 95, 99]
+        assert stats.percentile([3], 99) == 3
+        assert stats.percentile([], 50) is None
+
+    def test_rotated(self, data_dir: Path):
+        config = data.load_config()
+        config["stats"]["max_size"] = "0.0001"  # about 100 bytes
+        data.save_config(config)
+        for total in range(10):
+            stats.record("completions.create", "ada", total, 0, None, 0, 0, 0, False)
+        assert (data_dir / "stats.1.bin").exists()
+        totals = [call["total"] for call in stats.read()]
+        assert totals == sorted(totals)
+        assert totals[-1] == 9
+
+    def test_partial_record_ignored(self, data_dir: Path):
+        stats.record("completions.create", "ada", 1, 0, None, 0, 0, 0, False)
+        with open(data_dir / "stats.bin", "ab") as file:
+            file.write(b"\0" * 10)
+        assert len(list(stats.read())) == 1
+
+    def test_disabled(self, runner: CliRunner, api, data_dir: Path):
+        config = data.load_config()
+        config["stats"]["enabled"] = "false"
+        data.save_config(config)
+        runner.invoke(main, ["complete", "hi"])
+        assert not (data_dir / "stats.bin").exists()
+
+    def test_overhead(self, data_dir: Path):
+        stats.record("completions.create", "ada", 1, 0, None, 0, 0, 0, False)
+        start = time.perf_counter()
+        for _ in range(200):
+            stats.record("completions.create", "ada", 1, 0, 0.5, 10, 20, 0, False)
+        assert (time.perf_counter() - start) / 200 < 0.001